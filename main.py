@@ -1,13 +1,25 @@
 import argparse
+import logging
 import sys
+import wave
 from pathlib import Path
-from shutil import move, copy
+from shutil import copy
+from subprocess import CalledProcessError
 
-from utils.apply_mapping import apply_mapping
-from utils.convert_ant_segments import convert_ant_segments
-from utils.fix_ctms import fix_ctms
+from utils.convert_ant_segments import process_ant_segments
+from utils.ctm_postprocess import CtmPostProcessor
+from utils.g2p_cache import G2PCache
+from utils.global_language import GlobalLanguage
 from utils.kaldi_programs import KaldiPrograms
-from utils.prepare_language import prepare_language_file
+from utils.language_cache import LanguageCache
+from utils.lattice_ctm import lattice_to_ctms
+from utils.log import log, start_queue_logging, stop_queue_logging
+from utils.phone_set_cache import PhoneSetCache
+from utils.prepare_language import phone_set, sil_prob, prepare_language_file, read_transcription, read_word_ids, \
+    write_transcription
+from utils.profiler import Profiler
+from utils.beam_policy import BeamPolicy, default_beams, parse_beams
+from utils.workspace import create_workspace, remove_workspace
 
 if getattr(sys, 'frozen', False):
     prog_root = Path(sys.executable).parent
@@ -21,10 +33,18 @@ g2p_dir = data / 'g2p'
 
 custom_phones = data / 'custom_phones.txt'
 lda_mat = model_dir / 'final.mat'
+splice_opts = model_dir / 'splice_opts'
 model_file = model_dir / 'final.mdl'
 tree = model_dir / 'tree'
 g2p_path = g2p_dir / 'model.fst'
 g2p_lex_path = g2p_dir / 'lexicon.txt'
+g2p_cache_path = g2p_dir / 'g2p_cache.db'
+bin_cache_path = data / 'bin_paths.json'
+phone_set_cache_path = data / 'phone_sets'
+language_cache_path = data / 'language_cache'
+global_lang_path = data / 'global_lang'
+beam_stats_path = data / 'beam_stats.json'
+feature_cache_path = data / 'feature_cache'
 
 if sys.platform == 'win32' or sys.platform == 'cygwin':
     def_bin = prog_root / 'win32bin'
@@ -34,102 +54,349 @@ if sys.platform == 'win32' or sys.platform == 'cygwin':
 else:
     def_bin = '/home/guest/Applications/kaldi'
 
+def read_manifest(manifest, default_type):
+    entries = []
+    with open(str(manifest), encoding='utf-8') as f:
+        for l in f:
+            tok = l.rstrip('\r\n').split('\t')
+            if len(tok[0].strip()) == 0:
+                continue
+            audio = Path(tok[0])
+            trans = Path(tok[1])
+            type = tok[2] if len(tok) > 2 and tok[2] else default_type
+            output = Path(tok[3]) if len(tok) > 3 and tok[3] else trans.with_suffix('.ctm')
+            entries.append((f'rec{len(entries):05}', audio, trans, type, output))
+    return entries
+
+
+def prepare_data(entries, wav_scp, segments_file, text_file, max_chunk=None, chunks=None):
+    """Writes wav.scp, the text and, if needed, the segments of the entries. In long audio mode, the
+    (start sample, end sample, words) pieces of each txt recording are put in chunks under its rec_id, with
+    its sampling rate and the IDs of their utterances."""
+    use_segments = any(e[3] == 'ant' for e in entries) or max_chunk is not None
+
+    with open(str(wav_scp), 'w', encoding='utf-8') as f:
+        for rec_id, audio, trans, type, output in entries:
+            f.write(f'{rec_id} {audio}\n')
+
+    with open(str(text_file), 'w', encoding='utf-8') as g:
+        if use_segments:
+            f = open(str(segments_file), 'w', encoding='utf-8')
+        for rec_id, audio, trans, type, output in entries:
+            if type == 'ant':
+                segments = process_ant_segments(trans)
+                log.info(f'Found {len(segments)} segments in {trans}.')
+                for num, seg in enumerate(segments):
+                    f.write(f'{rec_id}_seg_{num:05} {rec_id} {seg[1]:0.2f} {seg[2]:0.2f}\n')
+                    g.write(f'{rec_id}_seg_{num:05} {seg[0]}\n')
+            elif type == 'txt' and max_chunk is not None:
+                import numpy as np
+                from utils.long_audio import split_long_audio
+                from utils.wav_reader import MappedWave
+
+                with open(str(trans), encoding='utf-8') as t:
+                    l = ' '.join(t.read().split())
+                with MappedWave(audio) as w:
+                    rate = w.getframerate()
+                    pieces = split_long_audio(np.frombuffer(w.data, dtype=np.int16), l, rate, max_chunk=max_chunk)
+                for num, (start, end, words) in enumerate(pieces):
+                    f.write(f'{rec_id}_chunk_{num:05} {rec_id} {start / rate:0.2f} {end / rate:0.2f}\n')
+                    g.write(f'{rec_id}_chunk_{num:05} {" ".join(words)}\n')
+                if chunks is not None:
+                    chunks[rec_id] = (rate, pieces, [f'{rec_id}_chunk_{num:05}' for num in range(len(pieces))])
+            elif type == 'txt':
+                with open(str(trans), encoding='utf-8') as t:
+                    l = t.readline().strip()
+                g.write(f'{rec_id} {l}\n')
+                if use_segments:
+                    with wave.open(str(audio)) as w:
+                        length = w.getnframes() / w.getframerate()
+                    f.write(f'{rec_id} {rec_id} 0.00 {length:0.2f}\n')
+            else:
+                raise RuntimeError(f'Unknown type {type} for {trans}!')
+        if use_segments:
+            f.close()
+
+    return use_segments
+
+
+def align_utterances(kaldi, profiler, work, lang, segments, args, feature_cache=None, beam_policy=None):
+    """Aligns the utterances of work/wav.scp (cut by segments) to work/trans.int with the language files in lang
+    and writes the word and phone CTMs to work/ctm.int and work/phone_ctm.int."""
+    if args.features == 'numpy':
+        from utils.features import compute_features
+
+        with profiler.stage('compute_features'):
+            compute_features(work / 'wav.scp', segments, work / 'feats.ark', lda_mat, splice_opts,
+                             cache=feature_cache)
+
+        feature_pipeline = f'ark:{work / "feats.ark"}'
+    else:
+        kaldi.compute_mfcc_feats(work / 'wav.scp', work / 'mfcc', segments)
+        kaldi.compute_cmvn_stats(work / 'mfcc', work / 'cmvn')
+
+        with open(str(splice_opts), encoding='utf-8') as f:
+            splice = f.read().strip()
+
+        feature_pipeline = f'ark,s,cs:apply-cmvn ark:"{work / "cmvn"}" ark:"{work / "mfcc"}" ark:- | ' \
+            f'splice-feats {splice} ark:- ark:- | ' \
+            f'transform-feats "{lda_mat}" ark:- ark:- |'
+
+    output_pipeline = f'ark:|linear-to-nbest ark:- ark:"{work / "trans.int"}" "" "" ark:- | ' \
+        f'lattice-align-words "{lang / "word_boundary.int"}" "{model_file}" ark:- ark:"{work / "nbest_ali"}"'
+
+    if beam_policy:
+        kaldi.gmm_align_adaptive(tree, model_file, lang / 'L.fst', feature_pipeline, work / 'trans.int',
+                                 work / 'ali', beam_policy)
+        kaldi.align_words(work / 'ali', work / 'trans.int', lang / 'word_boundary.int', model_file,
+                          work / 'nbest_ali')
+    else:
+        kaldi.gmm_align(tree, model_file, lang / 'L.fst', feature_pipeline, work / 'trans.int', output_pipeline)
+
+    if args.ctm == 'python':
+        with profiler.stage('lattice_to_ctms'):
+            lattice_to_ctms(model_file, work / 'nbest_ali', work / 'ctm.int', work / 'phone_ctm.int')
+    else:
+        kaldi.nbest_to_ctm(work / 'nbest_ali', work / 'ctm.int')
+
+        kaldi.lattice_to_phone_lattice(model_file, work / 'nbest_ali', work / 'phone_ali')
+        kaldi.nbest_to_ctm(work / 'phone_ali', work / 'phone_ctm.int')
+
+
+def read_ctm_lines(path, lines=None):
+    lines = {} if lines is None else lines
+    with open(str(path), encoding='utf-8') as f:
+        for l in f:
+            lines.setdefault(l.split(maxsplit=1)[0], []).append(l)
+    return lines
+
+
+def realign_failed_chunks(kaldi, profiler, work, segments, chunks, args, feature_cache=None, beam_policy=None):
+    """Long audio mode: like align_long_audio, merges each chunk left without words with its neighbour and aligns
+    the merged chunks again, until all are aligned or the recording is in one piece. The merged chunks are added
+    to segments and their CTMs replace those of the chunks they were made from in work/ctm.int and
+    work/phone_ctm.int."""
+    from utils.long_audio import merge_failed
+
+    word_lines = read_ctm_lines(work / 'ctm.int')
+    phone_lines = read_ctm_lines(work / 'phone_ctm.int')
+    word_ids = read_word_ids(work / 'words.txt')
+    failed_recordings = set()
+
+    attempt = 0
+    while True:
+        retry = []
+        for rec_id, (rate, pieces, ids) in chunks.items():
+            failed = [i for i, utt in enumerate(ids) if utt not in word_lines]
+            if not failed or rec_id in failed_recordings:
+                continue
+            if len(pieces) == 1:
+                log.error(f'Failed to align the whole recording {rec_id}.')
+                failed_recordings.add(rec_id)
+                continue
+            merge_failed(pieces, ids, failed, rate)
+            for i, utt in enumerate(ids):
+                if utt is None:
+                    ids[i] = f'{rec_id}_retry{attempt}_{i:05}'
+                    retry.append((rec_id, rate, ids[i], pieces[i]))
+        if not retry:
+            break
+
+        retry_work = work / f'retry{attempt}'
+        retry_work.mkdir()
+        copy(str(work / 'wav.scp'), str(retry_work / 'wav.scp'))
+        with open(str(retry_work / 'segments'), 'w', encoding='utf-8') as f, \
+                open(str(segments), 'a', encoding='utf-8') as g:
+            for rec_id, rate, utt, (start, end, words) in retry:
+                line = f'{utt} {rec_id} {start / rate:0.2f} {end / rate:0.2f}\n'
+                f.write(line)
+                g.write(line)
+        write_transcription(retry_work / 'trans.int', {utt: words for rec_id, rate, utt, (start, end, words) in retry},
+                            word_ids)
+
+        log.info(f'Aligning {len(retry)} merged chunks again.')
+        try:
+            align_utterances(kaldi, profiler, retry_work, work, retry_work / 'segments', args, feature_cache,
+                             beam_policy)
+            read_ctm_lines(retry_work / 'ctm.int', word_lines)
+            read_ctm_lines(retry_work / 'phone_ctm.int', phone_lines)
+        except (CalledProcessError, RuntimeError, AssertionError):
+            # gmm-align fails when none of the utterances could be aligned
+            log.warning('None of the merged chunks could be aligned.')
+        attempt += 1
+
+    # the CTMs in the order of the text, with the chunks of each recording in their place, leaving out the ones
+    # that were merged into others
+    first_chunks = {f'{rec_id}_chunk_{0:05}': ids for rec_id, (rate, pieces, ids) in chunks.items()}
+    order = []
+    with open(str(work / 'text'), encoding='utf-8') as f:
+        for l in f:
+            utt = l.split(maxsplit=1)[0]
+            if utt in first_chunks:
+                order.extend(first_chunks[utt])
+            elif utt.rsplit('_chunk_', 1)[0] not in chunks:
+                order.append(utt)
+    for name, lines in (('ctm.int', word_lines), ('phone_ctm.int', phone_lines)):
+        with open(str(work / name), 'w', encoding='utf-8') as f:
+            for utt in order:
+                f.writelines(lines.get(utt, []))
+
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
-    parser.add_argument('audio', type=Path, help='Audio WAV file.')
-    parser.add_argument('trans', type=Path, help='Transcription file.')
+    parser.add_argument('audio', type=Path, nargs='?', help='Audio WAV file.')
+    parser.add_argument('trans', type=Path, nargs='?', help='Transcription file.')
     parser.add_argument('--type', '-t', default='ant',help='Type of transcription: ant (ANT xml transcription and segmentation), txt (text transcription)')
+    parser.add_argument('--batch', type=Path,
+                        help='Manifest with one tab-separated "audio trans [type] [output]" row per file. '
+                             'All the files are aligned together and the results of each are written to its output '
+                             '(default: trans with the .ctm extension).')
     parser.add_argument('--bin-root', type=Path, help='Root folder containing all the binary files', default=def_bin)
     parser.add_argument('--cleanup', type=str, default='y', help='Erase unnecessary files after completion.')
+    parser.add_argument('--g2p-cache', type=str, default='y', help='Reuse G2P pronunciations from previous runs.')
+    parser.add_argument('--global-lexicon', type=str, default='n',
+                        help='Use the language files built once for the whole lexicon (python -m '
+                             'utils.global_language). Jobs with words missing from them prepare their own and start '
+                             'a build that adds the words in the background.')
+    parser.add_argument('--language-cache', type=str, default='y',
+                        help='Reuse the language files (L.fst and the symbol tables) made for the same vocabulary.')
+    parser.add_argument('--fst-mode', default='fstcompile', choices=['fstcompile', 'python'],
+                        help='Compile L.fst with fstcompile/fstarcsort or write it directly from Python.')
+    parser.add_argument('--feature-cache', type=str, default='n',
+                        help='Reuse the MFCCs of audio segments computed in previous runs (needs NumPy).')
+    parser.add_argument('--features', default='kaldi', choices=['kaldi', 'numpy'],
+                        help='Compute the features with the Kaldi programs or in-process with NumPy.')
+    parser.add_argument('--ctm', default='kaldi', choices=['kaldi', 'python'],
+                        help='Make the CTMs with nbest-to-ctm and lattice-to-phone-lattice or in-process.')
+    parser.add_argument('--long-audio', type=str, default='n',
+                        help='Split txt recordings at pauses and align the pieces as separate utterances (needs NumPy).')
+    parser.add_argument('--max-chunk', type=float, default=30.0,
+                        help='Maximum length of the pieces in long audio mode, in seconds.')
+    parser.add_argument('--adaptive-beam', type=str, default='n',
+                        help='Start with a narrow beam and widen it only for the segments that fail, learning the '
+                             'starting beam from previous runs.')
+    parser.add_argument('--beams', type=parse_beams, default=default_beams,
+                        help='Comma-separated beams tried in adaptive beam mode, from the narrowest.')
+    parser.add_argument('--profile', type=Path,
+                        help='Write a JSON report with the time and resources used by each stage to this file.')
 
-    args = parser.parse_args()
-
-    kaldi = KaldiPrograms(args.bin_root)
+    parser.add_argument('--work-dir', type=Path, default=work,
+                        help='Folder in which each job creates its own workspace for the intermediate files.')
+    parser.add_argument('--ram', type=str, default='n',
+                        help='Keep the intermediate files in RAM (on /dev/shm) instead of the work dir.')
+    parser.add_argument('--log-queue', type=str, default='y',
+                        help='Write the log from a background thread in batches.')
+    parser.add_argument('--log-dir', type=Path,
+                        help='With the log queue, write the Kaldi messages of each job to <job>.log in this folder '
+                             'instead of main.log.')
+    parser.add_argument('--log-level', default='debug', choices=['debug', 'info', 'warning', 'error'],
+                        help='Lowest level of Kaldi messages (VLOG, LOG, WARNING, ERROR) written to the log.')
+    parser.add_argument('--log-rate', type=float,
+                        help='Maximum number of Kaldi log lines per second, the rest are dropped (errors are always kept).')
 
-    work.mkdir(exist_ok=True)
+    args = parser.parse_args()
 
-    segments = work / 'segments'
-    text_file = work / 'text'
+    if args.log_queue.lower() in ['y', 'yes', 't', 'true']:
+        start_queue_logging(args.log_dir)
 
-    if args.type=='ant':
-        convert_ant_segments(args.trans, segments, text_file)
-    elif args.type=='txt':
-        with open(str(args.trans)) as f, open(str(text_file),'w') as g:
-            l=f.readline().strip()
-            g.write('input '+l+'\n')                
-        segments=None
+    if args.batch:
+        entries = read_manifest(args.batch, args.type)
+    elif args.audio and args.trans:
+        entries = [('input', args.audio, args.trans, args.type, None)]
     else:
+        parser.error('either audio and trans or --batch is required')
+
+    if any(e[3] not in ['ant', 'txt'] for e in entries):
         print('Unknown type!')
         exit(1)
 
-    with open(work / 'wav.scp', 'w', encoding='utf-8') as f:
-        wav_file = Path(args.audio)
-        f.write(f'input {wav_file}\n')
+    profiler = Profiler()
 
-    kaldi.compute_mfcc_feats(work / 'wav.scp', work / 'mfcc', segments)
-    kaldi.compute_cmvn_stats(work / 'mfcc', work / 'cmvn')
+    feature_cache = None
+    if args.feature_cache.lower() in ['y', 'yes', 't', 'true']:
+        from utils.feature_cache import FeatureCache
 
-    feature_pipeline = f'ark,s,cs:apply-cmvn ark:"{work / "cmvn"}" ark:"{work / "mfcc"}" ark:- | ' \
-        f'splice-feats --left-context=3 --right-context=3 ark:- ark:- | ' \
-        f'transform-feats "{lda_mat}" ark:- ark:- |'
+        feature_cache = FeatureCache(feature_cache_path)
 
-    output_pipeline = f'ark:|linear-to-nbest ark:- ark:"{work / "trans.int"}" "" "" ark:- | ' \
-        f'lattice-align-words "{work / "word_boundary.int"}" "{model_file}" ark:- ark:"{work / "nbest_ali"}"'
+    work = create_workspace(args.work_dir, args.ram.lower() in ['y', 'yes', 't', 'true'])
 
-    prepare_language_file(text_file, work, g2p_path, g2p_lex_path, '<unk>', kaldi)
+    kaldi = KaldiPrograms(args.bin_root, profiler, job=work.name,
+                          log_level=logging.getLevelName(args.log_level.upper()), log_rate=args.log_rate,
+                          cache_path=bin_cache_path, feature_cache=feature_cache)
 
-    kaldi.gmm_align(tree, model_file, work / 'L.fst', feature_pipeline, work / 'trans.int', output_pipeline)
+    g2p_cache = None
+    if args.g2p_cache.lower() in ['y', 'yes', 't', 'true']:
+        g2p_cache = G2PCache(g2p_cache_path, g2p_path)
 
-    kaldi.nbest_to_ctm(work / 'nbest_ali', work / 'ctm.int')
+    global_lexicon = args.global_lexicon.lower() in ['y', 'yes', 't', 'true']
 
-    kaldi.lattice_to_phone_lattice(model_file, work / 'nbest_ali', work / 'phone_ali')
-    kaldi.nbest_to_ctm(work / 'phone_ali', work / 'phone_ctm.int')
+    language_cache = None
+    if args.language_cache.lower() in ['y', 'yes', 't', 'true'] and not global_lexicon:
+        language_cache = LanguageCache(language_cache_path, g2p_path, g2p_lex_path, phone_set, sil_prob)
 
-    apply_mapping(work / 'ctm.int', work / 'words.txt', '4', work / 'ctm.txt', True)
-    apply_mapping(work / 'phone_ctm.int', work / 'phones.txt', '4', work / 'phone_ctm.txt', True)
+    segments = work / 'segments'
+    text_file = work / 'text'
 
-    phone_map = {}
-    with open(str(custom_phones), encoding='utf-8') as f:
-        for l in f:
-            tok = l.strip().split()
-            if len(tok) == 1:
-                phone_map[tok[0]] = ''
-            elif len(tok) == 2:
-                phone_map[tok[0]] = tok[1]
-
-    with open(work / 'phone_ctm.txt', encoding='utf-8') as f:
-        with open(work / 'phone_ctm_fixed.txt', 'w', encoding='utf-8') as g:
-            for l in f:
-                tok = l.strip().split()
-                ph = tok[-1]
-                if ph[-2] == '_' and (ph[-1] == 'B' or ph[-1] == 'E' or ph[-1] == 'S' or ph[-1] == 'I'):
-                    ph = ph[:-2]
-                if ph in phone_map:
-                    ph = phone_map[ph]
-                tok[-1] = ph
-                g.write(' '.join(tok))
-                g.write('\n')
-
-    if segments:
-        fix_ctms(work / 'ctm.txt', segments, work / 'tmp')
-        move(work / 'tmp', work / 'ctm.txt')
-        fix_ctms(work / 'phone_ctm_fixed.txt', segments, work / 'tmp')
-        move(work / 'tmp', work / 'phone_ctm_fixed.txt')
-
-    with open(work / 'ctm.txt', encoding='utf-8') as f:
-        for l in f:
-            tok = l.strip().split()
-            print(f'w\t{tok[2]}\t{tok[3]}\t{tok[4]}')
+    long_audio = args.long_audio.lower() in ['y', 'yes', 't', 'true']
+    chunks = {}
+    if not prepare_data(entries, work / 'wav.scp', segments, text_file, args.max_chunk if long_audio else None,
+                        chunks):
+        segments = None
 
-    with open(work / 'phone_ctm_fixed.txt', encoding='utf-8') as f:
-        for l in f:
-            tok = l.strip().split()
-            if len(tok) >= 5:
-                print(f'p\t{tok[2]}\t{tok[3]}\t{tok[4]}')
+    with profiler.stage('prepare_language'):
+        phone_cache = PhoneSetCache(phone_set_cache_path, phone_set)
+        if global_lexicon:
+            global_language = GlobalLanguage(global_lang_path, g2p_path, g2p_lex_path, '<unk>', kaldi, g2p_cache,
+                                             args.fst_mode, phone_cache)
+            transcription, wordlist = read_transcription(text_file)
+            global_language.prepare(wordlist, transcription, work)
+        else:
+            prepare_language_file(text_file, work, g2p_path, g2p_lex_path, '<unk>', kaldi, g2p_cache, args.fst_mode,
+                                  phone_cache, language_cache)
+
+    beam_policy = None
+    if args.adaptive_beam.lower() in ['y', 'yes', 't', 'true']:
+        beam_policy = BeamPolicy(args.beams, beam_stats_path)
+
+    align_utterances(kaldi, profiler, work, work, segments, args, feature_cache, beam_policy)
+    if chunks:
+        realign_failed_chunks(kaldi, profiler, work, segments, chunks, args, feature_cache, beam_policy)
+
+    if beam_policy:
+        beam_policy.log_summary()
+        beam_policy.save()
+        profiler.set_counters('beam_policy', beam_policy.counters())
+
+    with profiler.stage('postprocess'):
+        postprocessor = CtmPostProcessor(work / 'words.txt', work / 'phones.txt', custom_phones, segments)
+        results = postprocessor.process(work / 'ctm.int', work / 'phone_ctm.int')
+
+    for rec_id, audio, trans, type, output in entries:
+        if output:
+            with open(str(output), 'w', encoding='utf-8') as f:
+                for l in results.get(rec_id, []):
+                    f.write(l + '\n')
+        else:
+            for l in results.get(rec_id, []):
+                print(l)
 
     if args.cleanup.lower() in ['y','yes','t','true']:
-        for file in work.glob('**/*'):
-            file.unlink()
+        remove_workspace(work)
 
     kaldi.close()
+    if g2p_cache:
+        g2p_cache.close()
+    if language_cache:
+        language_cache.close()
+    if feature_cache:
+        feature_cache.close()
+
+    if args.profile:
+        audio_duration = 0.0
+        for rec_id, audio, trans, type, output in entries:
+            with wave.open(str(audio)) as w:
+                audio_duration += w.getnframes() / w.getframerate()
+        profiler.dump(args.profile, audio_duration)
+        profiler.print_summary(audio_duration)
+
+    stop_queue_logging()
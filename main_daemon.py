@@ -0,0 +1,155 @@
+import argparse
+import logging
+import sys
+from pathlib import Path
+
+from utils.align_daemon import AlignDaemon, create_server
+from utils.beam_policy import BeamPolicy, default_beams, parse_beams
+from utils.g2p_cache import G2PCache
+from utils.global_language import GlobalLanguage
+from utils.kaldi_programs import KaldiPrograms
+from utils.language_cache import LanguageCache
+from utils.log import log, start_queue_logging, stop_queue_logging
+from utils.phone_set_cache import PhoneSetCache
+from utils.prepare_language import phone_set, sil_prob
+
+if getattr(sys, 'frozen', False):
+    prog_root = Path(sys.executable).parent
+else:
+    prog_root = Path(__file__).parent
+
+work = prog_root / 'work'
+data = prog_root / 'data'
+model_dir = data / 'model'
+g2p_dir = data / 'g2p'
+
+lda_mat = model_dir / 'final.mat'
+model_file = model_dir / 'final.mdl'
+tree = model_dir / 'tree'
+g2p_path = g2p_dir / 'model.fst'
+g2p_lex_path = g2p_dir / 'lexicon.txt'
+g2p_cache_path = g2p_dir / 'g2p_cache.db'
+bin_cache_path = data / 'bin_paths.json'
+phone_set_cache_path = data / 'phone_sets'
+language_cache_path = data / 'language_cache'
+global_lang_path = data / 'global_lang'
+beam_stats_path = data / 'beam_stats.json'
+
+if sys.platform == 'win32' or sys.platform == 'cygwin':
+    def_bin = prog_root / 'win32bin'
+    import win_unicode_console
+
+    win_unicode_console.enable()
+else:
+    def_bin = '/home/guest/Applications/kaldi'
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Serves alignment requests over HTTP, keeping gmm-align-pipe '
+                                                 'loaded between them.')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on.')
+    parser.add_argument('--port', type=int, default=8765, help='Port to listen on.')
+    parser.add_argument('--socket', type=Path, help='Listen on this Unix socket instead of a port.')
+    parser.add_argument('--vocabulary', type=Path,
+                        help='Text file with the words of the language the pool is loaded with, when the global lexicon is '
+                             'not used. Requests with other words are aligned with their own language.')
+    parser.add_argument('--bin-root', type=Path,
+                        help='Root folder containing all the binary files', default=def_bin)
+    parser.add_argument('--g2p-cache', type=str, default='y',
+                        help='Reuse G2P pronunciations from previous runs.')
+    parser.add_argument('--global-lexicon', type=str, default='n',
+                        help='Load the pool with the language files built once for the whole lexicon (python -m '
+                             'utils.global_language), moving to each new build. Requests with words missing from '
+                             'them are aligned with their own language and start a build that adds the words in the '
+                             'background.')
+    parser.add_argument('--language-cache', type=str, default='y',
+                        help='Reuse the language files (L.fst and the symbol tables) made for the same vocabulary.')
+    parser.add_argument('--fst-mode', default='fstcompile', choices=['fstcompile', 'python'],
+                        help='Compile L.fst with fstcompile/fstarcsort or write it directly from Python.')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='Number of gmm-align-pipe processes aligning requests in parallel.')
+    parser.add_argument('--batch-size', type=int, default=16,
+                        help='Maximum number of queued requests sent to the pipes together.')
+    parser.add_argument('--adaptive-beam', type=str, default='n',
+                        help='Start with a narrow beam and widen it only for the segments that fail, learning the '
+                             'starting beam from previous runs.')
+    parser.add_argument('--beams', type=parse_beams, default=default_beams,
+                        help='Comma-separated beams tried in adaptive beam mode, from the narrowest.')
+    parser.add_argument('--work-dir', type=Path, default=work,
+                        help='Folder in which the workspaces for the language files are created.')
+    parser.add_argument('--ram', type=str, default='n',
+                        help='Keep the language files in RAM (on /dev/shm) instead of the work dir.')
+    parser.add_argument('--log-queue', type=str, default='y',
+                        help='Write the log from a background thread in batches.')
+    parser.add_argument('--log-dir', type=Path,
+                        help='With the log queue, write the Kaldi messages of each job to <job>.log in this folder '
+                             'instead of main.log.')
+    parser.add_argument('--log-level', default='debug', choices=['debug', 'info', 'warning', 'error'],
+                        help='Lowest level of Kaldi messages (VLOG, LOG, WARNING, ERROR) written to the log.')
+    parser.add_argument('--log-rate', type=float,
+                        help='Maximum number of Kaldi log lines per second, the rest are dropped (errors are always kept).')
+
+    args = parser.parse_args()
+
+    if args.log_queue.lower() in ['y', 'yes', 't', 'true']:
+        start_queue_logging(args.log_dir)
+
+    kaldi = KaldiPrograms(args.bin_root, job='daemon', log_level=logging.getLevelName(args.log_level.upper()),
+                          log_rate=args.log_rate, cache_path=bin_cache_path)
+
+    g2p_cache = None
+    if args.g2p_cache.lower() in ['y', 'yes', 't', 'true']:
+        g2p_cache = G2PCache(g2p_cache_path, g2p_path)
+
+    global_lexicon = args.global_lexicon.lower() in ['y', 'yes', 't', 'true']
+
+    language_cache = None
+    if args.language_cache.lower() in ['y', 'yes', 't', 'true'] and not global_lexicon:
+        language_cache = LanguageCache(language_cache_path, g2p_path, g2p_lex_path, phone_set, sil_prob)
+
+    vocabulary = set()
+    if args.vocabulary:
+        with open(str(args.vocabulary), encoding='utf-8') as f:
+            for l in f:
+                vocabulary.update(l.strip().split())
+
+    beam_policy = None
+    if args.adaptive_beam.lower() in ['y', 'yes', 't', 'true']:
+        beam_policy = BeamPolicy(args.beams, beam_stats_path)
+
+    phone_cache = PhoneSetCache(phone_set_cache_path, phone_set)
+
+    global_language = None
+    if global_lexicon:
+        global_language = GlobalLanguage(global_lang_path, g2p_path, g2p_lex_path, '<unk>', kaldi, g2p_cache,
+                                         args.fst_mode, phone_cache)
+
+    daemon = AlignDaemon(kaldi, tree, model_file, lda_mat, g2p_path, g2p_lex_path, args.work_dir, args.jobs,
+                         g2p_cache, args.fst_mode, args.ram.lower() in ['y', 'yes', 't', 'true'], args.batch_size,
+                         vocabulary, beam_policy=beam_policy, phone_cache=phone_cache, language_cache=language_cache,
+                         global_language=global_language)
+
+    server = create_server(daemon, args.host, args.port, args.socket)
+    where = args.socket if args.socket else f'http://{args.host}:{args.port}'
+    log.info(f'Listening on {where}')
+    print(f'Listening on {where}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket:
+            args.socket.unlink()
+
+        daemon.close()
+        kaldi.close()
+        if beam_policy:
+            beam_policy.log_summary()
+            beam_policy.save()
+        if g2p_cache:
+            g2p_cache.close()
+        if language_cache:
+            language_cache.close()
+
+        stop_queue_logging()
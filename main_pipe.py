@@ -1,15 +1,21 @@
 import argparse
+import logging
 import sys
 from pathlib import Path
-from shutil import move, copy
-import wave
 
-from utils.apply_mapping import apply_mapping
 from utils.convert_ant_segments import process_ant_segments
-from utils.fix_ctms import fix_ctms
+from utils.g2p_cache import G2PCache
+from utils.global_language import GlobalLanguage
 from utils.kaldi_programs import KaldiPrograms
-from utils.prepare_language import prepare_language_wordlist, prepare_language_file
-from utils.align_pipe import AlignPipe
+from utils.language_cache import LanguageCache
+from utils.log import log, start_queue_logging, stop_queue_logging
+from utils.phone_set_cache import PhoneSetCache
+from utils.prepare_language import phone_set, sil_prob, prepare_language_wordlist
+from utils.align_pipe import AlignPipePool, AdaptiveAlignPipePool
+from utils.beam_policy import BeamPolicy, default_beams, parse_beams
+from utils.profiler import Profiler
+from utils.workspace import create_workspace, remove_workspace
+from utils.wav_reader import MappedWave
 
 if getattr(sys, 'frozen', False):
     prog_root = Path(sys.executable).parent
@@ -27,6 +33,12 @@ model_file = model_dir / 'final.mdl'
 tree = model_dir / 'tree'
 g2p_path = g2p_dir / 'model.fst'
 g2p_lex_path = g2p_dir / 'lexicon.txt'
+g2p_cache_path = g2p_dir / 'g2p_cache.db'
+bin_cache_path = data / 'bin_paths.json'
+phone_set_cache_path = data / 'phone_sets'
+language_cache_path = data / 'language_cache'
+global_lang_path = data / 'global_lang'
+beam_stats_path = data / 'beam_stats.json'
 
 if sys.platform == 'win32' or sys.platform == 'cygwin':
     def_bin = prog_root / 'win32bin'
@@ -47,51 +59,135 @@ if __name__ == '__main__':
                         help='Root folder containing all the binary files', default=def_bin)
     parser.add_argument('--cleanup', type=str, default='y',
                         help='Erase unnecessary files after completion.')
+    parser.add_argument('--g2p-cache', type=str, default='y',
+                        help='Reuse G2P pronunciations from previous runs.')
+    parser.add_argument('--global-lexicon', type=str, default='n',
+                        help='Use the language files built once for the whole lexicon (python -m '
+                             'utils.global_language). Jobs with words missing from them prepare their own and start '
+                             'a build that adds the words in the background.')
+    parser.add_argument('--language-cache', type=str, default='y',
+                        help='Reuse the language files (L.fst and the symbol tables) made for the same vocabulary.')
+    parser.add_argument('--fst-mode', default='fstcompile', choices=['fstcompile', 'python'],
+                        help='Compile L.fst with fstcompile/fstarcsort or write it directly from Python.')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='Number of gmm-align-pipe processes aligning segments in parallel (ant transcriptions and long '
+                             'audio mode, a plain txt recording is a single segment).')
+    parser.add_argument('--long-audio', type=str, default='n',
+                        help='In txt mode, split the recording at pauses and align the pieces separately (needs NumPy).')
+    parser.add_argument('--max-chunk', type=float, default=30.0,
+                        help='Maximum length of the pieces in long audio mode, in seconds.')
+    parser.add_argument('--adaptive-beam', type=str, default='n',
+                        help='Start with a narrow beam and widen it only for the segments that fail, learning the '
+                             'starting beam from previous runs.')
+    parser.add_argument('--beams', type=parse_beams, default=default_beams,
+                        help='Comma-separated beams tried in adaptive beam mode, from the narrowest.')
+    parser.add_argument('--profile', type=Path,
+                        help='Write a JSON report with the time and resources used by each stage to this file.')
+
+    parser.add_argument('--work-dir', type=Path, default=work,
+                        help='Folder in which each job creates its own workspace for the intermediate files.')
+    parser.add_argument('--ram', type=str, default='n',
+                        help='Keep the intermediate files in RAM (on /dev/shm) instead of the work dir.')
+    parser.add_argument('--log-queue', type=str, default='y',
+                        help='Write the log from a background thread in batches.')
+    parser.add_argument('--log-dir', type=Path,
+                        help='With the log queue, write the Kaldi messages of each job to <job>.log in this folder '
+                             'instead of main.log.')
+    parser.add_argument('--log-level', default='debug', choices=['debug', 'info', 'warning', 'error'],
+                        help='Lowest level of Kaldi messages (VLOG, LOG, WARNING, ERROR) written to the log.')
+    parser.add_argument('--log-rate', type=float,
+                        help='Maximum number of Kaldi log lines per second, the rest are dropped (errors are always kept).')
 
     args = parser.parse_args()
 
-    kaldi = KaldiPrograms(args.bin_root)
-
-    work.mkdir(exist_ok=True)
-
-    with wave.open(str(args.audio)) as f:
-        assert f.getframerate() == 16000, 'Wrong audio framerate! '+str(f.getframerate())
-        assert f.getsampwidth() == 2, 'Wrong sample size!'
-        assert f.getnchannels() == 1, 'Only support mono!'
-        samp_num = f.getnframes()
-        audio = f.readframes(samp_num)
-
-    if args.type == 'ant':
-        segments = process_ant_segments(args.trans)
-        wordlist = set()
-        for seg in segments:
-            wordlist.add(seg[0])
-        prepare_language_wordlist(wordlist, None, work, g2p_path,
-                                  g2p_lex_path, '<unk>', kaldi)
-    elif args.type == 'txt':
-        wordlist = set()
-        with open(args.trans,encoding='utf-8') as f:
-            for l in f:
-                for w in l.strip().split():
-                    wordlist.add(w)
-        print(wordlist)
-        prepare_language_wordlist(wordlist, None, work, g2p_path,
-                                  g2p_lex_path, '<unk>', kaldi)
-
-    pipe = AlignPipe(tree, model_file, lda_mat, work / 'L.fst', work /
-                     'words.txt', work / 'phones.txt', work / 'word_boundary.int', work / 'phones' / 'disambig.int')
+    if args.log_queue.lower() in ['y', 'yes', 't', 'true']:
+        start_queue_logging(args.log_dir)
+
+    profiler = Profiler()
+
+    work = create_workspace(args.work_dir, args.ram.lower() in ['y', 'yes', 't', 'true'])
+
+    kaldi = KaldiPrograms(args.bin_root, profiler, job=work.name,
+                          log_level=logging.getLevelName(args.log_level.upper()), log_rate=args.log_rate,
+                          cache_path=bin_cache_path)
+
+    g2p_cache = None
+    if args.g2p_cache.lower() in ['y', 'yes', 't', 'true']:
+        g2p_cache = G2PCache(g2p_cache_path, g2p_path)
+
+    global_lexicon = args.global_lexicon.lower() in ['y', 'yes', 't', 'true']
+
+    language_cache = None
+    if args.language_cache.lower() in ['y', 'yes', 't', 'true'] and not global_lexicon:
+        language_cache = LanguageCache(language_cache_path, g2p_path, g2p_lex_path, phone_set, sil_prob)
+
+    wav = MappedWave(args.audio)
+    assert wav.getframerate() == 16000, 'Wrong audio framerate! '+str(wav.getframerate())
+    assert wav.getsampwidth() == 2, 'Wrong sample size!'
+    assert wav.getnchannels() == 1, 'Only support mono!'
+    audio = wav.data
+
+    with profiler.stage('prepare_language'):
+        phone_cache = PhoneSetCache(phone_set_cache_path, phone_set)
+        if args.type == 'ant':
+            segments = process_ant_segments(args.trans)
+            wordlist = set()
+            for seg in segments:
+                wordlist.add(seg[0])
+        elif args.type == 'txt':
+            wordlist = set()
+            with open(args.trans,encoding='utf-8') as f:
+                for l in f:
+                    for w in l.strip().split():
+                        wordlist.add(w)
+        if global_lexicon:
+            global_language = GlobalLanguage(global_lang_path, g2p_path, g2p_lex_path, '<unk>', kaldi, g2p_cache,
+                                             args.fst_mode, phone_cache)
+            global_language.prepare(wordlist, None, work)
+        else:
+            prepare_language_wordlist(wordlist, None, work, g2p_path,
+                                      g2p_lex_path, '<unk>', kaldi, g2p_cache, args.fst_mode, phone_cache,
+                                      language_cache)
+
+    long_audio = args.long_audio.lower() in ['y', 'yes', 't', 'true']
+    jobs = args.jobs
+    if args.type == 'txt' and not long_audio and jobs > 1:
+        log.info('The recording is aligned as a single segment, starting only one pipe.')
+        jobs = 1
+
+    beam_policy = None
+    with profiler.stage('start_align_pipes'):
+        pipe_args = (tree, model_file, lda_mat, work / 'L.fst', work / 'words.txt', work / 'phones.txt',
+                     work / 'word_boundary.int', work / 'phones' / 'disambig.int')
+        if args.adaptive_beam.lower() in ['y', 'yes', 't', 'true']:
+            beam_policy = BeamPolicy(args.beams, beam_stats_path)
+            pipe = AdaptiveAlignPipePool(jobs, *pipe_args, policy=beam_policy, profiler=profiler)
+        else:
+            pipe = AlignPipePool(jobs, *pipe_args, profiler=profiler)
 
     if args.type == 'ant':
+        requests = []
         for seg in segments:
             start_samp = int(seg[1]*16000.0)*2
             end_samp = start_samp+int(seg[2]*16000.0)*2
             seg_audio = audio[start_samp:end_samp]
             seg_trans = seg[0]
-            seg_w, seg_p = pipe.process_segment(seg_audio, seg_trans)
+            requests.append((seg_audio, seg_trans))
+        for seg_w, seg_p in pipe.process_segments(requests):
             for w, s, l in seg_w:
                 print(f'W {w} {s} {l}')
             for p, s, l in seg_p:
                 print(f'P {p} {s} {l}')
+    elif args.type == 'txt' and long_audio:
+        from utils.long_audio import align_long_audio
+
+        with open(str(args.trans), encoding='utf-8') as f:
+            trans = ' '.join(f.read().split())
+        seg_w, seg_p = align_long_audio(pipe, audio, trans, max_chunk=args.max_chunk)
+        for w, s, l in seg_w:
+            print(f'W {w} {s} {l}')
+        for p, s, l in seg_p:
+            print(f'P {p} {s} {l}')
     elif args.type == 'txt':
         with open(str(args.trans), encoding='utf-8') as f:
             trans = f.readline().strip()
@@ -101,10 +197,26 @@ if __name__ == '__main__':
         for p, s, l in seg_p:
             print(f'P {p} {s} {l}')
 
-    if args.cleanup.lower() in ['y', 'yes', 't', 'true']:
-        for file in work.glob('**/*'):
-            if file.is_file():
-                file.unlink()
-
     kaldi.close()
     pipe.close()
+
+    if beam_policy:
+        beam_policy.log_summary()
+        beam_policy.save()
+        profiler.set_counters('beam_policy', beam_policy.counters())
+
+    if args.cleanup.lower() in ['y', 'yes', 't', 'true']:
+        remove_workspace(work)
+    if g2p_cache:
+        g2p_cache.close()
+    if language_cache:
+        language_cache.close()
+
+    if args.profile:
+        audio_duration = wav.getnframes() / wav.getframerate()
+        profiler.dump(args.profile, audio_duration)
+        profiler.print_summary(audio_duration)
+
+    wav.close()
+
+    stop_queue_logging()
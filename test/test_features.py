@@ -0,0 +1,94 @@
+import wave
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from utils.features import Mfcc, apply_cmvn, compute_features, read_splice_opts, splice_feats, transform_feats
+from utils.kaldi_io import read_ark, read_matrix
+
+test_dir = Path(__file__).parent
+model_dir = test_dir.parent / 'data' / 'model'
+
+# Kaldi computes in float32 with its own FFT, the differences on test.wav are up to ~3.5e-4
+tolerance = 1e-3
+# the stages after the MFCCs only differ in the float rounding
+stage_tolerance = 1e-4
+
+# The reference arks hold the first second of test.wav after each stage of the Kaldi pipeline, i.e.
+# compute-mfcc-feats --dither=0, compute-cmvn-stats + apply-cmvn (per utterance), splice-feats with
+# data/model/splice_opts and transform-feats with data/model/final.mat, each run on the previous output.
+
+
+def read_samples(seconds=None):
+    with wave.open(str(test_dir / 'test.wav')) as w:
+        n = w.getnframes() if seconds is None else int(seconds * w.getframerate())
+        return np.frombuffer(w.readframes(n), dtype=np.int16)
+
+
+def compute_mfcc(samples):
+    key, feats = next(Mfcc(dither=0.0).compute_batched([('test', samples)]))
+    return feats
+
+
+def read_reference(stage):
+    return dict(read_ark(test_dir / f'test_{stage}.ark'))['test']
+
+
+def test_mfcc_matches_reference_ark():
+    ref = read_reference('mfcc')
+    feats = compute_mfcc(read_samples(1.0))
+    assert feats.shape == ref.shape
+    np.testing.assert_allclose(feats, ref, rtol=0, atol=tolerance)
+
+
+def test_apply_cmvn_matches_reference_ark():
+    ref = read_reference('cmvn')
+    feats = apply_cmvn(read_reference('mfcc'))
+    assert feats.shape == ref.shape
+    np.testing.assert_allclose(feats, ref, rtol=0, atol=stage_tolerance)
+
+
+def test_splice_feats_matches_reference_ark():
+    ref = read_reference('splice')
+    feats = splice_feats(read_reference('cmvn'), **read_splice_opts(model_dir / 'splice_opts'))
+    assert feats.shape == ref.shape
+    np.testing.assert_array_equal(feats, ref)
+
+
+def test_transform_feats_matches_reference_ark():
+    ref = read_reference('lda')
+    feats = transform_feats(read_reference('splice'), read_matrix(model_dir / 'final.mat'))
+    assert feats.shape == ref.shape
+    np.testing.assert_allclose(feats, ref, rtol=0, atol=stage_tolerance)
+
+
+def test_compute_features_matches_reference_ark(tmp_path):
+    wav_scp = tmp_path / 'wav.scp'
+    wav_scp.write_text(f'rec {test_dir / "test.wav"}\n', encoding='utf-8')
+    segments = tmp_path / 'segments'
+    segments.write_text('test rec 0.0 1.0\n', encoding='utf-8')
+    output = tmp_path / 'feats.ark'
+    count = compute_features(wav_scp, segments, output, model_dir / 'final.mat', model_dir / 'splice_opts',
+                             dither=0.0)
+    assert count == 1
+
+    ref = read_reference('lda')
+    feats = dict(read_ark(output))['test']
+    assert feats.shape == ref.shape
+    np.testing.assert_allclose(feats, ref, rtol=0, atol=tolerance)
+
+
+def test_mfcc_matches_kaldi_native_fbank():
+    knf = pytest.importorskip('kaldi_native_fbank')
+    samples = read_samples()
+    opts = knf.MfccOptions()
+    opts.frame_opts.dither = 0.0
+    mfcc = knf.OnlineMfcc(opts)
+    mfcc.accept_waveform(16000, samples.astype(np.float32).tolist())
+    mfcc.input_finished()
+    ref = np.array([mfcc.get_frame(i) for i in range(mfcc.num_frames_ready)], dtype=np.float32)
+
+    feats = compute_mfcc(samples)
+    assert feats.shape == ref.shape
+    np.testing.assert_allclose(feats, ref, rtol=0, atol=tolerance)
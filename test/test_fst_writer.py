@@ -0,0 +1,100 @@
+import io
+import shutil
+import struct
+import subprocess
+from collections import Counter
+
+import pytest
+
+from utils.fst_writer import fst_magic, kNotOLabelSorted, kOLabelSorted, write_lexicon_fst
+from utils.make_lexicon_fst import write_fst_with_silence
+
+# (word ID, pronunciation probability, phone IDs), with shared prefixes, a homophone and an empty pronunciation
+lexicon = [(1, 1.0, [5]), (2, 1.0, [5, 9, 7]), (3, 0.5, [5, 9]), (3, 0.5, [6, 9, 7]), (4, 1.0, [6, 9, 7, 12]),
+           (5, 1.0, [8]), (6, 1.0, []), (7, 0.25, [5, 9, 7, 30])]
+sil_prob = 0.5
+sil_phone = 2
+
+
+def float32(x):
+    return struct.unpack('<f', struct.pack('<f', x))[0]
+
+
+def read_fst(path):
+    """Start state, properties, final weights and arcs (ilabel, olabel, weight, nextstate) of each state of a
+    binary VectorFst<StdArc>."""
+    with open(str(path), 'rb') as f:
+        data = f.read()
+    pos = 0
+
+    def unpack(fmt):
+        nonlocal pos
+        values = struct.unpack_from(fmt, data, pos)
+        pos += struct.calcsize(fmt)
+        return values
+
+    assert unpack('<i')[0] == fst_magic
+    for i in range(2):
+        n = unpack('<i')[0]
+        pos += n
+    version, flags, props, start, num_states, num_arcs = unpack('<iiQqqq')
+    finals, arcs = [], []
+    for s in range(num_states):
+        final, n = unpack('<fq')
+        finals.append(final)
+        arcs.append([unpack('<iifi') for i in range(n)])
+    return start, props, finals, arcs
+
+
+def text_fst():
+    """The arcs and final weights of the text fstcompile reads, as float32."""
+    text = io.StringIO()
+    write_fst_with_silence(lexicon, sil_prob, sil_phone, None, file=text, eps=0)
+    arcs, finals = {}, {}
+    for l in text.getvalue().splitlines():
+        tok = l.split()
+        if len(tok) == 2:
+            finals[int(tok[0])] = float32(float(tok[1]))
+        else:
+            src, dest, ilabel, olabel, weight = tok
+            arcs.setdefault(int(src), []).append((int(ilabel), int(olabel), float32(float(weight)), int(dest)))
+    return arcs, finals
+
+
+def test_lexicon_fst_matches_text(tmp_path):
+    write_lexicon_fst(lexicon, sil_prob, sil_phone, None, tmp_path / 'L.fst')
+    start, props, finals, arcs = read_fst(tmp_path / 'L.fst')
+    text_arcs, text_finals = text_fst()
+
+    assert start == 0
+    assert props & kOLabelSorted and not props & kNotOLabelSorted
+    assert len(arcs) == max(text_arcs) + 1
+    for s, state_arcs in enumerate(arcs):
+        assert Counter(state_arcs) == Counter(text_arcs.get(s, []))
+        olabels = [arc[1] for arc in state_arcs]
+        assert olabels == sorted(olabels)
+        assert finals[s] == text_finals.get(s, float('inf'))
+
+
+@pytest.mark.skipif(not all(shutil.which(p) for p in ['fstcompile', 'fstarcsort', 'fstprint']),
+                    reason='needs the OpenFst tools')
+def test_lexicon_fst_matches_fstcompile(tmp_path):
+    text = io.StringIO()
+    write_fst_with_silence(lexicon, sil_prob, sil_phone, None, file=text, eps=0)
+    (tmp_path / 'L.txt').write_text(text.getvalue())
+    subprocess.run(['fstcompile', str(tmp_path / 'L.txt'), str(tmp_path / 'L_unsorted.fst')], check=True)
+    subprocess.run(['fstarcsort', '--sort_type=olabel', str(tmp_path / 'L_unsorted.fst'),
+                    str(tmp_path / 'L_ref.fst')], check=True)
+    write_lexicon_fst(lexicon, sil_prob, sil_phone, None, tmp_path / 'L.fst')
+
+    def printed(name):
+        out = subprocess.run(['fstprint', str(tmp_path / name)], check=True, stdout=subprocess.PIPE).stdout
+        return sorted(out.decode().splitlines())
+
+    def properties(name):
+        out = subprocess.run(['fstinfo', str(tmp_path / name)], check=True, stdout=subprocess.PIPE).stdout
+        return [l for l in out.decode().splitlines() if 'sorted' in l or 'deterministic' in l]
+
+    assert printed('L.fst') == printed('L_ref.fst')
+    if shutil.which('fstinfo'):
+        assert properties('L.fst') == properties('L_ref.fst')
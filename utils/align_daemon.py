@@ -0,0 +1,267 @@
+import io
+import json
+import os
+import socketserver
+import wave
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from queue import Queue, Empty
+from threading import Thread
+from urllib.parse import urlparse, parse_qs
+
+from utils.align_pipe import AlignPipePool, AdaptiveAlignPipePool
+from utils.log import log
+from utils.global_language import special_words
+from utils.prepare_language import prepare_language_wordlist, read_word_ids
+from utils.workspace import create_workspace, remove_workspace
+
+
+class AlignDaemon:
+    """Keeps a pool of gmm-align-pipe processes loaded and aligns the requests put on its queue.
+
+    The pool has the language of a fixed vocabulary: the current build of the global language if there is one,
+    otherwise the words given at startup. The requests with other words are aligned with a language made for the
+    words of those requests alone, on pipes started for them, so they never restart the pool. With the global
+    language, these words are added to it by its next build and the pool moves to each new build."""
+
+    def __init__(self, kaldi, tree, model, lda, g2p_path, g2p_lex_path, work_root, jobs=1, g2p_cache=None,
+                 fst_mode='fstcompile', ram=False, batch_size=16, vocabulary=None, profiler=None, beam_policy=None,
+                 phone_cache=None, language_cache=None, global_language=None):
+        self.kaldi = kaldi
+        self.tree = tree
+        self.model = model
+        self.lda = lda
+        self.g2p_path = g2p_path
+        self.g2p_lex_path = g2p_lex_path
+        self.work_root = work_root
+        self.jobs = jobs
+        self.g2p_cache = g2p_cache
+        self.fst_mode = fst_mode
+        self.ram = ram
+        self.batch_size = batch_size
+        self.profiler = profiler
+        self.beam_policy = beam_policy
+        self.phone_cache = phone_cache
+        self.language_cache = language_cache
+        self.global_language = global_language
+
+        self.vocabulary = set()
+        self.version = None
+        self.work = None
+        self.pool = None
+        if global_language:
+            self.update_pool()
+        elif vocabulary:
+            work = create_workspace(self.work_root, self.ram)
+            self.prepare_language(vocabulary, work)
+            self.replace_pool(work, set(vocabulary))
+
+        self.requests = Queue()
+        self.thread = Thread(target=self.serve_requests, daemon=True)
+        self.thread.start()
+
+    def align(self, audio: bytes, trans: str) -> tuple:
+        return self.submit(audio, trans).result()
+
+    def submit(self, audio: bytes, trans: str) -> Future:
+        future = Future()
+        self.requests.put((audio, trans, future))
+        return future
+
+    def serve_requests(self):
+        stop = False
+        while not stop:
+            req = self.requests.get()
+            if req is None:
+                break
+            # whatever piled up while the last batch was aligned goes through the pool together
+            batch = [req]
+            while len(batch) < self.batch_size:
+                try:
+                    req = self.requests.get_nowait()
+                except Empty:
+                    break
+                if req is None:
+                    stop = True
+                    break
+                batch.append(req)
+            batch = [req for req in batch if req[2].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            if self.global_language:
+                try:
+                    self.update_pool()
+                except Exception:
+                    log.exception('Failed to load the new build of the global language, keeping the old one.')
+
+            known = [req for req in batch if self.pool and set(req[1].split()) <= self.vocabulary]
+            unknown = [req for req in batch if not (self.pool and set(req[1].split()) <= self.vocabulary)]
+            if known:
+                self.run(known, self.pool)
+            if unknown:
+                self.run_separately(unknown)
+
+    def run(self, batch, pool):
+        try:
+            results = pool.process_segments([(audio, trans) for audio, trans, future in batch])
+        except Exception as e:
+            log.exception('Alignment failed.')
+            for audio, trans, future in batch:
+                future.set_exception(e)
+            return
+        for (audio, trans, future), res in zip(batch, results):
+            future.set_result(res)
+
+    def run_separately(self, batch):
+        """Aligns requests with words missing from the language of the pool, with a language made for their words
+        alone, on pipes that are closed afterwards."""
+        words = set()
+        for audio, trans, future in batch:
+            words.update(trans.split())
+        log.info(f'Preparing the language for {len(words)} words of {len(batch)} requests '
+                 f'({len(words - self.vocabulary)} missing from the pool).')
+        work = create_workspace(self.work_root, self.ram)
+        pool = None
+        try:
+            self.prepare_language(words, work)
+            pool = self.create_pool(work, min(self.jobs, len(batch)))
+        except Exception as e:
+            log.exception('Preparing the language failed.')
+            for audio, trans, future in batch:
+                future.set_exception(e)
+        if pool:
+            self.run(batch, pool)
+            pool.close()
+        remove_workspace(work)
+
+    def prepare_language(self, words, work):
+        if self.global_language:
+            # the words missing from the global language are added by its next build
+            self.global_language.prepare(words, None, work)
+        else:
+            prepare_language_wordlist(words, None, work, self.g2p_path, self.g2p_lex_path, '<unk>', self.kaldi,
+                                      self.g2p_cache, self.fst_mode, self.phone_cache, self.language_cache)
+
+    def create_pool(self, work, jobs):
+        pipe_args = (self.tree, self.model, self.lda, work / 'L.fst', work / 'words.txt', work / 'phones.txt',
+                     work / 'word_boundary.int', work / 'phones' / 'disambig.int')
+        if self.beam_policy:
+            return AdaptiveAlignPipePool(jobs, *pipe_args, policy=self.beam_policy, profiler=self.profiler)
+        return AlignPipePool(jobs, *pipe_args, profiler=self.profiler)
+
+    def update_pool(self):
+        """Moves the pool to the current build of the global language, if it changed."""
+        versions = self.global_language.versions()
+        if versions and versions[0] == self.version:
+            return
+        work = create_workspace(self.work_root, self.ram)
+        try:
+            # builds the first version if there is none. A build in the meantime only makes the next batch
+            # load the pool again.
+            self.global_language.prepare([], None, work)
+            version = versions[0] if versions else self.global_language.versions()[0]
+            vocabulary = set(read_word_ids(work / 'words.txt')) - set(special_words + ['<unk>'])
+        except BaseException:
+            remove_workspace(work)
+            raise
+        log.info(f'Loading the global language {version} with {len(vocabulary)} words.')
+        self.replace_pool(work, vocabulary)
+        self.version = version
+
+    def replace_pool(self, work, vocabulary):
+        try:
+            pool = self.create_pool(work, self.jobs)
+        except BaseException:
+            remove_workspace(work)
+            raise
+        old_pool, old_work = self.pool, self.work
+        self.pool, self.work, self.vocabulary = pool, work, vocabulary
+        if old_pool:
+            old_pool.close()
+            remove_workspace(old_work)
+
+    def close(self):
+        self.requests.put(None)
+        self.thread.join()
+        if self.pool:
+            self.pool.close()
+            remove_workspace(self.work)
+
+
+class AlignHandler(BaseHTTPRequestHandler):
+    """POST /align?trans=<transcript> with a 16 kHz, 16-bit mono WAV file as the body returns
+    {"words": [[word, start, length], ...], "phones": [[phone, start, length], ...]}.
+    GET /status returns the size of the vocabulary and of the request queue, and the beam counters in
+    adaptive beam mode."""
+
+    def send_json(self, code, obj):
+        body = json.dumps(obj, ensure_ascii=False).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if urlparse(self.path).path != '/status':
+            self.send_json(404, {'error': 'Not found'})
+            return
+        daemon = self.server.align_daemon
+        status = {'vocabulary': len(daemon.vocabulary), 'queued': daemon.requests.qsize()}
+        if daemon.beam_policy:
+            status['beams'] = daemon.beam_policy.counters()
+        self.send_json(200, status)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/align':
+            self.send_json(404, {'error': 'Not found'})
+            return
+        trans = parse_qs(url.query).get('trans', [''])[0].strip()
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            with wave.open(io.BytesIO(body)) as wav:
+                assert wav.getframerate() == 16000, 'Wrong audio framerate! ' + str(wav.getframerate())
+                assert wav.getsampwidth() == 2, 'Wrong sample size!'
+                assert wav.getnchannels() == 1, 'Only support mono!'
+                audio = wav.readframes(wav.getnframes())
+            assert trans, 'Missing transcription!'
+        except (AssertionError, wave.Error, EOFError) as e:
+            self.send_json(400, {'error': str(e) or 'Not a valid WAV file!'})
+            return
+
+        try:
+            words, phones = self.server.align_daemon.align(audio, trans)
+        except Exception as e:
+            self.send_json(500, {'error': str(e)})
+            return
+        self.send_json(200, {'words': words, 'phones': phones})
+
+    def log_message(self, format, *args):
+        log.info('HTTP: ' + format % args)
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+if hasattr(socketserver, 'UnixStreamServer'):
+    class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+        def get_request(self):
+            # BaseHTTPRequestHandler expects a (host, port) client address
+            request, address = socketserver.UnixStreamServer.get_request(self)
+            return request, ('local', 0)
+
+
+def create_server(daemon, host='127.0.0.1', port=8765, socket_path=None):
+    if socket_path:
+        if os.path.exists(str(socket_path)):
+            os.unlink(str(socket_path))
+        server = UnixHTTPServer(str(socket_path), AlignHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), AlignHandler)
+    server.align_daemon = daemon
+    return server
@@ -1,65 +1,419 @@
-from typing import List
+import asyncio
 import struct
-import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
 from subprocess import Popen, PIPE
+from threading import Condition, Lock, Semaphore, Thread
+import time
+
+from utils.log import log
+from utils.profiler import wait_process
+
+
+def align_pipe_command(tree, model, lda, lex, words, phones, boundaries, disambig, transition_scale=1.0,
+                       acoustic_scale=0.1, self_loop_scale=0.1, beam=20, retry_beam=300, careful=False):
+    return ['gmm-align-pipe', f'--transition-scale={transition_scale}', f'--acoustic-scale={acoustic_scale}',
+            f'--self-loop-scale={acoustic_scale}', f'--beam={beam}', f'--retry-beam={retry_beam}',
+            f'--careful={str(careful).lower()}', f'--phone-symbols={phones}',
+            str(tree), str(model), str(lda), str(lex), str(words),
+            str(boundaries), str(disambig)]
+
+
+def request_header(audio) -> bytes:
+    return struct.pack('<i', int(len(audio)/2))
+
+
+def request_trailer(trans: str) -> bytes:
+    trans = trans.encode('utf-8')
+    return struct.pack('<i', 0) + struct.pack('<i', len(trans)) + trans
+
+
+def parse_header(line: bytes) -> tuple:
+    head_num = line.strip().decode().split()
+    if len(head_num) == 2 and head_num[0] == 'NW':
+        return int(head_num[1]), 0
+    elif len(head_num) == 4 and head_num[0] == 'NW' and head_num[2] == 'NP':
+        return int(head_num[1]), int(head_num[3])
+    else:
+        raise RuntimeError(f'KALDI ENGINE HEADER ERROR: {head_num}')
+
+
+def parse_word(line: bytes) -> tuple:
+    line = line.strip().decode()
+    tok = line.split()
+    assert len(tok) == 4 and tok[0] == 'W', 'KALDI ENGINE WORD LINE ERROR: '+line
+    return tok[1], float(tok[2]), float(tok[3])
+
+
+def parse_phone(line: bytes) -> tuple:
+    line = line.strip().decode()
+    tok = line.split()
+    assert len(
+        tok) == 4 and tok[0] == 'P', 'KALDI ENGINE PHONE LINE ERROR: '+line
+    return tok[1], float(tok[2]), float(tok[3])
 
 
 class AlignPipe:
-    def __init__(self, tree, model, lda, lex, words, phones, boundaries, disambig, transition_scale=1.0,
-                 acoustic_scale=0.1, self_loop_scale=0.1, beam=20, retry_beam=300, careful=False):
-        self.proc = Popen(['gmm-align-pipe', f'--transition-scale={transition_scale}', f'--acoustic-scale={acoustic_scale}',
-                           f'--self-loop-scale={acoustic_scale}', f'--beam={beam}', f'--retry-beam={retry_beam}',
-                           f'--careful={str(careful).lower()}', f'--phone-symbols={phones}', 
-                           str(tree), str(model), str(lda), str(lex), str(words),
-                           str(boundaries), str(disambig)], stdin=PIPE, stdout=PIPE)
+    def __init__(self, *args, window=2, profiler=None, **kwargs):
+        self.profiler = profiler
+        self.started = time.perf_counter()
+        self.proc = Popen(align_pipe_command(*args, **kwargs), stdin=PIPE, stdout=PIPE)
 
         token = self.proc.stdout.readline().strip().decode()
         assert token == 'RDY', 'Token missing error! '+token
 
+        # requests are written by a separate thread, so that a request waiting in the pipe
+        # buffer never stops us from reading the responses of the ones before it
+        self.window = window
+        self.free = Semaphore(window)
+        self.in_flight = 0
+        self.submitted = deque()
+        self.requests = Queue()
+        self.writer = Thread(target=self.write_requests, daemon=True)
+        self.writer.start()
+
+    def write_requests(self):
+        try:
+            for req in iter(self.requests.get, None):
+                for data in req:
+                    self.proc.stdin.write(data)
+                self.proc.stdin.flush()
+        except (OSError, ValueError):
+            # the process was killed
+            pass
+
+    def submit(self, audio: bytes, trans: str):
+        self.free.acquire()
+        self.in_flight += 1
+        self.submitted.append((time.perf_counter(), len(audio) / 32000))
+        self.requests.put((request_header(audio), audio, request_trailer(trans)))
+
+    def collect(self) -> tuple:
+        assert self.in_flight > 0, 'No request was submitted!'
+        try:
+            nw, np = parse_header(self.proc.stdout.readline())
+
+            words = []
+            for i in range(nw):
+                words.append(parse_word(self.proc.stdout.readline()))
+
+            phones = []
+            for i in range(np):
+                phones.append(parse_phone(self.proc.stdout.readline()))
+        finally:
+            self.in_flight -= 1
+            self.free.release()
+            start, audio = self.submitted.popleft()
+            if self.profiler:
+                self.profiler.add({'stage': 'align_segment', 'wall': time.perf_counter() - start,
+                                   'child_cpu': 0.0, 'child_max_rss': 0, 'audio': audio})
+
+        return words, phones
+
+    def process_segment(self, audio: bytes, trans: str) -> tuple:
+        self.submit(audio, trans)
+        return self.collect()
+
+    def process_segments(self, segments):
+        for audio, trans in segments:
+            if self.in_flight >= self.window:
+                yield self.collect()
+            self.submit(audio, trans)
+        while self.in_flight > 0:
+            yield self.collect()
+
+    def close(self):
+
+        self.requests.put((struct.pack('i', 0), struct.pack('i', 0)))
+        self.requests.put(None)
+        self.writer.join()
+        self.proc.stdin.close()
+        self.proc.stdout.close()
+
+        rec = {'stage': 'gmm-align-pipe', 'wall': 0.0, 'child_cpu': 0.0, 'child_max_rss': 0}
+        wait_process(self.proc, self.profiler, rec)
+        if self.profiler:
+            rec['wall'] = time.perf_counter() - self.started
+            self.profiler.add(rec)
+
+    def kill(self):
+        if self.proc is not None and self.proc.returncode is None:
+            try:
+                self.proc.kill()
+            except ProcessLookupError:
+                # exited in the meantime
+                pass
+        self.requests.put(None)
+        self.writer.join()
+        self.proc.wait()
+        self.proc.stdin.close()
+        self.proc.stdout.close()
+
+
+class AlignPipePool:
+    def __init__(self, jobs, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        self.executor = ThreadPoolExecutor(max_workers=jobs)
+        self.pipes = list(self.executor.map(lambda i: AlignPipe(*args, **kwargs), range(jobs)))
+        self.idle = Queue()
+        for pipe in self.pipes:
+            self.idle.put(pipe)
+
     def process_segment(self, audio: bytes, trans: str) -> tuple:
-        self.proc.stdin.write(struct.pack('<i', int(len(audio)/2)))
+        pipe = self.idle.get()
+        try:
+            return pipe.process_segment(audio, trans)
+        except BaseException:
+            pipe = self.restart(pipe)
+            raise
+        finally:
+            self.idle.put(pipe)
+
+    def process_segments(self, segments: list) -> list:
+        results = [None] * len(segments)
+        jobs = iter(enumerate(segments))
+        jobs_lock = Lock()
+
+        def run(i):
+            order = deque()
+
+            def feed():
+                while True:
+                    with jobs_lock:
+                        job = next(jobs, None)
+                    if job is None:
+                        return
+                    order.append(job[0])
+                    yield job[1]
+
+            pipe = self.idle.get()
+            try:
+                for res in pipe.process_segments(feed()):
+                    results[order.popleft()] = res
+            except BaseException:
+                pipe = self.restart(pipe)
+                raise
+            finally:
+                self.idle.put(pipe)
+
+        list(self.executor.map(run, range(len(self.pipes))))
+        return results
+
+    def restart(self, pipe) -> AlignPipe:
+        # a request that failed may leave its response, or the ones after it, unread in the pipe
+        pipe.kill()
+        new_pipe = AlignPipe(*self.args, **self.kwargs)
+        self.pipes[self.pipes.index(pipe)] = new_pipe
+        return new_pipe
+
+    def close(self):
+        self.executor.shutdown()
+        for pipe in self.pipes:
+            pipe.close()
+
+
+class AdaptiveAlignPipePool:
+    """Aligns each segment first with the beam a BeamPolicy chooses and the ones that fail (no words in the result)
+    again with the wider beams. gmm-align-pipe takes its beam on the command line, so each pipe aligns with one
+    beam. There are at most jobs pipes for all the beams together: they are started when a beam needs one, and
+    when all the places are taken, the idle pipe of the beam used longest ago is closed to make place."""
+
+    def __init__(self, jobs, *args, policy, **kwargs):
+        self.jobs = jobs
+        self.args = args
+        self.kwargs = kwargs
+        self.policy = policy
+        self.executor = ThreadPoolExecutor(max_workers=jobs)
+        self.idle = {}
+        self.used = {}
+        self.count = 0
+        self.cond = Condition()
+
+    def acquire(self, k) -> AlignPipe:
+        old = None
+        with self.cond:
+            while True:
+                if self.idle.get(k):
+                    return self.idle[k].pop()
+                if self.count < self.jobs:
+                    self.count += 1
+                    break
+                others = [j for j, pipes in self.idle.items() if pipes]
+                if others:
+                    old = self.idle[min(others, key=lambda j: self.used[j])].pop()
+                    break
+                self.cond.wait()
+        try:
+            if old:
+                old.close()
+            return AlignPipe(*self.args, beam=self.policy.beams[k], retry_beam=0, **self.kwargs)
+        except BaseException:
+            self.discard()
+            raise
+
+    def release(self, k, pipe):
+        with self.cond:
+            self.idle.setdefault(k, []).append(pipe)
+            self.used[k] = time.perf_counter()
+            self.cond.notify()
+
+    def discard(self):
+        with self.cond:
+            self.count -= 1
+            self.cond.notify()
+
+    def process_beam(self, k, segments: list) -> list:
+        results = [None] * len(segments)
+        jobs = iter(enumerate(segments))
+        jobs_lock = Lock()
+
+        def run(i):
+            order = deque()
+
+            def feed():
+                while True:
+                    with jobs_lock:
+                        job = next(jobs, None)
+                    if job is None:
+                        return
+                    order.append(job[0])
+                    yield job[1]
+
+            pipe = self.acquire(k)
+            try:
+                for res in pipe.process_segments(feed()):
+                    results[order.popleft()] = res
+            except BaseException:
+                # a request that failed may leave its response, or the ones after it, unread in the pipe
+                pipe.kill()
+                self.discard()
+                raise
+            self.release(k, pipe)
+
+        list(self.executor.map(run, range(min(self.jobs, len(segments)))))
+        return results
+
+    def process_segment(self, audio: bytes, trans: str) -> tuple:
+        return self.process_segments([(audio, trans)])[0]
+
+    def process_segments(self, segments: list) -> list:
+        results = [([], [])] * len(segments)
+        starts = [self.policy.start_index() for seg in segments]
+        pending = list(range(len(segments)))
+        for k in range(len(self.policy.beams)):
+            batch = [i for i in pending if starts[i] <= k]
+            if not batch:
+                continue
+            for i, res in zip(batch, self.process_beam(k, [segments[i] for i in batch])):
+                if res[0]:
+                    results[i] = res
+                    self.policy.record(starts[i], k)
+            pending = [i for i in pending if not results[i][0]]
+        for i in pending:
+            self.policy.record(starts[i], None)
+        return results
+
+    def close(self):
+        self.executor.shutdown()
+        for pipes in self.idle.values():
+            for pipe in pipes:
+                pipe.close()
+
+
+class AsyncAlignPipe:
+    def __init__(self, *args, **kwargs):
+        self.cmd = align_pipe_command(*args, **kwargs)
+        self.proc = None
+        self.lock = None
+
+    @classmethod
+    async def create(cls, *args, **kwargs):
+        pipe = cls(*args, **kwargs)
+        await pipe.start()
+        return pipe
+
+    async def start(self):
+        self.lock = asyncio.Lock()
+        await self.spawn()
+
+    async def spawn(self):
+        self.proc = await asyncio.create_subprocess_exec(*self.cmd, stdin=PIPE, stdout=PIPE)
+        try:
+            token = (await self.proc.stdout.readline()).strip().decode()
+            assert token == 'RDY', 'Token missing error! '+token
+        except BaseException:
+            self.kill()
+            self.proc = None
+            raise
+
+    async def restart(self):
+        # a request that failed may leave its response, or the ones after it, unread in the pipe
+        self.kill()
+        await self.proc.wait()
+        self.proc = None
+        try:
+            await self.spawn()
+        except Exception:
+            # tried again by the next request
+            log.exception('Could not restart gmm-align-pipe.')
+
+    async def align(self, audio: bytes, trans: str) -> tuple:
+        # A request that was written must have its response read, otherwise the next caller would
+        # get it. The exchange therefore runs as its own task: cancelling the caller leaves the
+        # exchange running to completion and the pipe is released only once it is done.
+        await self.lock.acquire()
+        exchange = asyncio.ensure_future(self.exchange(audio, trans))
+        exchange.add_done_callback(self.exchange_done)
+        return await asyncio.shield(exchange)
+
+    def exchange_done(self, exchange):
+        self.lock.release()
+        if not exchange.cancelled():
+            exchange.exception()
+
+    async def exchange(self, audio: bytes, trans: str) -> tuple:
+        if self.proc is None:
+            # the last restart failed
+            await self.spawn()
+        try:
+            return await self.request(audio, trans)
+        except BaseException:
+            await self.restart()
+            raise
+
+    async def request(self, audio: bytes, trans: str) -> tuple:
+        self.proc.stdin.write(request_header(audio))
         self.proc.stdin.write(audio)
-        self.proc.stdin.write(struct.pack('<i', 0))
-        trans=trans.encode('utf-8')
-        self.proc.stdin.write(struct.pack('<i', len(trans)))
-        self.proc.stdin.write(trans)
-
-        self.proc.stdin.flush()
-
-        print('sent')
-
-        head_num = self.proc.stdout.readline().strip().decode().split()
-        nw = 0
-        np = 0
-        if len(head_num) == 2 and head_num[0] == 'NW':
-            nw = int(head_num[1])
-            np = 0
-        elif len(head_num) == 4 and head_num[0] == 'NW' and head_num[2] == 'NP':
-            nw = int(head_num[1])
-            np = int(head_num[3])
-        else:
-            raise RuntimeError(f'KALDI ENGINE HEADER ERROR: {head_num}')
+        self.proc.stdin.write(request_trailer(trans))
+        await self.proc.stdin.drain()
+
+        nw, np = parse_header(await self.proc.stdout.readline())
 
         words = []
         for i in range(nw):
-            line = self.proc.stdout.readline().strip().decode()
-            tok = line.split()
-            assert len(tok) == 4 and tok[0] == 'W', 'KALDI ENGINE WORD LINE ERROR: '+line
-            words.append((tok[1], float(tok[2]), float(tok[3])))
+            words.append(parse_word(await self.proc.stdout.readline()))
 
         phones = []
         for i in range(np):
-            line = self.proc.stdout.readline().strip().decode()
-            tok = line.split()
-            assert len(
-                tok) == 4 and tok[0] == 'P', 'KALDI ENGINE PHONE LINE ERROR: '+line
-            phones.append((tok[1], float(tok[2]), float(tok[3])))
+            phones.append(parse_phone(await self.proc.stdout.readline()))
 
         return words, phones
 
-    def close(self):
+    async def close(self):
+        async with self.lock:
+            if self.proc is None:
+                return
+            self.proc.stdin.write(struct.pack('i', 0))
+            self.proc.stdin.write(struct.pack('i', 0))
+            self.proc.stdin.close()
+            await self.proc.wait()
 
-        self.proc.stdin.write(struct.pack('i', 0))
-        self.proc.stdin.write(struct.pack('i', 0))
-        self.proc.stdin.close()
-        self.proc.stdout.close()
+    def kill(self):
+        if self.proc is not None and self.proc.returncode is None:
+            try:
+                self.proc.kill()
+            except ProcessLookupError:
+                # exited in the meantime
+                pass
@@ -0,0 +1,153 @@
+import argparse
+import json
+import os
+import tempfile
+from pathlib import Path
+from threading import Lock
+
+from utils.log import log
+
+default_beams = [8, 12, 20, 40, 300]
+
+
+def parse_beams(text):
+    try:
+        beams = sorted(float(b) for b in text.split(','))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Wrong beam schedule: {text}')
+    if not beams or beams[0] <= 0:
+        raise argparse.ArgumentTypeError(f'Wrong beam schedule: {text}')
+    return [int(b) if b == int(b) else b for b in beams]
+
+
+class BeamPolicy:
+    """Chooses the beam each segment is aligned with first. A segment that fails is aligned again with the
+    next beam of the schedule, until the widest one.
+
+    The beam at which each segment passed is counted and the starting beam is the one with the lowest expected
+    cost for the segments seen so far, taking the cost of an attempt as its beam (the decoding time grows about
+    linearly with it). Only the segments that start at the narrowest beam say where they would have passed,
+    so every explore-th segment starts there, whatever the current starting beam is.
+
+    The counts are kept in stats_path between runs."""
+
+    def __init__(self, beams=None, stats_path=None, min_samples=50, explore=10, max_samples=10000):
+        self.beams = list(beams) if beams else list(default_beams)
+        self.stats_path = stats_path
+        self.min_samples = min_samples
+        self.explore = explore
+        self.max_samples = max_samples
+        self.lock = Lock()
+
+        # beam index at which the segments that started at the narrowest beam passed
+        self.passed_from_start = [0] * len(self.beams)
+        self.failed_from_start = 0
+        self.load()
+
+        # counters of this run
+        self.segments = 0
+        self.attempts = [0] * len(self.beams)
+        self.passed = [0] * len(self.beams)
+        self.failed = 0
+
+        self.start = self.tune()
+        log.info(f'Beam schedule {self.beams}, starting at beam {self.beams[self.start]}.')
+
+    def load(self):
+        if not self.stats_path or not Path(self.stats_path).exists():
+            return
+        try:
+            with open(str(self.stats_path), encoding='utf-8') as f:
+                stats = json.load(f)
+        except ValueError:
+            log.warning(f'Ignoring corrupt beam statistics {self.stats_path}')
+            return
+        if stats.get('beams') != self.beams:
+            log.info(f'Beam statistics in {self.stats_path} are for another schedule, starting from scratch.')
+            return
+        self.passed_from_start = stats['passed']
+        self.failed_from_start = stats['failed']
+
+    def save(self):
+        if not self.stats_path:
+            return
+        with self.lock:
+            stats = {'beams': self.beams, 'passed': self.passed_from_start, 'failed': self.failed_from_start}
+        fd, tmp = tempfile.mkstemp(dir=str(Path(self.stats_path).parent), prefix=Path(self.stats_path).name)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(stats, f, indent=2)
+        os.replace(tmp, str(self.stats_path))
+
+    def cost(self, start):
+        """Expected cost of a segment starting at the beam with index start."""
+        total = 0.0
+        for k, n in enumerate(self.passed_from_start):
+            total += n * sum(self.beams[start:max(k, start) + 1])
+        total += self.failed_from_start * sum(self.beams[start:])
+        return total
+
+    def tune(self):
+        if sum(self.passed_from_start) + self.failed_from_start < self.min_samples:
+            return 0
+        return min(range(len(self.beams)), key=self.cost)
+
+    def start_index(self):
+        """Index of the beam a new segment starts at."""
+        with self.lock:
+            self.segments += 1
+            if self.explore and self.segments % self.explore == 0:
+                return 0
+            return self.start
+
+    def record(self, start, passed):
+        """Counts a segment that started at the beam index start and passed at the beam index passed, or
+        failed with all of them if passed is None."""
+        with self.lock:
+            last = passed if passed is not None else len(self.beams) - 1
+            for k in range(start, last + 1):
+                self.attempts[k] += 1
+            if passed is None:
+                self.failed += 1
+            else:
+                self.passed[passed] += 1
+
+            if start != 0:
+                return
+            if passed is None:
+                self.failed_from_start += 1
+            else:
+                self.passed_from_start[passed] += 1
+            # old counts fade out, so that the policy follows changes in the data
+            if sum(self.passed_from_start) + self.failed_from_start > self.max_samples:
+                self.passed_from_start = [n // 2 for n in self.passed_from_start]
+                self.failed_from_start //= 2
+            self.start = self.tune()
+
+    def counters(self):
+        with self.lock:
+            return {'beams': self.beams, 'start_beam': self.beams[self.start], 'segments': self.segments,
+                    'attempts': list(self.attempts), 'passed': list(self.passed), 'failed': self.failed,
+                    # the same estimate of the decoding work as in cost(), for the fixed beam=20, retry-beam=300
+                    'work': sum(a * b for a, b in zip(self.attempts, self.beams)),
+                    'fixed_work': sum(n * (20 if b <= 20 else 320) for b, n in zip(self.beams, self.passed))
+                                  + 320 * self.failed}
+
+    def log_summary(self):
+        c = self.counters()
+        for beam, attempts, passed in zip(c['beams'], c['attempts'], c['passed']):
+            log.info(f'Beam {beam}: {attempts} attempts, {passed} passed')
+        log.info(f'{c["segments"]} segments, {c["failed"]} failed with all beams, next run starts at beam '
+                 f'{c["start_beam"]}, estimated work {c["work"]} (fixed beams: {c["fixed_work"]})')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Shows the beam statistics collected by previous runs.')
+    parser.add_argument('stats', type=Path)
+    parser.add_argument('--beams', default=','.join(str(b) for b in default_beams))
+
+    args = parser.parse_args()
+
+    policy = BeamPolicy(parse_beams(args.beams), args.stats)
+    for k, (beam, n) in enumerate(zip(policy.beams, policy.passed_from_start)):
+        print(f'beam {beam:>6}: {n:>7} passed, expected cost when starting here {policy.cost(k):.0f}')
+    print(f'failed: {policy.failed_from_start}, starting beam: {policy.beams[policy.start]}')
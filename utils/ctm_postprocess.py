@@ -0,0 +1,94 @@
+import argparse
+from pathlib import Path
+
+position_suffixes = ['_B', '_E', '_S', '_I']
+
+
+def read_symbols(path):
+    # id -> symbol, like apply_mapping with flip
+    symbols = {}
+    with open(str(path), encoding='utf-8') as f:
+        for l in f:
+            tok = l.strip().split()
+            assert len(tok) == 2
+            symbols[tok[1]] = tok[0]
+    return symbols
+
+
+def read_custom_phones(path):
+    phone_map = {}
+    with open(str(path), encoding='utf-8') as f:
+        for l in f:
+            tok = l.strip().split()
+            if len(tok) == 1:
+                phone_map[tok[0]] = ''
+            elif len(tok) == 2:
+                phone_map[tok[0]] = tok[1]
+    return phone_map
+
+
+def read_segment_offsets(path):
+    segments = {}
+    with open(str(path), encoding='utf-8') as f:
+        for l in f:
+            tok = l.strip().split()
+            assert len(tok) == 4
+            segments[tok[0]] = (tok[1], float(tok[2]))
+    return segments
+
+
+class CtmPostProcessor:
+    """Turns the integer word and phone CTMs into the final results in one pass over each: maps the IDs to
+    symbols, strips the word-position suffixes of the phones, applies custom_phones.txt and moves the times
+    of segments to the times of their recordings."""
+
+    def __init__(self, words, phones, custom_phones=None, segments=None):
+        self.words = read_symbols(words)
+        phone_map = read_custom_phones(custom_phones) if custom_phones else {}
+        self.phones = {}
+        for id, ph in read_symbols(phones).items():
+            if ph[-2:] in position_suffixes:
+                ph = ph[:-2]
+            self.phones[id] = phone_map.get(ph, ph)
+        self.segments = read_segment_offsets(segments) if segments else None
+
+    def lines(self, ctm, symbols, kind, results):
+        with open(str(ctm), encoding='utf-8') as f:
+            for l in f:
+                tok = l.split()
+                label = symbols[tok[4]]
+                if not label:
+                    # phones mapped to nothing in custom_phones.txt
+                    continue
+                if self.segments:
+                    rec_id, offset = self.segments[tok[0]]
+                    start = f'{round(float(tok[2]) + offset, 2):0.2f}'
+                    length = f'{round(float(tok[3]), 2):0.2f}'
+                else:
+                    rec_id, start, length = tok[0], tok[2], tok[3]
+                results.setdefault(rec_id, []).append(f'{kind}\t{start}\t{length}\t{label}')
+
+    def process(self, word_ctm, phone_ctm):
+        """Results for each recording, the words first and then the phones."""
+        results = {}
+        self.lines(word_ctm, self.words, 'w', results)
+        self.lines(phone_ctm, self.phones, 'p', results)
+        return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Converts integer word and phone CTMs into the final output.')
+    parser.add_argument('words', type=Path)
+    parser.add_argument('phones', type=Path)
+    parser.add_argument('word_ctm', type=Path)
+    parser.add_argument('phone_ctm', type=Path)
+    parser.add_argument('--custom-phones', type=Path)
+    parser.add_argument('--segments', type=Path)
+
+    args = parser.parse_args()
+
+    results = CtmPostProcessor(args.words, args.phones, args.custom_phones, args.segments).process(args.word_ctm,
+                                                                                                    args.phone_ctm)
+    for lines in results.values():
+        for l in lines:
+            print(l)
@@ -0,0 +1,165 @@
+import argparse
+import random
+import time
+import tracemalloc
+from array import array
+from collections import Counter
+
+
+class PhoneCodes(dict):
+    """Gives each phone a character, numbering them in the order they are first seen."""
+
+    def __missing__(self, ph):
+        code = self[ph] = chr(len(self))
+        return code
+
+
+class PronunciationTrie:
+    """The pronunciations of a lexicon sorted in the preorder of their trie. A node of the trie (a distinct
+    pronunciation) has children exactly when the next one in this order starts with it, so the prefixes are found
+    comparing neighbours, without building the prefixes themselves.
+
+    Each pronunciation is a string with a character for each phone (its ID as the code point). Unlike tuples,
+    strings are not tracked by the garbage collector, and they are compared and hashed in C."""
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.count = Counter(keys)
+        nodes = sorted(self.count)
+        self.extended = {a for a, b in zip(nodes, nodes[1:]) if b.startswith(a)}
+
+
+def string_keys(pronunciations):
+    codes = PhoneCodes()
+    return [''.join(map(codes.__getitem__, trans)) for trans in pronunciations]
+
+
+def disambig_symbols(keys, first_sym=1):
+    """The n of the #n disambiguation symbol each pronunciation (a key of PronunciationTrie) needs, 0 for none,
+    and the highest one used. The pronunciations that need one are the same as another or a prefix of another
+    one."""
+    assert first_sym > 0, '#0 is reserved for the word disambiguation symbol'
+    trie = PronunciationTrie(keys)
+
+    symbols = array('i', bytes(4 * len(keys)))
+    max_disambig = first_sym - 1
+    reserved_empty = set()
+    last_sym = {}
+    count, extended = trie.count, trie.extended
+    for i, key in enumerate(keys):
+        # unique and not a prefix of another pronunciation
+        if count[key] == 1 and key not in extended:
+            continue
+        if not key:
+            max_disambig += 1
+            reserved_empty.add(max_disambig)
+            symbols[i] = max_disambig
+        else:
+            curr_sym = last_sym.get(key, first_sym - 1) + 1
+            while curr_sym in reserved_empty:
+                curr_sym += 1
+            if curr_sym > max_disambig:
+                max_disambig = curr_sym
+            last_sym[key] = curr_sym
+            symbols[i] = curr_sym
+    return symbols, max_disambig
+
+
+def add_disambig_symbols(lexicon, first_sym=1) -> int:
+    """Appends the #n disambiguation symbols to the pronunciations of the (word, prob, pronunciation) lexicon.
+    Returns the highest symbol used."""
+    symbols, max_disambig = disambig_symbols(string_keys([trans for w, p, trans in lexicon]), first_sym)
+    for (w, p, trans), n in zip(lexicon, symbols):
+        if n:
+            trans.append(f'#{n}')
+    return max_disambig
+
+
+def add_disambig_symbols_strings(lexicon, first_sym=1) -> int:
+    # the implementation the trie replaced, kept to check the results and compare the speed
+    max_disambig = first_sym - 1
+    reserved_empty = set()
+    last_sym = {}
+
+    count = {}
+    for w, p, trans in lexicon:
+        x = ' '.join(trans)
+        count[x] = count.get(x, 0) + 1
+
+    prefix = set()
+    for w, p, trans in lexicon:
+        t = trans.copy()
+        while len(t) > 0:
+            t.pop()
+            prefix.add(' '.join(t))
+
+    for w, p, trans in lexicon:
+        x = ' '.join(trans)
+        if x not in prefix and count[x] == 1:
+            continue
+        if len(x) == 0:
+            max_disambig += 1
+            reserved_empty.add(max_disambig)
+            trans.append(f'#{max_disambig}')
+        else:
+            curr_sym = last_sym[x] + 1 if x in last_sym else first_sym
+            while curr_sym in reserved_empty:
+                curr_sym += 1
+            if curr_sym > max_disambig:
+                max_disambig = curr_sym
+            last_sym[x] = curr_sym
+            trans.append(f'#{curr_sym}')
+    return max_disambig
+
+
+def synthetic_lexicon(size, seed=0):
+    """A lexicon like the G2P output: several variants of each word, with some shared pronunciations and
+    prefixes."""
+    from utils.prepare_language import nonsilence_phones
+
+    rng = random.Random(seed)
+    lexicon = []
+    while len(lexicon) < size:
+        base = [rng.choice(nonsilence_phones) for i in range(rng.randint(1, 12))]
+        word = f'w{len(lexicon)}'
+        if rng.random() < 0.0001:
+            lexicon.append((word, 1.0, []))
+        for v in range(rng.randint(1, 4)):
+            trans = list(base)
+            if v and rng.random() < 0.5:
+                trans[rng.randrange(len(trans))] = rng.choice(nonsilence_phones)
+            if v and rng.random() < 0.2 and len(trans) > 1:
+                trans.pop()
+            suffixed = [trans[0] + '_S'] if len(trans) == 1 else \
+                [trans[0] + '_B'] + [ph + '_I' for ph in trans[1:-1]] + [trans[-1] + '_E']
+            lexicon.append((word, 1.0, suffixed))
+    return lexicon[:size]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares the trie and the string based assignment of the '
+                                                 'disambiguation symbols on a synthetic lexicon.')
+    parser.add_argument('--size', type=int, default=1000000, help='Number of pronunciations.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--memory', action='store_true',
+                        help='Also measure the peak memory allocated (much slower).')
+
+    args = parser.parse_args()
+
+    results = []
+    for name, method in [('strings', add_disambig_symbols_strings), ('trie', add_disambig_symbols)]:
+        lexicon = synthetic_lexicon(args.size, args.seed)
+        if args.memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        max_disambig = method(lexicon)
+        elapsed = time.perf_counter() - start
+        peak = ''
+        if args.memory:
+            peak = f'  peak {tracemalloc.get_traced_memory()[1] / 2 ** 20:.1f} MB'
+            tracemalloc.stop()
+        print(f'{name:<8} {elapsed:8.3f}s  max disambig #{max_disambig}{peak}')
+        results.append((max_disambig, [trans for w, p, trans in lexicon]))
+        del lexicon
+
+    print('identical' if results[0] == results[1] else 'DIFFERENT')
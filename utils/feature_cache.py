@@ -0,0 +1,142 @@
+import hashlib
+import os
+import sqlite3
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from utils.log import log
+from utils.wav_reader import MappedWave
+
+
+def read_wav_scp(path):
+    recordings = {}
+    with open(str(path), encoding='utf-8') as f:
+        for l in f:
+            tok = l.strip().split(maxsplit=1)
+            if len(tok) == 2:
+                recordings[tok[0]] = tok[1]
+    return recordings
+
+
+def read_segments(path):
+    segments = []
+    with open(str(path), encoding='utf-8') as f:
+        for l in f:
+            tok = l.strip().split()
+            if len(tok) == 4:
+                segments.append((tok[0], tok[1], float(tok[2]), float(tok[3])))
+    return segments
+
+
+class FeatureCache:
+    """Features stored as .npy files, keyed by the hash of the audio, the segment boundaries and the
+    configuration of the front-end that computed them. The least recently used files are removed
+    once the cache grows over max_bytes."""
+
+    def __init__(self, cache_dir, max_bytes=2 * 2 ** 30):
+        self.dir = Path(cache_dir)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.audio_hashes = {}
+
+        self.db = sqlite3.connect(str(self.dir / 'index.db'), timeout=60)
+        self.db.execute('CREATE TABLE IF NOT EXISTS feats (key TEXT PRIMARY KEY, size INTEGER, used REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS feats_used ON feats (used)')
+        self.db.commit()
+
+        self.hits = 0
+        self.misses = 0
+
+    def audio_hash(self, path):
+        path = str(path)
+        if path not in self.audio_hashes:
+            with MappedWave(path) as wav:
+                h = hashlib.sha1(f'{wav.getframerate()}:{wav.getnchannels()}:{wav.getsampwidth()}:'.encode())
+                h.update(wav.data)
+                self.audio_hashes[path] = (h.hexdigest(), wav.getframerate(), wav.getnframes())
+        return self.audio_hashes[path]
+
+    def utterance_keys(self, wav_scp, segments, config, min_segment_length=0.1):
+        """Cache keys of all the utterances in wav_scp/segments, in order. Segments are cut the same way
+        as extract-segments does it."""
+        recordings = read_wav_scp(wav_scp)
+        keys = {}
+        if segments is None:
+            for rec_id, path in recordings.items():
+                audio, rate, length = self.audio_hash(path)
+                keys[rec_id] = self.key(audio, 0, length, config)
+        else:
+            for seg_id, rec_id, start, end in read_segments(segments):
+                if end - start < min_segment_length:
+                    continue
+                audio, rate, length = self.audio_hash(recordings[rec_id])
+                keys[seg_id] = self.key(audio, int(start * rate), min(int(end * rate), length), config)
+        return keys
+
+    @staticmethod
+    def key(audio_hash, start, end, config):
+        return hashlib.sha1(f'{audio_hash}:{start}:{end}:{config}'.encode()).hexdigest()
+
+    @staticmethod
+    def derived(key, kind):
+        # key of something computed from the features stored under key, eg. their CMVN stats
+        return hashlib.sha1(f'{key}:{kind}'.encode()).hexdigest()
+
+    def path(self, key):
+        return self.dir / key[:2] / f'{key}.npy'
+
+    def get(self, keys):
+        found = {}
+        for key in keys:
+            try:
+                found[key] = np.load(str(self.path(key)))
+            except (IOError, ValueError):
+                pass
+        if found:
+            now = time.time()
+            self.db.executemany('UPDATE feats SET used=? WHERE key=?', [(now, k) for k in found])
+            self.db.commit()
+        hits = sum(1 for key in keys if key in found)
+        self.hits += hits
+        self.misses += len(keys) - hits
+        return found
+
+    def put(self, feats):
+        now = time.time()
+        rows = []
+        for key, arr in feats.items():
+            path = self.path(key)
+            path.parent.mkdir(exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=str(path.parent), prefix=key)
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, np.ascontiguousarray(arr))
+            os.replace(tmp, str(path))
+            rows.append((key, path.stat().st_size, now))
+        self.db.executemany('INSERT OR REPLACE INTO feats VALUES (?, ?, ?)', rows)
+        self.db.commit()
+        self.evict()
+
+    def evict(self):
+        total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM feats').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        removed = []
+        for key, size in self.db.execute('SELECT key, size FROM feats ORDER BY used').fetchall():
+            if total <= self.max_bytes:
+                break
+            try:
+                self.path(key).unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed.append((key,))
+        log.info(f'Evicted {len(removed)} entries from the feature cache.')
+        self.db.executemany('DELETE FROM feats WHERE key=?', removed)
+        self.db.commit()
+
+    def close(self):
+        log.info(f'Feature cache: {self.hits} hits, {self.misses} misses.')
+        self.db.close()
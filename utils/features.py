@@ -0,0 +1,255 @@
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+from utils.kaldi_io import ArkWriter, read_ark, read_matrix
+from utils.log import log
+from utils.wav_reader import MappedWave
+
+# Kaldi floors energies at the float epsilon before taking the log
+FLT_EPSILON = float(np.finfo(np.float32).eps)
+
+
+def mel_scale(freq):
+    return 1127.0 * np.log(1.0 + freq / 700.0)
+
+
+def mel_banks(num_bins=23, padded_length=512, samp_freq=16000, low_freq=20.0, high_freq=0.0):
+    num_fft_bins = padded_length // 2
+    nyquist = 0.5 * samp_freq
+    if high_freq <= 0.0:
+        high_freq += nyquist
+    fft_bin_width = samp_freq / padded_length
+    mel_low = mel_scale(low_freq)
+    mel_high = mel_scale(high_freq)
+    mel_delta = (mel_high - mel_low) / (num_bins + 1)
+
+    # the last (Nyquist) bin of the power spectrum is never used, as in Kaldi
+    banks = np.zeros((num_bins, num_fft_bins + 1))
+    mel = mel_scale(fft_bin_width * np.arange(num_fft_bins))
+    for b in range(num_bins):
+        left = mel_low + b * mel_delta
+        center = left + mel_delta
+        right = center + mel_delta
+        up = (mel > left) & (mel <= center)
+        down = (mel > center) & (mel < right)
+        banks[b, :num_fft_bins][up] = (mel[up] - left) / (center - left)
+        banks[b, :num_fft_bins][down] = (right - mel[down]) / (right - center)
+    return banks
+
+
+def dct_matrix(num_ceps, num_bins):
+    k = np.arange(num_ceps)[:, None]
+    n = np.arange(num_bins)[None, :]
+    dct = np.sqrt(2.0 / num_bins) * np.cos(np.pi / num_bins * (n + 0.5) * k)
+    dct[0, :] = np.sqrt(1.0 / num_bins)
+    return dct
+
+
+def lifter_coeffs(num_ceps, cepstral_lifter=22.0):
+    i = np.arange(num_ceps)
+    return 1.0 + 0.5 * cepstral_lifter * np.sin(np.pi * i / cepstral_lifter)
+
+
+def povey_window(length):
+    i = np.arange(length)
+    return np.power(0.5 - 0.5 * np.cos(2 * np.pi * i / (length - 1)), 0.85)
+
+
+class Mfcc:
+    """Vectorized version of compute-mfcc-feats with its default options."""
+
+    def __init__(self, samp_freq=16000, frame_shift=10.0, frame_length=25.0, dither=1.0, preemph_coeff=0.97,
+                 num_mel_bins=23, num_ceps=13, cepstral_lifter=22.0, low_freq=20.0, high_freq=0.0, seed=0):
+        self.samp_freq = samp_freq
+        self.shift = int(samp_freq * 0.001 * frame_shift)
+        self.length = int(samp_freq * 0.001 * frame_length)
+        self.padded_length = 1 << (self.length - 1).bit_length()
+        self.dither = dither
+        self.preemph_coeff = preemph_coeff
+        self.window = povey_window(self.length)
+        self.banks = mel_banks(num_mel_bins, self.padded_length, samp_freq, low_freq, high_freq).T
+        self.dct = (dct_matrix(num_ceps, num_mel_bins) * lifter_coeffs(num_ceps, cepstral_lifter)[:, None]).T
+        self.rng = np.random.RandomState(seed)
+        self.config = f'numpy-mfcc:{samp_freq}:{frame_shift}:{frame_length}:{dither}:{preemph_coeff}:' \
+            f'{num_mel_bins}:{num_ceps}:{cepstral_lifter}:{low_freq}:{high_freq}:{seed}'
+
+    def num_frames(self, num_samples):
+        # snip-edges=true
+        if num_samples < self.length:
+            return 0
+        return 1 + (num_samples - self.length) // self.shift
+
+    def frames(self, samples):
+        num = self.num_frames(len(samples))
+        return np.lib.stride_tricks.as_strided(samples, (num, self.length),
+                                               (samples.strides[0] * self.shift, samples.strides[0]))
+
+    def compute(self, frames):
+        x = frames.astype(np.float64)
+        if self.dither != 0.0:
+            x += self.dither * self.rng.standard_normal(x.shape)
+        x -= x.mean(axis=1, keepdims=True)
+        # raw energy, i.e. before pre-emphasis and windowing
+        log_energy = np.log(np.maximum((x * x).sum(axis=1), FLT_EPSILON))
+        x[:, 1:] -= self.preemph_coeff * x[:, :-1].copy()
+        x[:, 0] -= self.preemph_coeff * x[:, 0]
+        x *= self.window
+        spec = np.fft.rfft(x, n=self.padded_length)
+        power = spec.real ** 2 + spec.imag ** 2
+        mel = np.log(np.maximum(power.dot(self.banks), FLT_EPSILON))
+        ceps = mel.dot(self.dct)
+        ceps[:, 0] = log_energy
+        return ceps.astype(np.float32)
+
+    def compute_batched(self, utterances, batch_frames=20000):
+        """Computes MFCCs for (key, samples) pairs, running the frames of many utterances at once."""
+        keys = []
+        frames = []
+        total = 0
+        for key, samples in utterances:
+            f = self.frames(samples)
+            if len(f) == 0:
+                log.warning(f'No frames in {key}, skipping it.')
+                continue
+            keys.append(key)
+            frames.append(f)
+            total += len(f)
+            if total >= batch_frames:
+                yield from self.split(keys, frames)
+                keys, frames, total = [], [], 0
+        if keys:
+            yield from self.split(keys, frames)
+
+    def split(self, keys, frames):
+        ceps = self.compute(np.concatenate(frames))
+        ends = np.cumsum([len(f) for f in frames])
+        for key, feats in zip(keys, np.split(ceps, ends[:-1])):
+            yield key, feats
+
+
+def apply_cmvn(feats):
+    # per-utterance stats with apply-cmvn's defaults: means only
+    return (feats - feats.mean(axis=0, dtype=np.float64)).astype(np.float32)
+
+
+def splice_feats(feats, left_context=3, right_context=3):
+    idx = np.arange(len(feats))[:, None] + np.arange(-left_context, right_context + 1)[None, :]
+    idx = np.clip(idx, 0, len(feats) - 1)
+    return feats[idx].reshape(len(feats), -1)
+
+
+def transform_feats(feats, mat):
+    dim = feats.shape[1]
+    if mat.shape[1] == dim:
+        return feats.dot(mat.T).astype(np.float32)
+    assert mat.shape[1] == dim + 1, f'Transform with {mat.shape[1]} columns does not match features of dim {dim}'
+    return (feats.dot(mat[:, :dim].T) + mat[:, dim]).astype(np.float32)
+
+
+def read_splice_opts(path):
+    opts = {'left_context': 4, 'right_context': 4}
+    with open(str(path), encoding='utf-8') as f:
+        for tok in f.read().split():
+            name, value = tok.lstrip('-').split('=')
+            opts[name.replace('-', '_')] = int(value)
+    return opts
+
+
+def read_utterances(wav_scp, segments=None, min_segment_length=0.1):
+    """Yields (key, int16 samples) for each utterance, cutting the segments like extract-segments does."""
+    recordings = {}
+    with open(str(wav_scp), encoding='utf-8') as f:
+        for l in f:
+            tok = l.strip().split(maxsplit=1)
+            if len(tok) == 2:
+                recordings[tok[0]] = tok[1]
+
+    waves = {}
+    try:
+        for rec_id, path in recordings.items():
+            wav = MappedWave(path)
+            assert wav.getsampwidth() == 2, f'Only 16-bit audio is supported: {path}'
+            waves[rec_id] = wav
+
+        def samples(wav):
+            s = np.frombuffer(wav.data, dtype=np.int16)
+            return s[::wav.getnchannels()]
+
+        if segments is None:
+            for rec_id, wav in waves.items():
+                yield rec_id, samples(wav)
+            return
+
+        with open(str(segments), encoding='utf-8') as f:
+            for l in f:
+                tok = l.strip().split()
+                if len(tok) != 4:
+                    continue
+                seg_id, rec_id, start, end = tok[0], tok[1], float(tok[2]), float(tok[3])
+                wav = waves[rec_id]
+                if end - start < min_segment_length:
+                    log.warning(f'Segment {seg_id} is shorter than {min_segment_length}s, skipping it.')
+                    continue
+                s = samples(wav)
+                yield seg_id, s[int(start * wav.getframerate()):int(end * wav.getframerate())]
+    finally:
+        for wav in waves.values():
+            wav.close()
+
+
+def compute_features(wav_scp, segments, output_ark, transform, splice_opts, dither=1.0, seed=0,
+                     batch_frames=20000, output_scp=None, cache=None):
+    """Does the work of compute-mfcc-feats, compute-cmvn-stats, apply-cmvn, splice-feats and transform-feats
+    and writes the final features to output_ark. With a FeatureCache, only the MFCCs of the utterances
+    missing from it are computed."""
+    mat = read_matrix(transform)
+    splice = read_splice_opts(splice_opts)
+    mfcc = Mfcc(dither=dither, seed=seed)
+    if cache:
+        keys = cache.utterance_keys(wav_scp, segments, mfcc.config)
+        cached = cache.get(list(keys.values()))
+        missing = ((utt, s) for utt, s in read_utterances(wav_scp, segments) if keys.get(utt) not in cached)
+        computed = dict(mfcc.compute_batched(missing, batch_frames))
+        cache.put({keys[utt]: feats for utt, feats in computed.items()})
+        mfccs = ((utt, cached[key] if key in cached else computed[utt]) for utt, key in keys.items()
+                 if key in cached or utt in computed)
+    else:
+        mfccs = mfcc.compute_batched(read_utterances(wav_scp, segments), batch_frames)
+    count = 0
+    with ArkWriter(output_ark, output_scp) as ark:
+        for key, feats in mfccs:
+            ark.write(key, transform_feats(splice_feats(apply_cmvn(feats), **splice), mat))
+            count += 1
+    log.info(f'Computed features for {count} utterances.')
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Computes LDA features in-process, like the Kaldi feature pipeline.')
+    parser.add_argument('wav_scp', type=Path)
+    parser.add_argument('output', type=Path, help='Output ark.')
+    parser.add_argument('--segments', type=Path)
+    parser.add_argument('--transform', type=Path, default=Path('data/model/final.mat'))
+    parser.add_argument('--splice-opts', type=Path, default=Path('data/model/splice_opts'))
+    parser.add_argument('--dither', type=float, default=1.0)
+    parser.add_argument('--mfcc-only', type=str, default='n',
+                        help='Write raw MFCCs, eg. to compare them with the output of compute-mfcc-feats.')
+    parser.add_argument('--compare', type=Path, help='Reference ark to compare the output with.')
+
+    args = parser.parse_args()
+
+    if args.mfcc_only.lower() in ['y', 'yes', 't', 'true']:
+        with ArkWriter(args.output) as ark:
+            for key, feats in Mfcc(dither=args.dither).compute_batched(read_utterances(args.wav_scp, args.segments)):
+                ark.write(key, feats)
+    else:
+        compute_features(args.wav_scp, args.segments, args.output, args.transform, args.splice_opts, args.dither)
+
+    if args.compare:
+        ours = dict(read_ark(args.output))
+        for key, ref in read_ark(args.compare):
+            assert key in ours, f'Missing {key}'
+            assert ours[key].shape == ref.shape, f'Shape mismatch for {key}: {ours[key].shape} vs {ref.shape}'
+            print(f'{key} max abs diff {np.abs(ours[key] - ref).max():.6f}')
@@ -0,0 +1,269 @@
+import math
+import struct
+from operator import itemgetter
+
+# Writes L.fst as a binary OpenFst VectorFst<StdArc> equivalent to what
+# "fstcompile | fstarcsort --sort_type=olabel" produces for the text written by
+# make_lexicon_fst.write_fst_with_silence: the same states, arcs and final weights,
+# with the arcs of each state sorted on their output labels. The stored property
+# bits are replayed the way OpenFst (1.6 series) updates them while compiling.
+# Arcs with the same output label keep the order they were added in, which may
+# differ from the (unspecified) order fstarcsort leaves them in.
+
+fst_magic = 2125659606
+fst_version = 2
+
+kExpanded = 0x1
+kMutable = 0x2
+kError = 0x4
+kAcceptor = 0x10000
+kNotAcceptor = 0x20000
+kIDeterministic = 0x40000
+kNonIDeterministic = 0x80000
+kODeterministic = 0x100000
+kNonODeterministic = 0x200000
+kEpsilons = 0x400000
+kNoEpsilons = 0x800000
+kIEpsilons = 0x1000000
+kNoIEpsilons = 0x2000000
+kOEpsilons = 0x4000000
+kNoOEpsilons = 0x8000000
+kILabelSorted = 0x10000000
+kNotILabelSorted = 0x20000000
+kOLabelSorted = 0x40000000
+kNotOLabelSorted = 0x80000000
+kWeighted = 0x100000000
+kUnweighted = 0x200000000
+kCyclic = 0x400000000
+kAcyclic = 0x800000000
+kInitialCyclic = 0x1000000000
+kInitialAcyclic = 0x2000000000
+kTopSorted = 0x4000000000
+kNotTopSorted = 0x8000000000
+kAccessible = 0x10000000000
+kNotAccessible = 0x20000000000
+kCoAccessible = 0x40000000000
+kNotCoAccessible = 0x80000000000
+kString = 0x100000000000
+kNotString = 0x200000000000
+kWeightedCycles = 0x400000000000
+kUnweightedCycles = 0x800000000000
+
+kStaticProperties = kExpanded | kMutable
+
+kNullProperties = kAcceptor | kIDeterministic | kODeterministic | kNoEpsilons | kNoIEpsilons | kNoOEpsilons | \
+                  kILabelSorted | kOLabelSorted | kUnweighted | kAcyclic | kInitialAcyclic | kTopSorted | \
+                  kAccessible | kCoAccessible | kString | kUnweightedCycles
+
+kCommonProperties = kExpanded | kMutable | kError | kAcceptor | kNotAcceptor | kIDeterministic | \
+                    kNonIDeterministic | kODeterministic | kNonODeterministic | kEpsilons | kNoEpsilons | \
+                    kIEpsilons | kNoIEpsilons | kOEpsilons | kNoOEpsilons | kILabelSorted | kNotILabelSorted | \
+                    kOLabelSorted | kNotOLabelSorted
+
+kSetStartProperties = kCommonProperties | kWeighted | kUnweighted | kCyclic | kAcyclic | kTopSorted | \
+                      kNotTopSorted | kCoAccessible | kNotCoAccessible | kWeightedCycles | kUnweightedCycles
+
+kSetFinalProperties = kCommonProperties | kCyclic | kAcyclic | kInitialCyclic | kInitialAcyclic | kTopSorted | \
+                      kNotTopSorted | kAccessible | kNotAccessible | kWeightedCycles | kUnweightedCycles
+
+kAddStateProperties = kCommonProperties | kWeighted | kUnweighted | kCyclic | kAcyclic | kInitialCyclic | \
+                      kInitialAcyclic | kTopSorted | kNotTopSorted | kNotAccessible | kNotCoAccessible | \
+                      kNotString | kWeightedCycles | kUnweightedCycles
+
+kAddArcProperties = kExpanded | kMutable | kError | kNotAcceptor | kNonIDeterministic | kNonODeterministic | \
+                    kEpsilons | kIEpsilons | kOEpsilons | kNotILabelSorted | kNotOLabelSorted | kWeighted | \
+                    kCyclic | kInitialCyclic | kNotTopSorted | kNotAccessible | kNotCoAccessible | kWeightedCycles
+
+kArcSortProperties = kAcceptor | kNotAcceptor | kIDeterministic | kNonIDeterministic | kODeterministic | \
+                     kNonODeterministic | kEpsilons | kNoEpsilons | kIEpsilons | kNoIEpsilons | kOEpsilons | \
+                     kNoOEpsilons | kWeighted | kUnweighted | kCyclic | kAcyclic | kInitialCyclic | \
+                     kInitialAcyclic | kTopSorted | kNotTopSorted | kAccessible | kNotAccessible | kCoAccessible | \
+                     kNotCoAccessible | kString | kNotString | kWeightedCycles | kUnweightedCycles
+
+kCopyProperties = kError | 0x0000ffffffff0000
+
+weight_one = 0.0
+weight_zero = math.inf
+
+ILABEL = 0
+OLABEL = 1
+WEIGHT = 2
+NEXTSTATE = 3
+
+
+def read_symbol_table(path):
+    symbols = {}
+    with open(str(path), encoding='utf-8') as f:
+        for l in f:
+            tok = l.strip().split()
+            if len(tok) == 2:
+                symbols[tok[0]] = int(tok[1])
+    return symbols
+
+
+def set_properties(props, newprops):
+    return (props & kError) | newprops
+
+
+def add_state_properties(props):
+    return props & kAddStateProperties
+
+
+def set_start_properties(props):
+    outprops = props & kSetStartProperties
+    if props & kAcyclic:
+        outprops |= kInitialAcyclic
+    return outprops
+
+
+def set_final_properties(props, old_weight, new_weight):
+    outprops = props
+    if old_weight != weight_zero and old_weight != weight_one:
+        outprops &= ~kWeighted
+    if new_weight != weight_zero and new_weight != weight_one:
+        outprops |= kWeighted
+        outprops &= ~kUnweighted
+    return outprops & (kSetFinalProperties | kWeighted | kUnweighted)
+
+
+def add_arc_properties(props, s, arc, prev_arc):
+    outprops = props
+    if arc[ILABEL] != arc[OLABEL]:
+        outprops |= kNotAcceptor
+        outprops &= ~kAcceptor
+    if arc[ILABEL] == 0:
+        outprops |= kIEpsilons
+        outprops &= ~kNoIEpsilons
+        if arc[OLABEL] == 0:
+            outprops |= kEpsilons
+            outprops &= ~kNoEpsilons
+    if arc[OLABEL] == 0:
+        outprops |= kOEpsilons
+        outprops &= ~kNoOEpsilons
+    if prev_arc is not None:
+        if prev_arc[ILABEL] > arc[ILABEL]:
+            outprops |= kNotILabelSorted
+            outprops &= ~kILabelSorted
+        if prev_arc[OLABEL] > arc[OLABEL]:
+            outprops |= kNotOLabelSorted
+            outprops &= ~kOLabelSorted
+    if arc[WEIGHT] != weight_zero and arc[WEIGHT] != weight_one:
+        outprops |= kWeighted
+        outprops &= ~kUnweighted
+    if arc[NEXTSTATE] <= s:
+        outprops |= kNotTopSorted
+        outprops &= ~kTopSorted
+    outprops &= kAddArcProperties | kAcceptor | kNoEpsilons | kNoIEpsilons | kNoOEpsilons | kILabelSorted | \
+                kOLabelSorted | kUnweighted | kTopSorted
+    if outprops & kTopSorted:
+        outprops |= kAcyclic | kInitialAcyclic
+    return outprops
+
+
+class CompiledFst:
+    """Mirrors the calls fstcompile makes while reading the text FST, one line at a time."""
+
+    def __init__(self):
+        self.start = -1
+        self.final = []
+        self.arcs = []
+        self.props = kNullProperties | kStaticProperties
+
+    def add_state(self):
+        self.final.append(weight_zero)
+        self.arcs.append([])
+        self.props = set_properties(self.props, add_state_properties(self.props))
+
+    def set_start(self, s):
+        self.start = s
+        self.props = set_properties(self.props, set_start_properties(self.props))
+
+    def set_final(self, s, weight):
+        self.props = set_properties(self.props, set_final_properties(self.props, self.final[s], weight))
+        self.final[s] = weight
+
+    def add_arc(self, s, arc):
+        arcs = self.arcs[s]
+        arcs.append(arc)
+        self.props = set_properties(self.props, add_arc_properties(self.props, s, arc,
+                                                                   arcs[-2] if len(arcs) > 1 else None))
+
+    def line(self, src, arc=None, final=None):
+        while src >= len(self.arcs):
+            self.add_state()
+        if self.start < 0:
+            self.set_start(src)
+        dest = src
+        if arc:
+            dest = arc[NEXTSTATE]
+            self.add_arc(src, arc)
+        else:
+            self.set_final(src, final)
+        while dest >= len(self.arcs):
+            self.add_state()
+
+    def arcsort(self):
+        olabel = itemgetter(OLABEL)
+        for arcs in self.arcs:
+            arcs.sort(key=olabel)
+        props = self.props & kArcSortProperties | kOLabelSorted
+        if self.props & kAcceptor:
+            props |= kILabelSorted
+        self.props = props
+
+    def write(self, path):
+        with open(str(path), 'wb') as f:
+            f.write(struct.pack('<i', fst_magic))
+            for s in [b'vector', b'standard']:
+                f.write(struct.pack('<i', len(s)))
+                f.write(s)
+            f.write(struct.pack('<iiQqqq', fst_version, 0, self.props & kCopyProperties | kStaticProperties,
+                                self.start, len(self.arcs), 0))
+            for final, arcs in zip(self.final, self.arcs):
+                f.write(struct.pack('<fq', final, len(arcs)))
+                for arc in arcs:
+                    f.write(struct.pack('<iifi', *arc))
+
+
+def write_lexicon_fst(lexicon, sil_prob, sil_phone, sil_disambig, output_fst):
+    """Integer-label counterpart of write_fst_with_silence: 'lexicon' holds (word-id, pron-prob, [phone-ids])
+    tuples and the result is written to 'output_fst' already sorted on output labels."""
+
+    assert sil_prob > 0.0 and sil_prob < 1.0
+    sil_cost = -math.log(sil_prob)
+    no_sil_cost = -math.log(1.0 - sil_prob)
+
+    start_state = 0
+    loop_state = 1
+    sil_state = 2
+    next_state = 3
+
+    fst = CompiledFst()
+    fst.line(start_state, (0, 0, no_sil_cost, loop_state))
+    fst.line(start_state, (0, 0, sil_cost, sil_state))
+    if sil_disambig is None:
+        fst.line(sil_state, (sil_phone, 0, 0.0, loop_state))
+    else:
+        sil_disambig_state = next_state
+        next_state += 1
+        fst.line(sil_state, (sil_phone, 0, 0.0, sil_disambig_state))
+        fst.line(sil_disambig_state, (sil_disambig, 0, 0.0, loop_state))
+
+    for (word, pronprob, pron) in lexicon:
+        pron_cost = -math.log(pronprob)
+        cur_state = loop_state
+        for i in range(len(pron) - 1):
+            fst.line(cur_state, (pron[i], word if i == 0 else 0, pron_cost if i == 0 else 0.0, next_state))
+            cur_state = next_state
+            next_state += 1
+
+        i = len(pron) - 1
+        phone = pron[i] if i >= 0 else 0
+        word = word if i <= 0 else 0
+        fst.line(cur_state, (phone, word, no_sil_cost + (pron_cost if i <= 0 else 0.0), loop_state))
+        fst.line(cur_state, (phone, word, sil_cost + (pron_cost if i <= 0 else 0.0), sil_state))
+
+    fst.line(loop_state, final=0.0)
+
+    fst.arcsort()
+    fst.write(output_fst)
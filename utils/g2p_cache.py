@@ -0,0 +1,77 @@
+import hashlib
+import sqlite3
+import time
+from pathlib import Path
+
+from utils.log import log
+
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(str(path), 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class G2PCache:
+
+    def __init__(self, cache_path, g2p_path, pmass=0.8, nbest=10, max_entries=1000000):
+        self.path = Path(cache_path)
+        self.max_entries = max_entries
+        # phonetisaurus is run with these settings for the words the cache is missing
+        self.pmass = pmass
+        self.nbest = nbest
+        self.model = f'{file_hash(g2p_path)}:{pmass}:{nbest}'
+
+        Path(cache_path).parent.mkdir(parents=True, exist_ok=True)
+        # the daemon opens the cache in the main thread and looks up the words in its worker thread
+        self.db = sqlite3.connect(str(cache_path), timeout=60, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS prons (word TEXT, model TEXT, prons TEXT, used REAL, '
+                        'PRIMARY KEY (word, model))')
+        self.db.execute('CREATE INDEX IF NOT EXISTS prons_used ON prons (used)')
+        self.db.commit()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, words):
+        found = {}
+        words = list(words)
+        for i in range(0, len(words), 500):
+            chunk = words[i:i + 500]
+            rows = self.db.execute(f'SELECT word, prons FROM prons WHERE model=? AND word IN '
+                                   f'({",".join("?" * len(chunk))})', [self.model] + chunk).fetchall()
+            for w, prons in rows:
+                found[w] = [p.split() for p in prons.split('\n')]
+        if found:
+            now = time.time()
+            self.db.executemany('UPDATE prons SET used=? WHERE word=? AND model=?',
+                                [(now, w, self.model) for w in found])
+            self.db.commit()
+        self.hits += len(found)
+        self.misses += len(words) - len(found)
+        return found
+
+    def words(self):
+        return [w for w, in self.db.execute('SELECT word FROM prons WHERE model=?', (self.model,))]
+
+    def put(self, lexicon):
+        now = time.time()
+        self.db.executemany('INSERT OR REPLACE INTO prons VALUES (?, ?, ?, ?)',
+                            [(w, self.model, '\n'.join(' '.join(p) for p in prons), now)
+                             for w, prons in lexicon.items()])
+        self.db.commit()
+        self.evict()
+
+    def evict(self):
+        size = self.db.execute('SELECT COUNT(*) FROM prons').fetchone()[0]
+        if size > self.max_entries:
+            log.info(f'Evicting {size - self.max_entries} entries from the G2P cache.')
+            self.db.execute('DELETE FROM prons WHERE rowid IN (SELECT rowid FROM prons ORDER BY used LIMIT ?)',
+                            (size - self.max_entries,))
+            self.db.commit()
+
+    def close(self):
+        log.info(f'G2P cache: {self.hits} hits, {self.misses} misses.')
+        self.db.close()
@@ -0,0 +1,292 @@
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from contextlib import ExitStack, contextmanager
+from pathlib import Path
+from threading import Thread
+
+from utils.kaldi_programs import KaldiPrograms
+from utils.language_cache import language_files
+from utils.lexicon_index import LexiconIndex
+from utils.log import log
+from utils.phone_set_cache import link_or_copy
+from utils.prepare_language import prepare_language_wordlist, read_word_ids, write_transcription
+
+# the symbols of words.txt that are not words of the vocabulary
+special_words = ['<eps>', '#0', '<s>', '</s>']
+
+
+@contextmanager
+def file_lock(path, blocking=True):
+    """Exclusive lock between processes, held while the block runs. Without blocking, the block gets False
+    instead of waiting when another process holds the lock."""
+    with open(str(path), 'a+b') as f:
+        if sys.platform == 'win32':
+            import msvcrt
+
+            f.seek(0)
+            while True:
+                try:
+                    # retries for 10 seconds before it fails
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+                    break
+                except OSError:
+                    if not blocking:
+                        yield False
+                        return
+            try:
+                yield True
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def read_lexicon(path, lexicon=None) -> dict:
+    """Adds the pronunciations of a 'word phone phone ...' file to lexicon, skipping the ones it already has."""
+    if lexicon is None:
+        lexicon = {}
+    with open(str(path), encoding='utf-8') as f:
+        for l in f:
+            tok = l.split()
+            if not tok:
+                continue
+            prons = lexicon.setdefault(tok[0], [])
+            if tok[1:] not in prons:
+                prons.append(tok[1:])
+    return lexicon
+
+
+def write_lexicon(f, lexicon):
+    for w in sorted(lexicon):
+        for pron in lexicon[w]:
+            f.write(' '.join([w] + list(pron)) + '\n')
+
+
+class GlobalLanguage:
+    """Language files for all the words of the lexicon and of the G2P cache, built once and shared by the jobs.
+    gmm-align compiles the graph of each utterance from its transcript, so the words L.fst has in excess do not
+    change the alignments, and a job only links the files into its workspace and writes its trans.int.
+
+    Each build is a folder of root, which also keeps the pronunciations of the words that are not in the lexicon
+    in g2p_lexicon.txt, so that they never go through the G2P again. The file named current holds the name of the
+    newest build and of the one before, which is kept for the jobs that may still be linking its files.
+
+    A job with words missing from the language prepares its own language, as without the global one, and adds
+    the words with their pronunciations to pending.txt. It then starts a build of the pending words in the
+    background (python -m utils.global_language --pending-only, or a thread of the job in a frozen build), which
+    outlives the job. The builds take a lock, so only one runs at a time, and only one more waits for it: the
+    words added in the meantime are all taken by the waiting one.
+
+    The first job builds the language if there is none, which takes long for a big lexicon. Operators can build
+    it beforehand, and again after the lexicon or the G2P model changed:
+
+        python -m utils.global_language data/global_lang --g2p-cache data/g2p/g2p_cache.db
+
+    A build that fails leaves its pending words for the next one."""
+
+    def __init__(self, root, g2p_path, g2p_lex_path, oov, kaldi, g2p_cache=None, fst_mode='fstcompile',
+                 phone_cache=None, auto_build=True):
+        self.root = Path(root)
+        self.g2p_path = g2p_path
+        self.g2p_lex_path = g2p_lex_path
+        self.oov = oov
+        self.kaldi = kaldi
+        self.g2p_cache = g2p_cache
+        self.fst_mode = fst_mode
+        self.phone_cache = phone_cache
+        self.auto_build = auto_build
+
+    def versions(self) -> list:
+        pointer = self.root / 'current'
+        if not pointer.exists():
+            return []
+        with open(str(pointer), encoding='utf-8') as f:
+            return f.read().split()
+
+    def current(self):
+        versions = self.versions()
+        return self.root / versions[0] if versions else None
+
+    def build(self, force=True, pending_only=False):
+        """Builds a new version with the words of the lexicon, of the G2P cache, of the current version and the
+        pending ones, and makes it the current one. Without force, only if there is no current version. With
+        pending_only, only if there are pending words, and not at all if another build is already waiting for
+        the lock."""
+        self.root.mkdir(parents=True, exist_ok=True)
+        with ExitStack() as stack:
+            if not stack.enter_context(file_lock(self.root / 'lock', blocking=not pending_only)):
+                # one build waits for the running one, the words added in the meantime are all taken by it
+                with file_lock(self.root / 'queue.lock', blocking=False) as queued:
+                    if not queued:
+                        log.info('Another build of the global language is waiting, leaving the pending words to it.')
+                        return None
+                    stack.enter_context(file_lock(self.root / 'lock'))
+            return self.build_locked(force, pending_only)
+
+    def build_locked(self, force, pending_only):
+        versions = self.versions()
+        if versions and not force:
+            return self.root / versions[0]
+
+        pending = self.take_pending()
+        if pending_only and not pending:
+            return self.root / versions[0] if versions else None
+
+        pronunciations = {}
+        if versions:
+            read_lexicon(self.root / versions[0] / 'g2p_lexicon.txt', pronunciations)
+        for path in pending:
+            read_lexicon(path, pronunciations)
+
+        vocabulary = set(pronunciations)
+        lex_index = LexiconIndex(self.g2p_lex_path)
+        vocabulary.update(lex_index.words())
+        lex_index.close()
+        if self.g2p_cache:
+            vocabulary.update(self.g2p_cache.words())
+        vocabulary.difference_update(special_words + [self.oov])
+
+        log.info(f'Building the global language for {len(vocabulary)} words in {self.root}.')
+        path = Path(tempfile.mkdtemp(dir=str(self.root), prefix='lang-'))
+        try:
+            post_lexicon = prepare_language_wordlist(vocabulary, None, path, self.g2p_path, self.g2p_lex_path,
+                                                     self.oov, self.kaldi, self.g2p_cache, self.fst_mode,
+                                                     self.phone_cache, pronunciations=pronunciations)
+            with open(str(path / 'g2p_lexicon.txt'), 'w', encoding='utf-8') as f:
+                write_lexicon(f, post_lexicon)
+        except BaseException:
+            shutil.rmtree(str(path), ignore_errors=True)
+            raise
+
+        fd, tmp = tempfile.mkstemp(dir=str(self.root), prefix='current')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(f'{path.name}\n')
+            if versions:
+                f.write(f'{versions[0]}\n')
+        os.replace(tmp, str(self.root / 'current'))
+        for name in versions[1:]:
+            shutil.rmtree(str(self.root / name), ignore_errors=True)
+        for p in pending:
+            p.unlink()
+        return path
+
+    def take_pending(self) -> list:
+        """Moves pending.txt aside, so that the jobs can add words while the build runs. Returns the files moved
+        aside, also by the builds that failed."""
+        with file_lock(self.root / 'pending.lock'):
+            pending = self.root / 'pending.txt'
+            if pending.exists():
+                fd, tmp = tempfile.mkstemp(dir=str(self.root), prefix='pending-', suffix='.txt')
+                os.close(fd)
+                os.replace(str(pending), tmp)
+        return sorted(self.root.glob('pending-*.txt'))
+
+    def add_pending(self, lexicon):
+        if not lexicon:
+            return
+        with file_lock(self.root / 'pending.lock'):
+            with open(str(self.root / 'pending.txt'), 'a', encoding='utf-8') as f:
+                write_lexicon(f, lexicon)
+        if self.auto_build:
+            self.build_in_background()
+
+    def build_in_background(self):
+        """Starts a build of the pending words that does not hold up the job."""
+        log.info('Starting a build of the global language with the pending words in the background.')
+        if getattr(sys, 'frozen', False):
+            # there is no Python to run the module with, the build keeps the job running until it is done
+            Thread(target=self.build, kwargs={'pending_only': True}).start()
+            return
+        cmd = [sys.executable, '-m', 'utils.global_language', str(self.root.absolute()), '--pending-only',
+               f'--oov-word={self.oov}', f'--g2p-model={Path(self.g2p_path).absolute()}',
+               f'--g2p-lexicon={Path(self.g2p_lex_path).absolute()}', f'--kaldi-root={self.kaldi.root.absolute()}',
+               f'--fst-mode={self.fst_mode}']
+        if self.g2p_cache:
+            cmd.append(f'--g2p-cache={self.g2p_cache.path.absolute()}')
+        kwargs = {}
+        if sys.platform == 'win32':
+            kwargs['creationflags'] = subprocess.CREATE_NEW_PROCESS_GROUP
+        else:
+            # not stopped by a Ctrl-C meant for the job
+            kwargs['start_new_session'] = True
+        subprocess.Popen(cmd, cwd=str(Path(__file__).parent.parent), stdin=subprocess.DEVNULL,
+                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, **kwargs)
+
+    def prepare(self, wordlist, transcription, output_dir):
+        """Puts the language files into output_dir. When words of wordlist are missing from the global language,
+        they are prepared for this job alone."""
+        path = self.current()
+        if path is None:
+            path = self.build(force=False)
+        try:
+            word_ids = read_word_ids(path / 'words.txt')
+            missing = [w for w in sorted(set(wordlist)) if w not in word_ids]
+            if not missing:
+                (output_dir / 'phones').mkdir(parents=True, exist_ok=True)
+                for name in language_files:
+                    link_or_copy(path / name, output_dir / name)
+                if transcription:
+                    write_transcription(output_dir / 'trans.int', transcription, word_ids)
+                return
+            log.info(f'{len(missing)} words missing from the global language, preparing the language of this job. '
+                     f'They are added by the next build.')
+        except FileNotFoundError:
+            # removed by newer builds in the meantime
+            missing = []
+            for name in language_files:
+                if (output_dir / name).exists():
+                    os.unlink(str(output_dir / name))
+
+        post_lexicon = prepare_language_wordlist(wordlist, transcription, output_dir, self.g2p_path,
+                                                 self.g2p_lex_path, self.oov, self.kaldi, self.g2p_cache,
+                                                 self.fst_mode, self.phone_cache)
+        self.add_pending({w: post_lexicon[w] for w in missing if w in post_lexicon})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Builds the global language from the whole lexicon, adding the '
+                                                 'words jobs found missing from the previous build. Run it before '
+                                                 'the first job with --global-lexicon and after the lexicon or the '
+                                                 'G2P model changed. The jobs start it with --pending-only for the '
+                                                 'words they add.')
+    parser.add_argument('output_dir')
+    parser.add_argument('--oov-word', default='<unk>')
+    parser.add_argument('--g2p-model', default='data/g2p/model.fst')
+    parser.add_argument('--g2p-lexicon', default='data/g2p/lexicon.txt')
+    parser.add_argument('--g2p-cache', help='Also add the words of this G2P cache.')
+    parser.add_argument(
+        '--kaldi-root', default='/home/guest/Applications/kaldi')
+    parser.add_argument('--fst-mode', default='fstcompile', choices=['fstcompile', 'python'])
+    parser.add_argument('--pending-only', action='store_true',
+                        help='Only build if there are pending words and no other build is waiting for the lock.')
+
+    args = parser.parse_args()
+
+    g2p_cache = None
+    if args.g2p_cache:
+        from utils.g2p_cache import G2PCache
+
+        g2p_cache = G2PCache(args.g2p_cache, args.g2p_model)
+
+    language = GlobalLanguage(args.output_dir, Path(args.g2p_model), Path(args.g2p_lexicon), args.oov_word,
+                              KaldiPrograms(args.kaldi_root), g2p_cache, args.fst_mode, auto_build=False)
+    path = language.build(pending_only=args.pending_only)
+    if path:
+        print(f'Built {path}')
+    if g2p_cache:
+        g2p_cache.close()
@@ -0,0 +1,138 @@
+from array import array
+
+from utils.disambig import disambig_symbols
+
+# the order of the position-dependent variants of a phone in phones.txt
+position_suffixes = ['_B', '_E', '_S', '_I']
+BEGIN, END, SINGLETON, INTERNAL = range(4)
+
+
+class PhoneSet:
+    """The IDs of the phones, numbered as in phones.txt: <eps>, then each silence phone followed by its _B, _E, _S
+    and _I variants, then the _B, _E, _S and _I variants of each non-silence phone and last the disambiguation
+    symbols. The variants of a phone are consecutive, so the ID of each is the ID of the _B variant plus its
+    position (BEGIN, END, SINGLETON or INTERNAL)."""
+
+    def __init__(self, silence_phones, nonsilence_phones):
+        self.silence = list(silence_phones)
+        self.nonsilence = list(nonsilence_phones)
+        self.index = {ph: i for i, ph in enumerate(self.silence + self.nonsilence)}
+        self.base = array('i')
+        id = 1
+        for ph in self.silence:
+            self.base.append(id + 1)
+            id += 1 + len(position_suffixes)
+        for ph in self.nonsilence:
+            self.base.append(id)
+            id += len(position_suffixes)
+        self.first_disambig = id
+
+    def phone_id(self, ph) -> int:
+        """ID of a silence phone without the position."""
+        return self.base[self.index[ph]] - 1
+
+    def position_ids(self, pron) -> list:
+        """IDs of the position-dependent phones of a pronunciation given as phone indices."""
+        base = self.base
+        if len(pron) == 1:
+            return [base[pron[0]] + SINGLETON]
+        if not pron:
+            return []
+        return [base[pron[0]] + BEGIN] + [base[p] + INTERNAL for p in pron[1:-1]] + [base[pron[-1]] + END]
+
+    def symbols(self, max_disambig):
+        """(symbol, ID) pairs of phones.txt."""
+        yield '<eps>', 0
+        for ph, base in zip(self.silence, self.base):
+            yield ph, base - 1
+            for pos, suffix in enumerate(position_suffixes):
+                yield ph + suffix, base + pos
+        for ph, base in zip(self.nonsilence, self.base[len(self.silence):]):
+            for pos, suffix in enumerate(position_suffixes):
+                yield ph + suffix, base + pos
+        for i in range(max_disambig + 1):
+            yield f'#{i}', self.first_disambig + i
+
+    def write_phones(self, path, max_disambig):
+        with open(str(path), 'w', encoding='utf-8') as f:
+            for ph, id in self.symbols(max_disambig):
+                f.write(f'{ph} {id}\n')
+
+    def write_disambig(self, phones_dir, max_disambig):
+        phones_dir.mkdir(exist_ok=True)
+        with open(str(phones_dir / 'disambig.txt'), 'w', encoding='utf-8') as f:
+            for i in range(max_disambig + 1):
+                f.write(f'#{i}\n')
+        with open(str(phones_dir / 'disambig.int'), 'w', encoding='utf-8') as f:
+            for i in range(max_disambig + 1):
+                f.write(f'{self.first_disambig + i}\n')
+
+    def write_word_boundary(self, path):
+        with open(str(path), 'w', encoding='utf-8') as f:
+            for base in self.base[:len(self.silence)]:
+                f.write(f'{base - 1} nonword\n')
+                for pos, b in enumerate(['begin', 'end', 'singleton', 'internal']):
+                    f.write(f'{base + pos} {b}\n')
+            for base in self.base[len(self.silence):]:
+                for pos, b in enumerate(['begin', 'end', 'singleton', 'internal']):
+                    f.write(f'{base + pos} {b}\n')
+
+
+class IntLexicon:
+    """A lexicon kept in flat arrays. For each pronunciation there is the ID of its word (as in words.txt), its
+    probability, its disambiguation symbol (n of #n, 0 for none) and the range of its phones in the phones array,
+    which holds the indices of the phones in the PhoneSet without their positions."""
+
+    def __init__(self, phone_set, words):
+        self.phone_set = phone_set
+        self.words = sorted(set(words))
+        self.word_ids = {w: i + 1 for i, w in enumerate(self.words)}
+        self.word = array('i')
+        self.prob = array('d')
+        self.disambig = array('i')
+        self.phones = array('H')
+        self.offsets = array('i', [0])
+        self.max_disambig = 0
+
+    def __len__(self):
+        return len(self.word)
+
+    def add(self, word, prob, pron):
+        ids = [self.phone_set.index.get(ph) for ph in pron]
+        assert None not in ids, f'ERROR: {pron[ids.index(None)]} is not a proper phoneme!'
+        self.word.append(self.word_ids[word])
+        self.prob.append(prob)
+        self.disambig.append(0)
+        self.phones.extend(ids)
+        self.offsets.append(len(self.phones))
+
+    def position_ids(self, i) -> list:
+        return self.phone_set.position_ids(self.phones[self.offsets[i]:self.offsets[i + 1]])
+
+    def add_disambig(self, first_sym=1) -> int:
+        """Finds the disambiguation symbols of the pronunciations and returns the highest one used."""
+        keys = [''.join(map(chr, self.position_ids(i))) for i in range(len(self))]
+        self.disambig, self.max_disambig = disambig_symbols(keys, first_sym)
+        return self.max_disambig
+
+    def fst_entries(self):
+        """(word ID, prob, [phone IDs]) of each pronunciation, with the ID of its disambiguation symbol last."""
+        first_disambig = self.phone_set.first_disambig
+        for i in range(len(self)):
+            ids = self.position_ids(i)
+            if self.disambig[i]:
+                ids.append(first_disambig + self.disambig[i])
+            yield self.word[i], self.prob[i], ids
+
+    def word_symbols(self):
+        """(symbol, ID) pairs of words.txt."""
+        yield '<eps>', 0
+        for w, id in self.word_ids.items():
+            yield w, id
+        for i, w in enumerate(['#0', '<s>', '</s>']):
+            yield w, len(self.words) + 1 + i
+
+    def write_words(self, path):
+        with open(str(path), 'w', encoding='utf-8') as f:
+            for w, id in self.word_symbols():
+                f.write(f'{w} {id}\n')
@@ -0,0 +1,213 @@
+import argparse
+import mmap
+import os
+import struct
+from pathlib import Path
+
+import numpy as np
+
+dtypes = {b'FM ': np.float32, b'DM ': np.float64, b'FV ': np.float32, b'DV ': np.float64}
+
+
+def read_int32(buf, offset):
+    size, value = struct.unpack_from('<bi', buf, offset)
+    assert size == 4, f'Expected a 4-byte integer at {offset}'
+    return value, offset + 5
+
+
+def read_token(buf, offset):
+    end = buf.find(b' ', offset)
+    return bytes(buf[offset:end]), end + 1
+
+
+def read_object(buf, offset):
+    """Reads a binary matrix or vector at offset (at its '\\0B' marker) as a NumPy array sharing memory
+    with buf. Returns the array and the offset just after it."""
+    assert buf[offset:offset + 2] == b'\0B', f'Only binary objects are supported (offset {offset})'
+    typ = bytes(buf[offset + 2:offset + 5])
+    assert typ in dtypes, f'Unsupported object type {typ} at offset {offset}'
+    dtype = dtypes[typ]
+    offset += 5
+    if typ[1:2] == b'M':
+        rows, offset = read_int32(buf, offset)
+        cols, offset = read_int32(buf, offset)
+        shape = (rows, cols)
+    else:
+        dim, offset = read_int32(buf, offset)
+        shape = (dim,)
+    count = int(np.prod(shape))
+    arr = np.frombuffer(buf, dtype=dtype, count=count, offset=offset).reshape(shape)
+    return arr, offset + count * np.dtype(dtype).itemsize
+
+
+def write_object(f, arr):
+    arr = np.ascontiguousarray(arr)
+    if arr.dtype != np.float64:
+        arr = arr.astype(np.float32, copy=False)
+    typ = (b'F' if arr.dtype == np.float32 else b'D') + (b'M ' if arr.ndim == 2 else b'V ')
+    f.write(b'\0B' + typ)
+    if arr.ndim == 2:
+        f.write(struct.pack('<bibi', 4, arr.shape[0], 4, arr.shape[1]))
+    else:
+        assert arr.ndim == 1, f'Cannot write an array with {arr.ndim} dimensions'
+        f.write(struct.pack('<bi', 4, arr.shape[0]))
+    f.write(arr.tobytes())
+
+
+class ArkReader:
+    """Memory-maps an ark file. The arrays returned point straight into the mapping, so they are read-only
+    and keep the mapping alive for as long as they are used."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(str(path), 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                # an empty file cannot be mapped, e.g. an ark compute-mfcc-feats wrote no utterances to
+                self.mm = b''
+            else:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __iter__(self):
+        offset = 0
+        while offset < len(self.mm):
+            key, offset = read_token(self.mm, offset)
+            arr, offset = read_object(self.mm, offset)
+            yield key.decode('utf-8'), arr
+
+    def read_at(self, offset):
+        return read_object(self.mm, offset)[0]
+
+    def index(self):
+        """Key to byte offset, same as the offsets in an scp file."""
+        offsets = {}
+        offset = 0
+        while offset < len(self.mm):
+            key, offset = read_token(self.mm, offset)
+            offsets[key.decode('utf-8')] = offset
+            offset = read_object(self.mm, offset)[1]
+        return offsets
+
+    def close(self):
+        if not isinstance(self.mm, mmap.mmap):
+            return
+        try:
+            self.mm.close()
+        except BufferError:
+            # arrays read from the ark are still in use
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ArkWriter:
+    """Writes binary arks, optionally with an scp file listing the offset of each entry."""
+
+    def __init__(self, ark_path, scp_path=None):
+        self.ark_path = Path(ark_path)
+        self.ark = open(str(ark_path), 'wb')
+        self.scp = open(str(scp_path), 'w', encoding='utf-8') if scp_path else None
+
+    def write(self, key, arr):
+        self.ark.write(key.encode('utf-8') + b' ')
+        if self.scp:
+            self.scp.write(f'{key} {self.ark_path}:{self.ark.tell()}\n')
+        write_object(self.ark, arr)
+
+    def close(self):
+        self.ark.close()
+        if self.scp:
+            self.scp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_scp(path):
+    entries = {}
+    with open(str(path), encoding='utf-8') as f:
+        for l in f:
+            tok = l.strip().split(maxsplit=1)
+            if len(tok) != 2:
+                continue
+            ark, offset = tok[1].rsplit(':', 1)
+            entries[tok[0]] = (ark, int(offset))
+    return entries
+
+
+class ScpReader:
+    """Random access to the entries of an scp file with 'key ark:offset' lines."""
+
+    def __init__(self, path):
+        self.entries = read_scp(path)
+        self.arks = {}
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def keys(self):
+        return self.entries.keys()
+
+    def __getitem__(self, key):
+        ark, offset = self.entries[key]
+        if ark not in self.arks:
+            self.arks[ark] = ArkReader(ark)
+        return self.arks[ark].read_at(offset)
+
+    def close(self):
+        for ark in self.arks.values():
+            ark.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_ark(path):
+    return ArkReader(path)
+
+
+def read_matrix(path):
+    """Reads a single matrix or vector file, like final.mat, in binary or text format."""
+    with open(str(path), 'rb') as f:
+        head = f.read(2)
+    if head == b'\0B':
+        with ArkReader(path) as ark:
+            return ark.read_at(0).copy()
+    with open(str(path), encoding='utf-8') as f:
+        rows = f.read().replace('[', ' ').replace(']', '\n').strip().split('\n')
+    return np.array([[float(v) for v in r.split()] for r in rows if r.strip()])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Lists the contents of a binary ark or scp file.')
+    parser.add_argument('input', type=Path)
+    parser.add_argument('--scp', type=str, default='n', help='Input is an scp file.')
+    parser.add_argument('--write-scp', type=Path, help='Write an scp file with the offsets of the ark entries.')
+
+    args = parser.parse_args()
+
+    if args.scp.lower() in ['y', 'yes', 't', 'true']:
+        with ScpReader(args.input) as scp:
+            for key in scp.keys():
+                arr = scp[key]
+                print(f'{key} {arr.dtype} {arr.shape}')
+    else:
+        with ArkReader(args.input) as ark:
+            if args.write_scp:
+                with open(str(args.write_scp), 'w', encoding='utf-8') as f:
+                    for key, offset in ark.index().items():
+                        f.write(f'{key} {args.input}:{offset}\n')
+            for key, arr in ark:
+                print(f'{key} {arr.dtype} {arr.shape}')
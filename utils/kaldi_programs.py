@@ -1,23 +1,95 @@
+import json
 import logging
 import os
 import sys
+import tempfile
 from pathlib import Path
-from subprocess import run, DEVNULL, Popen, PIPE
+from subprocess import run, DEVNULL, Popen, PIPE, CalledProcessError
 from threading import Thread
 
-from utils.log import log
+from utils.fst_writer import write_lexicon_fst
+from utils.log import RateLimiter, kaldi_level, log
 from utils.make_lexicon_fst import write_fst_with_silence
+from utils.profiler import Profiler, profiled, wait_process
 
 progs = ['compute-mfcc-feats', 'compute-cmvn-stats', 'apply-cmvn', 'splice-feats', 'transform-feats', 'linear-to-nbest',
          'lattice-align-words', 'nbest-to-ctm', 'gmm-align', 'phonetisaurus-g2pfst', 'fstcompile', 'fstarcsort',
          'lattice-to-phone-lattice', 'extract-segments']
 
+def find_programs(root, names, dir_mtimes=None):
+    """Finds all the programs in a single walk of the root folder.
+
+    Same result as globbing '**/name' (and '**/name.exe' if that finds nothing) for each of the names:
+    the first match in a top-down walk, preferring the name without the extension. The modification times
+    of the folders walked are put in dir_mtimes, if given."""
+    found = {}
+    found_exe = {}
+    visited = set()
+    for dirpath, dirnames, filenames in os.walk(str(root), followlinks=True):
+        real = os.path.realpath(dirpath)
+        if real in visited:
+            dirnames[:] = []
+            continue
+        visited.add(real)
+        if dir_mtimes is not None:
+            dir_mtimes[dirpath] = os.stat(dirpath).st_mtime_ns
+        for name in names:
+            if name not in found and name in filenames:
+                found[name] = os.path.join(dirpath, name)
+            if name not in found_exe and name + '.exe' in filenames:
+                found_exe[name] = os.path.join(dirpath, name + '.exe')
+        if len(found) == len(names):
+            break
+    for name, path in found_exe.items():
+        found.setdefault(name, path)
+    return found
+
+
+def resolve_programs(root, names, cache_path=None):
+    """Like find_programs, but reuses the paths saved in cache_path as long as all the folders the walk
+    went through and all the programs are unchanged since they were found. A program added or removed in
+    any of these folders changes its modification time, and may change what the walk finds."""
+    root = os.path.abspath(str(root))
+    cache = {}
+    if cache_path and Path(cache_path).exists():
+        try:
+            with open(str(cache_path), encoding='utf-8') as f:
+                cache = json.load(f)
+        except ValueError:
+            log.warning(f'Ignoring corrupt program cache {cache_path}')
+            cache = {}
+
+    entry = cache.get(root)
+    if entry and 'dirs' in entry and set(names) <= set(entry['progs']):
+        try:
+            if all(os.stat(path).st_mtime_ns == mtime for path, mtime in entry['dirs'].items()) and \
+                    all(os.stat(path).st_mtime_ns == mtime for path, mtime in entry['progs'].values()):
+                return {name: entry['progs'][name][0] for name in names}
+        except FileNotFoundError:
+            pass
+
+    dir_mtimes = {}
+    found = find_programs(root, names, dir_mtimes)
+    if cache_path and len(found) == len(names):
+        cache[root] = {'dirs': dir_mtimes,
+                       'progs': {name: [path, os.stat(path).st_mtime_ns] for name, path in found.items()}}
+        fd, tmp = tempfile.mkstemp(dir=str(Path(cache_path).parent), prefix=Path(cache_path).name)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(cache, f, indent=2)
+        os.replace(tmp, str(cache_path))
+    return found
+
+
 class LogPipe(Thread):
 
-    def __init__(self, level):
+    def __init__(self, level, job=None, min_level=logging.DEBUG, rate_limit=None):
         Thread.__init__(self)
         self.daemon = False
         self.level = level
+        self.min_level = min_level
+        self.extra = {'job': job} if job else None
+        self.limiter = RateLimiter(rate_limit) if rate_limit else None
+        self.filtered = 0
         self.fdRead, self.fdWrite = os.pipe()
         self.pipeReader = os.fdopen(self.fdRead)
         self.start()
@@ -27,28 +99,42 @@ class LogPipe(Thread):
 
     def run(self):
         for line in iter(self.pipeReader.readline, ''):
-            log.log(self.level, line.strip('\n'))
+            level = kaldi_level(line, self.level)
+            if level < self.min_level:
+                self.filtered += 1
+                continue
+            # errors are never dropped, they are usually the only thing worth reading
+            if self.limiter and level < logging.ERROR and not self.limiter.allow():
+                continue
+            log.log(level, line.strip('\n'), extra=self.extra)
 
         self.pipeReader.close()
+        dropped = self.limiter.dropped if self.limiter else 0
+        if self.filtered or dropped:
+            log.log(self.level, f'Kaldi log lines filtered: {self.filtered}, dropped by rate limit: {dropped}',
+                    extra=self.extra)
 
     def close(self):
         os.close(self.fdWrite)
+        self.join()
 
 
 class KaldiPrograms:
 
-    def __init__(self, root_path):
-        self.log = LogPipe(logging.INFO)
+    def __init__(self, root_path, profiler=None, job=None, log_level=logging.DEBUG, log_rate=None,
+                 cache_path=None, feature_cache=None):
+        self.log = LogPipe(logging.INFO, job, log_level, log_rate)
+        self.profiler = profiler if profiler else Profiler()
+        self.feature_cache = feature_cache
+        self.feature_keys = {}
 
         self.root = Path(root_path)
+        found = resolve_programs(self.root, progs, cache_path)
         self.paths = set()
         for prog in progs:
-            p = list(self.root.glob(f'**/{prog}'))
-            if len(p) == 0:
-                p = list(self.root.glob(f'**/{prog}.exe'))
-            if len(p) == 0:
+            if prog not in found:
                 raise RuntimeError(f'Cannot find {prog} in path {self.root}!')
-            self.paths.add(str(p[0].parent))
+            self.paths.add(os.path.dirname(found[prog]))
 
         for path in self.paths:
             log.info(f'Adding to path: {path}')
@@ -60,53 +146,206 @@ class KaldiPrograms:
     def close(self):
         self.log.close()
 
+    def run(self, cmd, **kwargs):
+        proc = Popen(cmd, stderr=self.log, **kwargs)
+        if wait_process(proc, self.profiler) != 0:
+            raise CalledProcessError(proc.returncode, cmd)
+
+    @profiled('compute_mfcc_feats')
     def compute_mfcc_feats(self, wav_scp, mfcc, segments=None):
+        if not self.feature_cache:
+            self.mfcc_feats(wav_scp, mfcc, segments)
+            return
+
+        from utils.kaldi_io import ArkReader, ArkWriter
+
+        self.feature_keys = self.feature_cache.utterance_keys(wav_scp, segments, 'compute-mfcc-feats')
+        feats = self.feature_cache.get(list(self.feature_keys.values()))
+        missing = {utt for utt, key in self.feature_keys.items() if key not in feats}
+        if missing:
+            # only the utterances that are not in the cache go through Kaldi
+            missing_mfcc = Path(f'{mfcc}.missing')
+            if segments:
+                missing_segments = Path(f'{segments}.missing')
+                with open(str(segments), encoding='utf-8') as f, \
+                        open(str(missing_segments), 'w', encoding='utf-8') as g:
+                    for l in f:
+                        if l.split(maxsplit=1)[0] in missing:
+                            g.write(l)
+                self.mfcc_feats(wav_scp, missing_mfcc, missing_segments)
+                missing_segments.unlink()
+            else:
+                missing_scp = Path(f'{wav_scp}.missing')
+                with open(str(wav_scp), encoding='utf-8') as f, open(str(missing_scp), 'w', encoding='utf-8') as g:
+                    for l in f:
+                        if l.split(maxsplit=1)[0] in missing:
+                            g.write(l)
+                self.mfcc_feats(missing_scp, missing_mfcc, None)
+                missing_scp.unlink()
+
+            with ArkReader(missing_mfcc) as ark:
+                computed = {self.feature_keys[utt]: arr.copy() for utt, arr in ark}
+            missing_mfcc.unlink()
+            self.feature_cache.put(computed)
+            feats.update(computed)
+
+        with ArkWriter(mfcc) as ark:
+            for utt, key in self.feature_keys.items():
+                if key in feats:
+                    ark.write(utt, feats[key])
+
+    def mfcc_feats(self, wav_scp, mfcc, segments=None):
         if segments:
             seg = Popen(['extract-segments', f'scp:{wav_scp}', str(segments), 'ark:-'], stdout=PIPE, stderr=self.log)
             mfcc = Popen(['compute-mfcc-feats', f'ark:-', f'ark:{mfcc}'], stdin=seg.stdout, stderr=self.log)
-            mfcc.communicate()
             seg.stdout.close()
+            wait_process(mfcc, self.profiler)
+            wait_process(seg, self.profiler)
             assert mfcc.returncode == 0, f'Process compute-mfcc-feats returned code {mfcc.returncode}'
         else:
-            run(['compute-mfcc-feats', f'scp:{wav_scp}', f'ark:{mfcc}'], check=True, stderr=self.log)
+            self.run(['compute-mfcc-feats', f'scp:{wav_scp}', f'ark:{mfcc}'])
 
+    @profiled('compute_cmvn_stats')
     def compute_cmvn_stats(self, mfcc, cmvn):
-        run(['compute-cmvn-stats', f'ark:{mfcc}', f'ark:{cmvn}'], check=True, stderr=self.log)
+        if not self.feature_cache:
+            self.run(['compute-cmvn-stats', f'ark:{mfcc}', f'ark:{cmvn}'])
+            return
+
+        import numpy as np
+        from utils.kaldi_io import ArkReader, ArkWriter
+
+        # the stats are just sums over the frames, cheaper to compute here than to start compute-cmvn-stats
+        stats_keys = {utt: self.feature_cache.derived(key, 'cmvn') for utt, key in self.feature_keys.items()}
+        cached = self.feature_cache.get(list(stats_keys.values()))
+        computed = {}
+        with ArkReader(mfcc) as feats, ArkWriter(cmvn) as ark:
+            for utt, arr in feats:
+                key = stats_keys.get(utt)
+                if key in cached:
+                    stats = cached[key]
+                else:
+                    stats = np.zeros((2, arr.shape[1] + 1))
+                    stats[0, :-1] = arr.sum(axis=0, dtype=np.float64)
+                    stats[0, -1] = len(arr)
+                    stats[1, :-1] = np.square(arr, dtype=np.float64).sum(axis=0)
+                    if key:
+                        computed[key] = stats
+                ark.write(utt, stats)
+        if computed:
+            self.feature_cache.put(computed)
 
+    @profiled('gmm_align')
     def gmm_align(self, tree, model, lex, feature_pipeline, trans, output_pipeline, transition_scale=1.0,
                   acoustic_scale=0.1, self_loop_scale=0.1, beam=20, retry_beam=300, careful=False):
 
-        run(['gmm-align', f'--transition-scale={transition_scale}', f'--acoustic-scale={acoustic_scale}',
-             f'--self-loop-scale={acoustic_scale}', f'--beam={beam}', f'--retry-beam={retry_beam}',
-             f'--careful={str(careful).lower()}', str(tree), str(model), str(lex), feature_pipeline, f'ark:{trans}',
-             output_pipeline], check=True, stderr=self.log)
+        self.run(['gmm-align', f'--transition-scale={transition_scale}', f'--acoustic-scale={acoustic_scale}',
+                  f'--self-loop-scale={acoustic_scale}', f'--beam={beam}', f'--retry-beam={retry_beam}',
+                  f'--careful={str(careful).lower()}', str(tree), str(model), str(lex), feature_pipeline,
+                  f'ark:{trans}', output_pipeline])
+
+    @profiled('gmm_align')
+    def gmm_align_adaptive(self, tree, model, lex, feature_pipeline, trans, alignments, policy,
+                           transition_scale=1.0, acoustic_scale=0.1, self_loop_scale=0.1, careful=False):
+        """Aligns with the beams of a BeamPolicy, running gmm-align once per beam for the utterances that are
+        still not aligned. The alignments are written to a text ark in the order of the transcriptions."""
+        transcripts = {}
+        with open(str(trans), encoding='utf-8') as f:
+            for l in f:
+                transcripts[l.split(maxsplit=1)[0]] = l
+        starts = {utt: policy.start_index() for utt in transcripts}
+        aligned = {}
+        pending = list(transcripts)
+        for k, beam in enumerate(policy.beams):
+            batch = [utt for utt in pending if starts[utt] <= k]
+            if not batch:
+                continue
+            pass_trans = Path(f'{trans}.beam{beam}')
+            pass_ali = Path(f'{alignments}.beam{beam}')
+            with open(str(pass_trans), 'w', encoding='utf-8') as f:
+                for utt in batch:
+                    f.write(transcripts[utt])
+
+            # gmm-align fails when it could not align any of the utterances, which is expected with narrow beams
+            with self.profiler.stage(f'gmm_align_beam_{beam}', segments=len(batch)):
+                proc = Popen(['gmm-align', f'--transition-scale={transition_scale}',
+                              f'--acoustic-scale={acoustic_scale}', f'--self-loop-scale={acoustic_scale}',
+                              f'--beam={beam}', '--retry-beam=0', f'--careful={str(careful).lower()}', str(tree),
+                              str(model), str(lex), feature_pipeline, f'ark:{pass_trans}', f'ark,t:{pass_ali}'],
+                             stderr=self.log)
+                if wait_process(proc, self.profiler) != 0:
+                    log.warning(f'gmm-align with beam {beam} returned code {proc.returncode}')
+
+            if pass_ali.exists():
+                with open(str(pass_ali), encoding='utf-8') as f:
+                    for l in f:
+                        aligned[l.split(maxsplit=1)[0]] = l
+                pass_ali.unlink()
+            pass_trans.unlink()
 
+            for utt in batch:
+                if utt in aligned:
+                    policy.record(starts[utt], k)
+            pending = [utt for utt in pending if utt not in aligned]
+
+        for utt in pending:
+            log.warning(f'Failed to align {utt} with any of the beams {policy.beams}')
+            policy.record(starts[utt], None)
+        if not aligned:
+            raise RuntimeError('gmm-align failed to align any of the utterances!')
+
+        with open(str(alignments), 'w', encoding='utf-8') as f:
+            for utt in transcripts:
+                if utt in aligned:
+                    f.write(aligned[utt])
+
+    @profiled('align_words')
+    def align_words(self, alignments, trans, word_boundary, model, output):
+        """The output pipeline of gmm-align, for alignments made by gmm_align_adaptive."""
+        nbest = Popen(['linear-to-nbest', f'ark:{alignments}', f'ark:{trans}', '', '', 'ark:-'], stdout=PIPE,
+                      stderr=self.log)
+        words = Popen(['lattice-align-words', str(word_boundary), str(model), 'ark:-', f'ark:{output}'],
+                      stdin=nbest.stdout, stderr=self.log)
+        nbest.stdout.close()
+        wait_process(words, self.profiler)
+        wait_process(nbest, self.profiler)
+        assert words.returncode == 0, f'Process lattice-align-words returned code {words.returncode}'
+        assert nbest.returncode == 0, f'Process linear-to-nbest returned code {nbest.returncode}'
+
+    @profiled('nbest_to_ctm')
     def nbest_to_ctm(self, nbest, ctm, frame_shift=0.01, print_silence=False):
-        run(['nbest-to-ctm', f'--frame-shift={frame_shift}', f'--print-silence={str(print_silence).lower()}',
-             f'ark:{nbest}', str(ctm)], check=True, stderr=self.log)
+        self.run(['nbest-to-ctm', f'--frame-shift={frame_shift}', f'--print-silence={str(print_silence).lower()}',
+                  f'ark:{nbest}', str(ctm)])
 
+    @profiled('lattice_to_phone_lattice')
     def lattice_to_phone_lattice(self, model, lattice, phone_lattice):
-        run(['lattice-to-phone-lattice', str(model), f'ark:{lattice}', f'ark:{phone_lattice}'], check=True,
-            stderr=self.log)
+        self.run(['lattice-to-phone-lattice', str(model), f'ark:{lattice}', f'ark:{phone_lattice}'])
 
-    def phonetisaurus_g2p(self, model, wordlist, output):
+    @profiled('phonetisaurus_g2p')
+    def phonetisaurus_g2p(self, model, wordlist, output, pmass=0.8, nbest=10):
         with open(str(output), 'w', encoding='utf-8') as f:
-            run(['phonetisaurus-g2pfst', '--pmass=0.8', '--nbest=10', f'--model={model}', f'--wordlist={wordlist}'],
-                stdout=f, stderr=self.log, check=True)
+            self.run(['phonetisaurus-g2pfst', f'--pmass={pmass}', f'--nbest={nbest}', f'--model={model}',
+                      f'--wordlist={wordlist}'], stdout=f)
+
+    @profiled('make_L_fst')
+    def make_L_fst(self, lexicon, output_fst, optional_silence, mode='fstcompile', sil_prob=0.5):
+        # lexicon is an IntLexicon, the FST is written with the IDs of its phones.txt and words.txt
+        sil_phone = lexicon.phone_set.phone_id(optional_silence)
+        if mode == 'python':
+            write_lexicon_fst(lexicon.fst_entries(), sil_prob, sil_phone, None, output_fst)
+            return
 
-    def make_L_fst(self, lexicon, output_fst, optional_silence, phones_file, words_file):
         proc_compile = Popen(
-            ['fstcompile', f'--isymbols={phones_file}', f'--osymbols={words_file}',
-             '--keep_isymbols=false', '--keep_osymbols=false', '-', str(output_fst)],
-            stdin=PIPE, stdout=PIPE, encoding='utf-8', stderr=self.log)
+            ['fstcompile', '--keep_isymbols=false', '--keep_osymbols=false', '-', str(output_fst)],
+            stdin=PIPE, encoding='utf-8', stderr=self.log)
 
-        write_fst_with_silence(lexicon, 0.5, optional_silence, None, nonterminals=None, left_context_phones=None,
-                               file=proc_compile.stdin)
+        write_fst_with_silence(lexicon.fst_entries(), sil_prob, sil_phone, None, nonterminals=None,
+                               left_context_phones=None, file=proc_compile.stdin, eps=0)
 
-        proc_compile.communicate()
         proc_compile.stdin.close()
+        wait_process(proc_compile, self.profiler)
 
         assert proc_compile.returncode == 0, f'Process fstcompile returned code {proc_compile.returncode}'
 
+    @profiled('fstarcsort')
     def fstarcsort(self, input_fst, output_fst):
-        run(['fstarcsort', '--sort_type=olabel', str(input_fst), str(output_fst)], check=True, stderr=self.log)
+        self.run(['fstarcsort', '--sort_type=olabel', str(input_fst), str(output_fst)])
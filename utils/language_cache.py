@@ -0,0 +1,111 @@
+import hashlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from pathlib import Path
+
+from utils.g2p_cache import file_hash
+from utils.log import log
+from utils.phone_set_cache import link_or_copy, phone_set_hash
+
+# the files of a language that do not depend on the transcriptions
+language_files = ['words.txt', 'phones.txt', 'word_boundary.int', 'phones/disambig.txt', 'phones/disambig.int',
+                  'L.fst']
+
+
+class LanguageCache:
+    """Finished language files, keyed by the hash of the vocabulary, the lexicon, the G2P model, the phone set
+    and the silence probability. A hit links (or copies) the files into the output folder, so they must not be
+    modified there. The least recently used languages are removed once the cache grows over max_bytes."""
+
+    def __init__(self, cache_dir, g2p_path, g2p_lex_path, phone_set, sil_prob, max_bytes=2 ** 30):
+        self.dir = Path(cache_dir)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.config = f'{file_hash(g2p_path)}:{file_hash(g2p_lex_path)}:{phone_set_hash(phone_set)}:{sil_prob}'
+
+        # the daemon opens the cache in the main thread and prepares the languages in its worker thread
+        self.db = sqlite3.connect(str(self.dir / 'index.db'), timeout=60, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS langs (key TEXT PRIMARY KEY, size INTEGER, used REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS langs_used ON langs (used)')
+        self.db.commit()
+
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, wordlist, oov):
+        h = hashlib.sha1(f'{self.config}:{oov}\n'.encode('utf-8'))
+        for w in sorted(set(wordlist)):
+            h.update(w.encode('utf-8'))
+            h.update(b'\n')
+        return h.hexdigest()
+
+    def get(self, key, output_dir) -> bool:
+        """Puts the files of the language into output_dir, if it is in the cache."""
+        path = self.dir / key
+        row = self.db.execute('SELECT key FROM langs WHERE key=?', (key,)).fetchone()
+        if row is None or not path.is_dir():
+            self.misses += 1
+            return False
+        (output_dir / 'phones').mkdir(parents=True, exist_ok=True)
+        try:
+            for name in language_files:
+                link_or_copy(path / name, output_dir / name)
+        except FileNotFoundError:
+            # evicted by another job in the meantime. The files linked so far are removed, the language is
+            # written in their place and must not overwrite files shared with other workspaces.
+            for name in language_files:
+                if (output_dir / name).exists():
+                    os.unlink(str(output_dir / name))
+            self.misses += 1
+            return False
+        self.db.execute('UPDATE langs SET used=? WHERE key=?', (time.time(), key))
+        self.db.commit()
+        self.hits += 1
+        log.info(f'Language files taken from the cache ({key}).')
+        return True
+
+    def put(self, key, output_dir):
+        path = self.dir / key
+        if not path.is_dir():
+            tmp = Path(tempfile.mkdtemp(dir=str(self.dir), prefix='tmp-'))
+            try:
+                (tmp / 'phones').mkdir()
+                for name in language_files:
+                    shutil.copyfile(str(output_dir / name), str(tmp / name))
+                os.rename(str(tmp), str(path))
+            except OSError:
+                # added by another job in the meantime
+                shutil.rmtree(str(tmp), ignore_errors=True)
+                if not path.is_dir():
+                    raise
+        # also indexes a folder left without its row by a job that died after renaming it
+        try:
+            size = sum(os.path.getsize(str(path / name)) for name in language_files)
+        except FileNotFoundError:
+            # evicted by another job in the meantime
+            return
+        self.db.execute('INSERT OR REPLACE INTO langs VALUES (?, ?, ?)', (key, size, time.time()))
+        self.db.commit()
+        self.evict()
+
+    def evict(self):
+        total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM langs').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        removed = []
+        for key, size in self.db.execute('SELECT key, size FROM langs ORDER BY used').fetchall():
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(str(self.dir / key), ignore_errors=True)
+            removed.append((key,))
+            total -= size
+        log.info(f'Evicting {len(removed)} languages from the language cache.')
+        self.db.executemany('DELETE FROM langs WHERE key=?', removed)
+        self.db.commit()
+
+    def close(self):
+        log.info(f'Language cache: {self.hits} hits, {self.misses} misses.')
+        self.db.close()
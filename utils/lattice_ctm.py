@@ -0,0 +1,227 @@
+import argparse
+import struct
+from pathlib import Path
+
+FST_MAGIC = 2125659606
+
+
+def f32(x):
+    return struct.unpack('<f', struct.pack('<f', x))[0]
+
+
+class Reader:
+    """Reads the primitives of Kaldi's and OpenFst's binary formats from a bytes object."""
+
+    def __init__(self, data, pos=0):
+        self.data = data
+        self.pos = pos
+
+    def unpack(self, fmt):
+        v = struct.unpack_from(fmt, self.data, self.pos)
+        self.pos += struct.calcsize(fmt)
+        return v
+
+    def token(self):
+        end = self.data.index(b' ', self.pos)
+        tok = self.data[self.pos:end].decode('utf-8')
+        self.pos = end + 1
+        return tok
+
+    def expect(self, token):
+        tok = self.token()
+        assert tok == token, f'Expected {token}, got {tok}'
+
+    def basic(self, fmt='i'):
+        # Kaldi's WriteBasicType: the size of the type, then the value
+        size, v = self.unpack(f'<b{fmt}')
+        assert size == struct.calcsize(fmt), f'Unexpected type size {size}'
+        return v
+
+    def int_vector(self):
+        size, num = self.unpack('<bi')
+        assert size == 4, f'Unexpected type size {size}'
+        return list(self.unpack(f'<{num}i'))
+
+    def fst_string(self):
+        num, = self.unpack('<i')
+        s = self.data[self.pos:self.pos + num].decode('utf-8')
+        self.pos += num
+        return s
+
+
+class TransitionModel:
+    """The part of Kaldi's TransitionModel needed to map transition-ids to phones and HMM states."""
+
+    def __init__(self, model_path):
+        with open(str(model_path), 'rb') as f:
+            data = f.read()
+        r = Reader(data)
+        assert r.unpack('2s')[0] == b'\0B', f'Only binary models are supported: {model_path}'
+        r.expect('<TransitionModel>')
+
+        r.expect('<Topology>')
+        r.int_vector()  # phones
+        phone2idx = r.int_vector()
+        num_entries = r.basic()
+        hmm = num_entries != -1
+        if not hmm:
+            # -1 marks the format with separate self-loop pdf-classes
+            num_entries = r.basic()
+        entries = []
+        for i in range(num_entries):
+            states = []
+            for j in range(r.basic()):
+                r.basic()
+                if not hmm:
+                    r.basic()
+                dests = []
+                for k in range(r.basic()):
+                    dests.append(r.basic())
+                    r.basic('f')
+                states.append(dests)
+            entries.append(states)
+        r.expect('</Topology>')
+
+        tuples_token = r.token()
+        assert tuples_token in ['<Triples>', '<Tuples>'], f'Unexpected token {tuples_token}'
+        tuples = []
+        for i in range(r.basic()):
+            phone, hmm_state = r.basic(), r.basic()
+            r.basic()
+            if tuples_token == '<Tuples>':
+                r.basic()
+            tuples.append((phone, hmm_state))
+
+        # transition-ids start from 1, one for each transition out of each transition-state
+        self.phone = [0]
+        self.hmm_state = [0]
+        self.self_loop = [False]
+        for phone, hmm_state in tuples:
+            dests = entries[phone2idx[phone]][hmm_state]
+            for dest in dests:
+                self.phone.append(phone)
+                self.hmm_state.append(hmm_state)
+                self.self_loop.append(dest == hmm_state)
+
+    def is_phone_start(self, tid):
+        # the same test lattice-to-phone-lattice uses to place the phone labels
+        return tid != 0 and self.hmm_state[tid] == 0 and not self.self_loop[tid]
+
+
+def read_compact_lattices(path):
+    """Yields (key, start, states) for the binary compact lattices in an ark, where states is a list of
+    (final, arcs) with final the transition-ids of the final weight (None if not final) and arcs a list of
+    (label, transition-ids, next state)."""
+    with open(str(path), 'rb') as f:
+        data = f.read()
+    r = Reader(data)
+    while r.pos < len(data):
+        key = r.token()
+        assert r.unpack('2s')[0] == b'\0B', f'Only binary lattices are supported: {path}'
+        magic, = r.unpack('<i')
+        assert magic == FST_MAGIC, f'Bad FST header for {key}'
+        fst_type, arc_type = r.fst_string(), r.fst_string()
+        assert fst_type == 'vector' and arc_type.startswith('compactlattice'), \
+            f'Unsupported lattice type {fst_type}/{arc_type} for {key}'
+        version, flags, props, start, num_states, num_arcs = r.unpack('<iiQqqq')
+        assert flags == 0, f'Unsupported FST flags {flags} for {key}'
+        assert num_states >= 0, f'Lattice for {key} has an unknown number of states'
+        states = []
+        for s in range(num_states):
+            w1, w2, n = r.unpack('<ffi')
+            final_tids = r.unpack(f'<{n}i')
+            final = None if w1 == float('inf') else final_tids
+            arcs = []
+            num, = r.unpack('<q')
+            for a in range(num):
+                ilabel, olabel, w1, w2, n = r.unpack('<iiffi')
+                tids = r.unpack(f'<{n}i')
+                nextstate, = r.unpack('<i')
+                arcs.append((ilabel, tids, nextstate))
+            states.append((final, arcs))
+        yield key, start, states
+
+
+def linear_path(start, states):
+    """The (label, transition-ids) of the arcs of a linear lattice and the transition-ids of its final weight.
+    None if the lattice is not linear."""
+    path = []
+    s = start
+    while True:
+        final, arcs = states[s]
+        if final is not None:
+            if arcs:
+                return None
+            return path, final
+        if len(arcs) != 1:
+            return None
+        label, tids, s = arcs[0]
+        path.append((label, tids))
+
+
+def word_alignment(path):
+    """Same as CompactLatticeToWordAlignment: (word, start frame, length) for each arc. The final weight is
+    ignored, like it does."""
+    words = []
+    t = 0
+    for label, tids in path:
+        words.append((label, t, len(tids)))
+        t += len(tids)
+    return words
+
+
+def phone_alignment(path, final, tmodel):
+    """Same as the result of lattice-to-phone-lattice followed by CompactLatticeToWordAlignment: each phone
+    starts at its first-state, non-self-loop transition-id and lasts until the next phone starts."""
+    phones = []
+    label = 0
+    begin = 0
+    t = 0
+    # lattice-to-phone-lattice turns the final weight into arcs, so its frames count here
+    for word, tids in path + [(0, final)]:
+        for tid in tids:
+            if tmodel.is_phone_start(tid):
+                if t > begin or label != 0:
+                    phones.append((label, begin, t - begin))
+                label = tmodel.phone[tid]
+                begin = t
+            t += 1
+    if t > begin or label != 0:
+        phones.append((label, begin, t - begin))
+    return phones
+
+
+def write_ctm(f, key, alignment, frame_shift=0.01, print_silence=False):
+    # nbest-to-ctm does the arithmetic in single precision and prints 2 decimals
+    shift = f32(frame_shift)
+    for label, start, length in alignment:
+        if label == 0 and not print_silence:
+            continue
+        f.write(f'{key} 1 {f32(shift * start):.2f} {f32(shift * length):.2f} {label}\n')
+
+
+def lattice_to_ctms(model, lattice, word_ctm, phone_ctm, frame_shift=0.01):
+    """Writes the word and phone CTMs of the linear lattices written by lattice-align-words. Does the work of
+    nbest-to-ctm, lattice-to-phone-lattice and nbest-to-ctm again."""
+    tmodel = TransitionModel(model)
+    with open(str(word_ctm), 'w', encoding='utf-8') as wf, open(str(phone_ctm), 'w', encoding='utf-8') as pf:
+        for key, start, states in read_compact_lattices(lattice):
+            res = linear_path(start, states)
+            if res is None:
+                raise RuntimeError(f'Lattice for {key} is not linear!')
+            path, final = res
+            write_ctm(wf, key, word_alignment(path), frame_shift)
+            write_ctm(pf, key, phone_alignment(path, list(final), tmodel), frame_shift)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Converts aligned compact lattices to word and phone CTMs.')
+    parser.add_argument('model', type=Path)
+    parser.add_argument('lattice', type=Path)
+    parser.add_argument('word_ctm', type=Path)
+    parser.add_argument('phone_ctm', type=Path)
+    parser.add_argument('--frame-shift', type=float, default=0.01)
+
+    args = parser.parse_args()
+
+    lattice_to_ctms(args.model, args.lattice, args.word_ctm, args.phone_ctm, args.frame_shift)
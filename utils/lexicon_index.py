@@ -0,0 +1,138 @@
+import argparse
+import mmap
+import os
+import struct
+import tempfile
+from pathlib import Path
+
+from utils.log import log
+
+# header: magic, version, lexicon size, lexicon mtime (ns), number of words
+header = struct.Struct('<4siqqq')
+magic = b'KLXI'
+version = 1
+
+
+class LexiconIndex:
+
+    def __init__(self, lex_path, index_path=None):
+        self.lex_path = Path(lex_path)
+        if index_path:
+            self.index_path = Path(index_path)
+        else:
+            self.index_path = self.lex_path.with_name(self.lex_path.name + '.idx')
+
+        if not self.is_current():
+            self.build()
+
+        self.file = open(str(self.index_path), 'rb')
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.num = header.unpack_from(self.mm, 0)[4]
+        self.offsets = memoryview(self.mm)[header.size:header.size + (self.num + 1) * 8].cast('Q')
+        self.base = header.size + (self.num + 1) * 8
+
+    def is_current(self):
+        if not self.index_path.exists():
+            return False
+        st = self.lex_path.stat()
+        with open(str(self.index_path), 'rb') as f:
+            h = f.read(header.size)
+        if len(h) != header.size:
+            return False
+        m, v, size, mtime, num = header.unpack(h)
+        return m == magic and v == version and size == st.st_size and mtime == st.st_mtime_ns
+
+    def build(self):
+        log.info(f'Building lexicon index {self.index_path} from {self.lex_path}.')
+
+        st = self.lex_path.stat()
+        prons = {}
+        with open(str(self.lex_path), encoding='utf-8') as f:
+            for l in f:
+                tok = l.strip().split()
+                if len(tok) == 0:
+                    continue
+                if tok[0] not in prons:
+                    prons[tok[0]] = []
+                prons[tok[0]].append(' '.join(tok[1:]))
+
+        records = []
+        for w in sorted(prons):
+            records.append(w.encode('utf-8') + b'\t' + '\n'.join(prons[w]).encode('utf-8'))
+
+        offsets = [0]
+        for r in records:
+            offsets.append(offsets[-1] + len(r))
+
+        fd, tmp = tempfile.mkstemp(dir=str(self.index_path.parent), prefix=self.index_path.name)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(header.pack(magic, version, st.st_size, st.st_mtime_ns, len(records)))
+            f.write(struct.pack(f'<{len(offsets)}Q', *offsets))
+            for r in records:
+                f.write(r)
+        os.replace(tmp, str(self.index_path))
+
+        log.info(f'Indexed {len(records)} words.')
+
+    def record(self, i):
+        return self.base + self.offsets[i], self.base + self.offsets[i + 1]
+
+    def find(self, word):
+        key = word.encode('utf-8')
+        lo = 0
+        hi = self.num
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start, end = self.record(mid)
+            w = self.mm[start:self.mm.find(b'\t', start, end)]
+            if w < key:
+                lo = mid + 1
+            elif w > key:
+                hi = mid
+            else:
+                return mid
+        return -1
+
+    def get(self, word):
+        i = self.find(word)
+        if i < 0:
+            return None
+        start, end = self.record(i)
+        start = self.mm.find(b'\t', start, end) + 1
+        return [p.split() for p in self.mm[start:end].decode('utf-8').split('\n')]
+
+    def words(self):
+        for i in range(self.num):
+            start, end = self.record(i)
+            yield self.mm[start:self.mm.find(b'\t', start, end)].decode('utf-8')
+
+    def lookup(self, wordlist):
+        lexicon = {}
+        for w in wordlist:
+            t = self.get(w)
+            if t is not None:
+                lexicon[w] = t
+        return lexicon
+
+    def __contains__(self, word):
+        return self.find(word) >= 0
+
+    def __len__(self):
+        return self.num
+
+    def close(self):
+        self.offsets.release()
+        self.mm.close()
+        self.file.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('lexicon')
+    parser.add_argument('--index')
+
+    args = parser.parse_args()
+
+    index = LexiconIndex(args.lexicon, args.index)
+    print(f'{len(index)} words in {index.index_path}')
+    index.close()
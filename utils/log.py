@@ -1,4 +1,10 @@
+import atexit
 import logging
+import logging.handlers
+import queue
+import time
+from pathlib import Path
+from threading import Thread
 
 log = logging.getLogger('kaldi')
 log.setLevel(logging.DEBUG)
@@ -6,4 +12,123 @@ fh = logging.FileHandler('main.log')
 fh.setLevel(logging.DEBUG)
 formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 fh.setFormatter(formatter)
-log.addHandler(fh)
\ No newline at end of file
+log.addHandler(fh)
+
+
+class QueueLogWriter(Thread):
+    """Moves the file writes of the 'kaldi' logger to a background thread.
+
+    Records are put on a queue without blocking and written in batches, either when batch_size
+    records are waiting or flush_interval seconds after the first of them arrived. Records logged
+    with a 'job' attribute go to log_dir/<job>.log, everything else goes to main.log."""
+
+    def __init__(self, log_dir=None, batch_size=200, flush_interval=0.5):
+        Thread.__init__(self)
+        self.daemon = True
+        self.log_dir = Path(log_dir) if log_dir else None
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        self.handler = logging.handlers.QueueHandler(self.queue)
+        self.job_files = {}
+
+        log.removeHandler(fh)
+        log.addHandler(self.handler)
+        self.start()
+
+    def run(self):
+        batch = []
+        deadline = None
+        stop = False
+        while not stop:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                rec = self.queue.get(timeout=timeout)
+                if rec is None:
+                    stop = True
+                else:
+                    batch.append(rec)
+                    if deadline is None:
+                        deadline = time.monotonic() + self.flush_interval
+            except queue.Empty:
+                pass
+            if stop or len(batch) >= self.batch_size or (deadline and time.monotonic() >= deadline):
+                self.write(batch)
+                batch = []
+                deadline = None
+
+    def write(self, batch):
+        lines = {}
+        for rec in batch:
+            lines.setdefault(getattr(rec, 'job', None), []).append(fh.format(rec) + '\n')
+        for job, l in lines.items():
+            if job is None or self.log_dir is None:
+                stream = fh.stream
+            else:
+                if job not in self.job_files:
+                    self.log_dir.mkdir(parents=True, exist_ok=True)
+                    self.job_files[job] = open(str(self.log_dir / f'{job}.log'), 'a', encoding='utf-8')
+                stream = self.job_files[job]
+            stream.write(''.join(l))
+            stream.flush()
+
+    def stop(self):
+        self.queue.put(None)
+        self.join()
+        for f in self.job_files.values():
+            f.close()
+        log.removeHandler(self.handler)
+        log.addHandler(fh)
+
+
+class RateLimiter:
+    """Token bucket allowing 'rate' lines per second on average, with bursts of up to 'burst' lines."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst else rate
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.dropped = 0
+
+    def allow(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return True
+        self.dropped += 1
+        return False
+
+
+def kaldi_level(line, default):
+    if line.startswith('LOG ('):
+        return logging.INFO
+    if line.startswith('VLOG['):
+        return logging.DEBUG
+    if line.startswith('WARNING ('):
+        return logging.WARNING
+    if line.startswith('ERROR (') or line.startswith('ASSERTION_FAILED ('):
+        return logging.ERROR
+    return default
+
+
+queue_writer = None
+
+
+def start_queue_logging(log_dir=None, batch_size=200, flush_interval=0.5):
+    global queue_writer
+    if queue_writer is None:
+        queue_writer = QueueLogWriter(log_dir, batch_size, flush_interval)
+        # the writer is a daemon thread, the records still queued when the program ends (eg. on an error)
+        # would be lost without this
+        atexit.register(stop_queue_logging)
+    return queue_writer
+
+
+def stop_queue_logging():
+    global queue_writer
+    if queue_writer is not None:
+        queue_writer.stop()
+        queue_writer = None
@@ -0,0 +1,164 @@
+import numpy as np
+
+from utils.log import log
+
+
+def frame_energies(samples, frame=160):
+    """Log energy in dB of each frame of 10 ms (at 16 kHz)."""
+    num = len(samples) // frame
+    frames = np.asarray(samples[:num * frame], dtype=np.float64).reshape(num, frame)
+    return 10 * np.log10(np.maximum((frames * frames).mean(axis=1), 1.0))
+
+
+def speech_threshold(energies, margin=10.0):
+    # the quietest frames are taken as the noise floor
+    return np.percentile(energies, 10) + margin
+
+
+def find_chunks(energies, min_chunk=1000, max_chunk=3000, smooth=30):
+    """Splits the frames into chunks of min_chunk to max_chunk frames, cutting each at the quietest point of
+    the energy averaged over smooth frames. Returns (start, end) frames of each chunk."""
+    smoothed = np.convolve(energies, np.ones(smooth) / smooth, mode='same')
+    chunks = []
+    pos = 0
+    while len(energies) - pos > max_chunk:
+        window = smoothed[pos + min_chunk:pos + max_chunk]
+        cut = pos + min_chunk + int(np.argmin(window))
+        chunks.append((pos, cut))
+        pos = cut
+    chunks.append((pos, len(energies)))
+    return chunks
+
+
+def anchor_words(words, chunks, energies, threshold):
+    """Coarse pass: shares the words out between the chunks in proportion to the amount of speech in each,
+    measuring words by their length in characters."""
+    speech = np.array([max(1, int((energies[s:e] > threshold).sum())) for s, e in chunks], dtype=np.float64)
+    bounds = np.cumsum(speech) / speech.sum()
+    lengths = np.array([len(w) + 1 for w in words], dtype=np.float64)
+    # the middle of each word, as a fraction of the whole transcription
+    centers = (np.cumsum(lengths) - lengths / 2) / lengths.sum()
+    idx = np.minimum(np.searchsorted(bounds, centers), len(chunks) - 1)
+    assigned = [[] for c in chunks]
+    for w, i in zip(words, idx):
+        assigned[i].append(w)
+    return assigned
+
+
+def merge_empty(pieces):
+    # chunks left without words (eg. long silences) are joined to a neighbour
+    merged = []
+    for start, end, words in pieces:
+        if merged and (not words or not merged[-1][2]):
+            merged[-1] = (merged[-1][0], end, merged[-1][2] + words)
+        else:
+            merged.append((start, end, words))
+    return merged
+
+
+def split_long_audio(samples, trans, rate=16000, min_chunk=10.0, max_chunk=30.0):
+    """Splits a long recording and its transcription into (start sample, end sample, words) pieces."""
+    frame = rate // 100
+    energies = frame_energies(samples, frame)
+    chunks = find_chunks(energies, int(min_chunk * 100), int(max_chunk * 100))
+    words = trans.split()
+    assigned = anchor_words(words, chunks, energies, speech_threshold(energies))
+    pieces = [(s * frame, e * frame if i < len(chunks) - 1 else len(samples), w)
+              for i, ((s, e), w) in enumerate(zip(chunks, assigned))]
+    pieces = merge_empty(pieces)
+    log.info(f'Split {len(samples) / rate:.1f}s of audio with {len(words)} words into {len(pieces)} chunks.')
+    return pieces
+
+
+def realign_boundaries(pool, audio, words, phones, rate=16000):
+    """Fixes the words the coarse pass put on the wrong side of a cut. The words and phones of each pair of
+    neighbouring chunks are lists of absolute (label, start, length). Around each cut, the words from the middle
+    of one chunk to the middle of the next are aligned again as one piece. The pieces never overlap, so they
+    are aligned in parallel."""
+    jobs = []
+    for k in range(len(words) - 1):
+        left, right = words[k], words[k + 1]
+        if not left or not right:
+            continue
+        mid_left = (left[0][1] + left[-1][1]) / 2
+        mid_right = (right[0][1] + right[-1][1]) / 2
+        i = next(n for n, w in enumerate(left) if w[1] >= mid_left)
+        j = next((n for n, w in enumerate(right) if w[1] >= mid_right), len(right))
+        start = left[i][1]
+        end = right[j][1] if j < len(right) else None
+        jobs.append((k, i, j, start, end))
+
+    # the windows are cut at word starts, so that no word is split between two of them
+    requests = []
+    for k, i, j, start, end in jobs:
+        s = int(round(start * rate)) * 2
+        e = int(round(end * rate)) * 2 if end is not None else len(audio)
+        requests.append((audio[s:e], ' '.join(w[0] for w in words[k][i:] + words[k + 1][:j])))
+
+    for (k, i, j, start, end), (seg_w, seg_p) in zip(jobs, pool.process_segments(requests)):
+        if not seg_w:
+            continue
+        new_w = [(w, round(s + start, 2), l) for w, s, l in seg_w]
+        new_p = [(p, round(s + start, 2), l) for p, s, l in seg_p]
+        n = len(words[k]) - i
+        words[k], words[k + 1] = words[k][:i] + new_w[:n], new_w[n:] + words[k + 1][j:]
+        left_p = [p for p in phones[k] if p[1] < start]
+        right_p = [p for p in phones[k + 1] if end is not None and p[1] >= end]
+        boundary = new_w[n][1] if n < len(new_w) else float('inf')
+        phones[k] = left_p + [p for p in new_p if p[1] < boundary]
+        phones[k + 1] = [p for p in new_p if p[1] >= boundary] + right_p
+
+
+def merge_failed(pieces, results, failed, rate=16000):
+    """Joins each failed chunk with its next neighbour (the previous one for the last chunk). The result of a
+    merged chunk is set to None, so that it is aligned again."""
+    for i in reversed(failed):
+        if i >= len(pieces):
+            continue
+        j = i + 1 if i + 1 < len(pieces) else i - 1
+        a, b = min(i, j), max(i, j)
+        log.warning(f'Chunk {pieces[i][0] / rate:.2f}-{pieces[i][1] / rate:.2f}s failed to align, '
+                    f'merging it with its neighbour.')
+        pieces[a:b + 1] = [(pieces[a][0], pieces[b][1], pieces[a][2] + pieces[b][2])]
+        results[a:b + 1] = [None]
+
+
+def align_long_audio(pool, audio, trans, rate=16000, min_chunk=10.0, max_chunk=30.0, refine=True):
+    """Aligns a long recording chunk by chunk on an AlignPipePool. A chunk that fails to align is merged with
+    its neighbour and the two are aligned again. Times in the result are from the start of the recording."""
+    samples = np.frombuffer(audio, dtype=np.int16)
+    pieces = split_long_audio(samples, trans, rate, min_chunk, max_chunk)
+    results = [None] * len(pieces)
+
+    while True:
+        todo = [i for i, r in enumerate(results) if r is None]
+        if not todo:
+            break
+        res = pool.process_segments([(audio[pieces[i][0] * 2:pieces[i][1] * 2], ' '.join(pieces[i][2]))
+                                     for i in todo])
+        failed = []
+        for i, (words, phones) in zip(todo, res):
+            if words:
+                results[i] = (words, phones)
+            else:
+                failed.append(i)
+        if not failed:
+            break
+        if len(pieces) == 1:
+            log.error('Failed to align the whole recording.')
+            results[0] = ([], [])
+            break
+
+        merge_failed(pieces, results, failed, rate)
+
+    words = []
+    phones = []
+    for (start, end, w), (seg_w, seg_p) in zip(pieces, results):
+        offset = start / rate
+        words.append([(w, round(s + offset, 2), l) for w, s, l in seg_w])
+        phones.append([(p, round(s + offset, 2), l) for p, s, l in seg_p])
+
+    if refine and len(pieces) > 1:
+        realign_boundaries(pool, audio, words, phones, rate)
+
+    return [w for chunk in words for w in chunk], [p for chunk in phones for p in chunk]
@@ -217,7 +217,7 @@ def write_fst_no_silence(lexicon, nonterminals=None, left_context_phones=None):
 
 
 def write_fst_with_silence(lexicon, sil_prob, sil_phone, sil_disambig,
-                           nonterminals=None, left_context_phones=None, file=sys.stdout):
+                           nonterminals=None, left_context_phones=None, file=sys.stdout, eps='<eps>'):
     """Writes the text format of L.fst to the standard output.  This version is for
        when --sil-prob != 0.0, meaning there is optional silence
      'lexicon' is a list of 3-tuples (word, pron-prob, prons)
@@ -232,6 +232,7 @@ def write_fst_with_silence(lexicon, sil_prob, sil_phone, sil_disambig,
      'left_context_phones', which also relates to grammar decoding, and must be
         supplied if 'nonterminals' is supplied is either None or a list of
         phones that may appear as left-context, e.g. ['a', 'ah', ... '#nonterm_bos'].
+     'eps' is the epsilon label, 0 when the words and phones are integer IDs.
     """
 
     assert sil_prob > 0.0 and sil_prob < 1.0
@@ -246,23 +247,23 @@ def write_fst_with_silence(lexicon, sil_prob, sil_phone, sil_disambig,
 
     print('{src}\t{dest}\t{phone}\t{word}\t{cost}'.format(
         src=start_state, dest=loop_state,
-        phone='<eps>', word='<eps>', cost=no_sil_cost), file=file)
+        phone=eps, word=eps, cost=no_sil_cost), file=file)
     print('{src}\t{dest}\t{phone}\t{word}\t{cost}'.format(
         src=start_state, dest=sil_state,
-        phone='<eps>', word='<eps>', cost=sil_cost), file=file)
+        phone=eps, word=eps, cost=sil_cost), file=file)
     if sil_disambig is None:
         print('{src}\t{dest}\t{phone}\t{word}\t{cost}'.format(
             src=sil_state, dest=loop_state,
-            phone=sil_phone, word='<eps>', cost=0.0), file=file)
+            phone=sil_phone, word=eps, cost=0.0), file=file)
     else:
         sil_disambig_state = next_state
         next_state += 1
         print('{src}\t{dest}\t{phone}\t{word}\t{cost}'.format(
             src=sil_state, dest=sil_disambig_state,
-            phone=sil_phone, word='<eps>', cost=0.0), file=file)
+            phone=sil_phone, word=eps, cost=0.0), file=file)
         print('{src}\t{dest}\t{phone}\t{word}\t{cost}'.format(
             src=sil_disambig_state, dest=loop_state,
-            phone=sil_disambig, word='<eps>', cost=0.0), file=file)
+            phone=sil_disambig, word=eps, cost=0.0), file=file)
 
     for (word, pronprob, pron) in lexicon:
         pron_cost = -math.log(pronprob)
@@ -271,7 +272,7 @@ def write_fst_with_silence(lexicon, sil_prob, sil_phone, sil_disambig,
             print("{src}\t{dest}\t{phone}\t{word}\t{cost}".format(
                 src=cur_state, dest=next_state,
                 phone=pron[i],
-                word=(word if i == 0 else '<eps>'),
+                word=(word if i == 0 else eps),
                 cost=(pron_cost if i == 0 else 0.0)), file=file)
             cur_state = next_state
             next_state += 1
@@ -280,14 +281,14 @@ def write_fst_with_silence(lexicon, sil_prob, sil_phone, sil_disambig,
         print("{src}\t{dest}\t{phone}\t{word}\t{cost}".format(
             src=cur_state,
             dest=loop_state,
-            phone=(pron[i] if i >= 0 else '<eps>'),
-            word=(word if i <= 0 else '<eps>'),
+            phone=(pron[i] if i >= 0 else eps),
+            word=(word if i <= 0 else eps),
             cost=no_sil_cost + (pron_cost if i <= 0 else 0.0)), file=file)
         print("{src}\t{dest}\t{phone}\t{word}\t{cost}".format(
             src=cur_state,
             dest=sil_state,
-            phone=(pron[i] if i >= 0 else '<eps>'),
-            word=(word if i <= 0 else '<eps>'),
+            phone=(pron[i] if i >= 0 else eps),
+            word=(word if i <= 0 else eps),
             cost=sil_cost + (pron_cost if i <= 0 else 0.0)), file=file)
 
     if nonterminals is not None:
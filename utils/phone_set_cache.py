@@ -0,0 +1,62 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+from utils.int_lexicon import position_suffixes
+from utils.log import log
+
+# change when the layout of the files in the bundle changes
+bundle_version = 1
+
+
+def phone_set_hash(phone_set) -> str:
+    spec = [bundle_version, phone_set.silence, phone_set.nonsilence, position_suffixes]
+    return hashlib.sha1(json.dumps(spec).encode('utf-8')).hexdigest()
+
+
+def link_or_copy(src, dst):
+    if os.path.exists(str(dst)):
+        os.unlink(str(dst))
+    try:
+        os.link(str(src), str(dst))
+    except OSError:
+        shutil.copyfile(str(src), str(dst))
+
+
+class PhoneSetCache:
+    """The language files that depend only on the phone set: phones.txt without the disambiguation symbols and
+    word_boundary.int. They are made once for each phone inventory, in a folder of cache_dir named by its hash,
+    and each language only adds the #n symbols of its vocabulary."""
+
+    def __init__(self, cache_dir, phone_set):
+        self.phone_set = phone_set
+        self.path = Path(cache_dir) / phone_set_hash(phone_set)
+        if not (self.path / 'phones.txt').exists():
+            self.build()
+        with open(str(self.path / 'phones.txt'), 'rb') as f:
+            self.phones = f.read()
+
+    def build(self):
+        log.info(f'Building the phone set files in {self.path}')
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = Path(tempfile.mkdtemp(dir=str(self.path.parent), prefix='tmp-'))
+        self.phone_set.write_phones(tmp / 'phones.txt', -1)
+        self.phone_set.write_word_boundary(tmp / 'word_boundary.int')
+        try:
+            os.rename(str(tmp), str(self.path))
+        except OSError:
+            # made by another job in the meantime
+            shutil.rmtree(str(tmp), ignore_errors=True)
+
+    def write(self, output_dir, max_disambig):
+        """Writes phones.txt, word_boundary.int and phones/disambig.{txt,int} of a language using the
+        disambiguation symbols #0 to #max_disambig."""
+        with open(str(output_dir / 'phones.txt'), 'wb') as f:
+            f.write(self.phones)
+            f.write(''.join(f'#{i} {self.phone_set.first_disambig + i}\n'
+                            for i in range(max_disambig + 1)).encode('utf-8'))
+        link_or_copy(self.path / 'word_boundary.int', output_dir / 'word_boundary.int')
+        self.phone_set.write_disambig(output_dir / 'phones', max_disambig)
@@ -6,7 +6,9 @@ import sys
 from pathlib import Path
 
 # Polish SAMPA only
+from utils.int_lexicon import IntLexicon, PhoneSet
 from utils.kaldi_programs import KaldiPrograms
+from utils.lexicon_index import LexiconIndex
 from utils.log import log
 
 nonsilence_phones = sorted(['I', 'S', 'Z', 'a', 'b', 'd', 'dZ', 'dz', 'dzi', 'e', 'en', 'f', 'g', 'i', 'j', 'k', 'l',
@@ -14,239 +16,144 @@ nonsilence_phones = sorted(['I', 'S', 'Z', 'a', 'b', 'd', 'dZ', 'dz', 'dzi', 'e'
                             'z', 'zi'])
 silence_phones = sorted(['sil', 'spn'])
 optional_silence = 'sil'
+sil_prob = 0.5
 
+phone_set = PhoneSet(silence_phones, nonsilence_phones)
 
-def range2fields(range_str, length):
-    if len(range_str) == 0:
-        return []
-    if ',' in range_str:
-        a = []
-        for i in range_str.split(','):
-            a.append(int(i.strip()))
-        return a
-    if '-' in range_str:
-        if range_str[0] == '-':
-            start = 0
-        else:
-            p = range_str.index('-')
-            start = int(range_str[:p].strip())
-        if range_str[1] == '-':
-            end = length
-        else:
-            p = range_str.index('-')
-            end = int(range_str[p + 1:].strip())
-        return range(start, end)
-    return [int(range_str.strip())]
 
+def read_word_ids(path):
+    word_ids = {}
+    with open(str(path), encoding='utf-8') as f:
+        for l in f:
+            w, id = l.split()
+            word_ids[w] = int(id)
+    return word_ids
 
-def txt2int(txt, int, p_fields, w_fields, phone_map):
-    with open(str(txt), encoding='utf-8') as f:
-        with open(str(int), 'w', encoding='utf-8') as g:
-            for l in f:
-                tok = l.strip().split()
-                for f in range2fields(p_fields, len(tok)):
-                    tok[f] = str(phone_map[tok[f]])
-                for f in range2fields(w_fields, len(tok)):
-                    tok[f] = str(words_map[tok[f]])
-                g.write(' '.join(tok))
-                g.write('\n')
+
+def write_transcription(path, transcription, word_ids):
+    with open(str(path), 'w', encoding='utf-8') as f:
+        for id, trans in transcription.items():
+            f.write(id)
+            for w in trans:
+                f.write(f' {word_ids[w]}')
+            f.write('\n')
 
 
-def prepare_language_wordlist(wordlist, transcription, output_dir, g2p_path, g2p_lex_path, oov, kaldi):
-    pre_lexicon = {}
-    with open(str(g2p_lex_path), encoding='utf-8') as f:
+def read_transcription(text_path):
+    transcription = {}
+    wordlist = set()
+    with open(str(text_path), encoding='utf-8') as f:
         for l in f:
             tok = l.strip().split()
-            if tok[0] not in pre_lexicon:
-                pre_lexicon[tok[0]] = []
-            pre_lexicon[tok[0]].append(tok[1:])
+            id = tok[0]
+            transcription[id] = []
+            for w in tok[1:]:
+                wordlist.add(w)
+                transcription[id].append(w)
+    return transcription, sorted(wordlist)
 
-    with open(str(output_dir / 'wordlist'), 'w', encoding='utf-8') as f:
-        for w in wordlist:
-            if w not in pre_lexicon:
-                f.write(f'{w}\n')
 
-    kaldi.phonetisaurus_g2p(g2p_path, output_dir /
-                            'wordlist', output_dir / 'lexicon.raw')
+def prepare_language_wordlist(wordlist, transcription, output_dir, g2p_path, g2p_lex_path, oov, kaldi,
+                              g2p_cache=None, fst_mode='fstcompile', phone_cache=None, language_cache=None,
+                              pronunciations=None):
+    """The words missing from the lexicon take their pronunciations from pronunciations (a dict of word to lists
+    of phones), the G2P cache or the G2P, in this order. Returns the pronunciations of these words, or None when
+    the files were taken from the language cache."""
+    # sorted, so the same vocabulary always gives the same files
+    wordlist = sorted(set(wordlist))
+
+    if language_cache:
+        key = language_cache.key(wordlist, oov)
+        if language_cache.get(key, output_dir):
+            if transcription:
+                write_transcription(output_dir / 'trans.int', transcription, read_word_ids(output_dir / 'words.txt'))
+            return None
+
+    lex_index = LexiconIndex(g2p_lex_path)
+    pre_lexicon = lex_index.lookup(wordlist)
+    lex_index.close()
+
+    oov_words = [w for w in wordlist if w not in pre_lexicon]
 
     post_lexicon = {}
-    with open(str(output_dir / 'lexicon.raw'), encoding='utf-8') as f:
-        for l in f:
-            tok = l.strip().split()
-            if tok[0] not in pre_lexicon:
-                post_lexicon[tok[0]] = []
-            post_lexicon[tok[0]].append(tok[2:])
+    if pronunciations and oov_words:
+        post_lexicon = {w: pronunciations[w] for w in oov_words if w in pronunciations}
+        oov_words = [w for w in oov_words if w not in post_lexicon]
+
+    if g2p_cache and oov_words:
+        post_lexicon.update(g2p_cache.get(oov_words))
+        oov_words = [w for w in oov_words if w not in post_lexicon]
+
+    if oov_words:
+        with open(str(output_dir / 'wordlist'), 'w', encoding='utf-8') as f:
+            for w in oov_words:
+                f.write(f'{w}\n')
+
+        # with the settings the G2P cache keys its pronunciations by
+        g2p_opts = {'pmass': g2p_cache.pmass, 'nbest': g2p_cache.nbest} if g2p_cache else {}
+        kaldi.phonetisaurus_g2p(g2p_path, output_dir / 'wordlist', output_dir / 'lexicon.raw', **g2p_opts)
+
+        g2p_lexicon = {}
+        with open(str(output_dir / 'lexicon.raw'), encoding='utf-8') as f:
+            for l in f:
+                tok = l.strip().split()
+                if tok[0] not in g2p_lexicon:
+                    g2p_lexicon[tok[0]] = []
+                g2p_lexicon[tok[0]].append(tok[2:])
 
-    lexicon = []
-    lexicon.append((oov, 1.0, ['spn']))
+        if g2p_cache:
+            g2p_cache.put(g2p_lexicon)
+        post_lexicon.update(g2p_lexicon)
+
+    lexicon = IntLexicon(phone_set, [oov] + wordlist)
+    lexicon.add(oov, 1.0, ['spn'])
     for w in wordlist:
         if w in pre_lexicon:
             t = pre_lexicon[w]
         else:
             t = post_lexicon[w]
         for tr in t:
-            lexicon.append((w, 1.0, tr))
-
-    for w, p, trans in lexicon:
-        for ph in trans:
-            assert ph in nonsilence_phones or ph in silence_phones, f'ERROR: {ph} is not a proper phoneme!'
+            lexicon.add(w, 1.0, tr)
 
-    # add _B_E_S_I
-    for w, p, trans in lexicon:
-        if len(trans) == 1:
-            trans[0] += '_S'
-        else:
-            trans[0] += '_B'
-            if len(trans) > 2:
-                for i in range(1, len(trans) - 1):
-                    trans[i] += '_I'
-            trans[-1] += '_E'
-
-    # add_disambig
-    first_sym = 1  # 0 is reserved for wdisambig
-    max_disambig = first_sym - 1
-    reserved_empty = set()
-    last_sym = {}
-
-    count = {}  # number of identical transcripstions
-    for w, p, trans in lexicon:
-        x = ' '.join(trans)
-        if x not in count:
-            count[x] = 1
-        else:
-            count[x] += 1
-
-    prefix = set()  # set of all possible prefixes (does not include full transcriptions)
-    for w, p, trans in lexicon:
-        t = trans.copy()
-        while len(t) > 0:
-            t.pop()
-            prefix.add(' '.join(t))
-
-    for w, p, trans in lexicon:
-        x = ' '.join(trans)
-        if x not in prefix and count[x] == 1:
-            pass
-        else:
-            if len(x) == 0:
-                max_disambig += 1
-                reserved_empty.add(max_disambig)
-                trans.append(f'#{max_disambig}')
-            else:
-                if x not in last_sym:
-                    curr_sym = first_sym
-                else:
-                    curr_sym = last_sym[x] + 1
-                while curr_sym in reserved_empty:
-                    curr_sym += 1
-                if curr_sym > max_disambig:
-                    max_disambig = curr_sym
-                last_sym[x] = curr_sym
-                trans.append(f'#{curr_sym}')
+    # add_disambig, 0 is reserved for wdisambig
+    max_disambig = lexicon.add_disambig(first_sym=1)
 
     max_disambig += 1
     sil_disambig = max_disambig
 
-    counter = 0
-    phone_map = {}
-    phone_map['<eps>'] = counter
-    counter += 1
-    for ph in silence_phones:
-        phone_map[ph] = counter
-        counter += 1
-        phone_map[ph + '_B'] = counter
-        counter += 1
-        phone_map[ph + '_E'] = counter
-        counter += 1
-        phone_map[ph + '_S'] = counter
-        counter += 1
-        phone_map[ph + '_I'] = counter
-        counter += 1
-    for ph in nonsilence_phones:
-        phone_map[ph + '_B'] = counter
-        counter += 1
-        phone_map[ph + '_E'] = counter
-        counter += 1
-        phone_map[ph + '_S'] = counter
-        counter += 1
-        phone_map[ph + '_I'] = counter
-        counter += 1
-    for i in range(max_disambig + 1):
-        phone_map[f'#{i}'] = counter
-        counter += 1
-
-    with open(str(output_dir / 'phones.txt'), 'w', encoding='utf-8') as f:
-        for p, i in phone_map.items():
-            f.write(f'{p} {i}\n')
-
-    phones_dir = output_dir/'phones'
-    phones_dir.mkdir(exist_ok=True)
-    with open(str(phones_dir / 'disambig.txt'), 'w', encoding='utf-8') as f:
-        for i in range(max_disambig + 1):
-            f.write(f'#{i}\n')
-
-    txt2int(phones_dir / 'disambig.txt', phones_dir / 'disambig.int', '0', '', phone_map)
-
-    counter = 0
-    words_map = {}
-    words_map['<eps>'] = counter
-    counter += 1
-    wordlist = set()
-    for w, p, t in lexicon:
-        wordlist.add(w)
-    for w in sorted(wordlist):
-        words_map[w] = counter
-        counter += 1
-    words_map['#0'] = counter
-    counter += 1
-    words_map['<s>'] = counter
-    counter += 1
-    words_map['</s>'] = counter
-
-    with open(str(output_dir / 'words.txt'), 'w', encoding='utf-8') as f:
-        for w, i in words_map.items():
-            f.write(f'{w} {i}\n')
+    # only the disambiguation symbols depend on the vocabulary, the rest comes from the phone set
+    if phone_cache:
+        phone_cache.write(output_dir, max_disambig)
+    else:
+        phone_set.write_phones(output_dir / 'phones.txt', max_disambig)
+        phone_set.write_word_boundary(output_dir / 'word_boundary.int')
+        phone_set.write_disambig(output_dir / 'phones', max_disambig)
+
+    lexicon.write_words(output_dir / 'words.txt')
 
     if transcription:
-        with open(str(output_dir / 'trans.int'), 'w', encoding='utf-8') as f:
-            for id, trans in transcription.items():
-                f.write(id)
-                for w in trans:
-                    f.write(f' {words_map[w]}')
-                f.write('\n')
-
-    with open(str(output_dir / 'word_boundary.int'), 'w', encoding='utf-8') as f:
-        cnt = 1
-        for i in range(len(silence_phones)):
-            for b in ['nonword', 'begin', 'end', 'singleton', 'internal']:
-                f.write(f'{cnt} {b}\n')
-                cnt += 1
-        for i in range(len(nonsilence_phones)):
-            for b in ['begin', 'end', 'singleton', 'internal']:
-                f.write(f'{cnt} {b}\n')
-                cnt += 1
-
-    kaldi.make_L_fst(lexicon, output_dir / 'L_unsorted.fst', optional_silence, output_dir / 'phones.txt',
-                     output_dir / 'words.txt')
-
-    kaldi.fstarcsort(output_dir / 'L_unsorted.fst', output_dir / 'L.fst')
-
-
-def prepare_language_file(text_path, output_dir, g2p_path, g2p_lex_path, oov, kaldi):
+        write_transcription(output_dir / 'trans.int', transcription, lexicon.word_ids)
+
+    if fst_mode == 'python':
+        kaldi.make_L_fst(lexicon, output_dir / 'L.fst', optional_silence, mode='python', sil_prob=sil_prob)
+    else:
+        kaldi.make_L_fst(lexicon, output_dir / 'L_unsorted.fst', optional_silence, sil_prob=sil_prob)
+
+        kaldi.fstarcsort(output_dir / 'L_unsorted.fst', output_dir / 'L.fst')
+
+    if language_cache:
+        language_cache.put(key, output_dir)
+
+    return post_lexicon
+
+
+def prepare_language_file(text_path, output_dir, g2p_path, g2p_lex_path, oov, kaldi, g2p_cache=None,
+                          fst_mode='fstcompile', phone_cache=None, language_cache=None):
     log.info(f'Using {text_path} to prepare language files in {output_dir}.')
 
-    transcription = {}
-    wordlist = set()
-    with open(str(text_path), encoding='utf-8') as f:
-        for l in f:
-            tok = l.strip().split()
-            id = tok[0]
-            transcription[id] = []
-            for w in tok[1:]:
-                wordlist.add(w)
-                transcription[id].append(w)
-    wordlist = sorted(wordlist)
-    return prepare_language_wordlist(wordlist, transcription, output_dir, g2p_path, g2p_lex_path, oov, kaldi)
+    transcription, wordlist = read_transcription(text_path)
+    return prepare_language_wordlist(wordlist, transcription, output_dir, g2p_path, g2p_lex_path, oov, kaldi,
+                                     g2p_cache, fst_mode, phone_cache, language_cache)
 
 
 if __name__ == '__main__':
@@ -258,6 +165,7 @@ if __name__ == '__main__':
     parser.add_argument('--g2p-lexicon', default='data/g2p/lexicon.txt')
     parser.add_argument(
         '--kaldi-root', default='/home/guest/Applications/kaldi')
+    parser.add_argument('--fst-mode', default='fstcompile', choices=['fstcompile', 'python'])
 
     args = parser.parse_args()
 
@@ -272,4 +180,4 @@ if __name__ == '__main__':
     oov = args.oov_word
 
     prepare_language_file(text_path, output_dir, g2p_path,
-                          g2p_lex_path, oov, kaldi)
+                          g2p_lex_path, oov, kaldi, fst_mode=args.fst_mode)
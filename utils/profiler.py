@@ -0,0 +1,158 @@
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock, local
+
+from utils.log import log
+
+
+class Profiler:
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.records = []
+        self.counters = {}
+        self.lock = Lock()
+        self.current = local()
+
+    @contextmanager
+    def stage(self, name, **info):
+        """Records the wall time of a stage and the resources of the processes it waits for. A stage started
+        inside another one in the same thread is nested in it: its wall time is also part of the parent's, but
+        not of the parent's self_wall, and the processes are counted only in the innermost stage."""
+        parent = getattr(self.current, 'rec', None)
+        rec = {'stage': name, 'wall': 0.0, 'self_wall': 0.0, 'child_cpu': 0.0, 'child_max_rss': 0,
+               'parent': parent['stage'] if parent else None, 'depth': parent['depth'] + 1 if parent else 0,
+               'nested_wall': 0.0}
+        rec.update(info)
+        self.current.rec = rec
+        start = time.perf_counter()
+        try:
+            yield rec
+        finally:
+            rec['wall'] = time.perf_counter() - start
+            rec['self_wall'] = rec['wall'] - rec.pop('nested_wall')
+            if parent:
+                parent['nested_wall'] += rec['wall']
+            self.current.rec = parent
+            self.add(rec)
+
+    def add(self, rec):
+        with self.lock:
+            self.records.append(rec)
+
+    def set_counters(self, name, values):
+        with self.lock:
+            self.counters[name] = values
+
+    def child(self, usage, rec=None):
+        # usage is the rusage returned by os.wait4 for a finished child process
+        if rec is None:
+            rec = getattr(self.current, 'rec', None)
+        if rec is None:
+            return
+        rec['child_cpu'] += usage.ru_utime + usage.ru_stime
+        # ru_maxrss is in kilobytes on Linux, but in bytes on macOS
+        rss = usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+        rec['child_max_rss'] = max(rec['child_max_rss'], rss)
+
+    def summary(self):
+        stages = {}
+        with self.lock:
+            records = list(self.records)
+        for rec in records:
+            s = stages.setdefault(rec['stage'], {'count': 0, 'wall': 0.0, 'self_wall': 0.0, 'child_cpu': 0.0,
+                                                 'child_max_rss': 0, 'audio': 0.0, 'parent': rec.get('parent'),
+                                                 'depth': rec.get('depth', 0)})
+            s['count'] += 1
+            s['wall'] += rec['wall']
+            s['self_wall'] += rec.get('self_wall', rec['wall'])
+            s['child_cpu'] += rec['child_cpu']
+            s['child_max_rss'] = max(s['child_max_rss'], rec['child_max_rss'])
+            s['audio'] += rec.get('audio', 0.0)
+        return stages
+
+    def report(self, audio_duration=None):
+        total = time.perf_counter() - self.start
+        stages = self.summary()
+        if audio_duration:
+            for s in stages.values():
+                s['rtf'] = s['wall'] / audio_duration
+        with self.lock:
+            records = list(self.records)
+            counters = dict(self.counters)
+        # the nested stages are already part of the wall time of the outermost ones, and the records added
+        # directly (requests, processes) overlap the stages and each other
+        stages_wall = sum(rec['wall'] for rec in records if rec.get('depth') == 0)
+        return {'total_wall': total, 'stages_wall': stages_wall, 'audio_duration': audio_duration,
+                'rtf': total / audio_duration if audio_duration else None,
+                'stages': stages, 'counters': counters, 'records': records}
+
+    def dump(self, path, audio_duration=None):
+        with open(str(path), 'w', encoding='utf-8') as f:
+            json.dump(self.report(audio_duration), f, indent=2)
+
+    def print_summary(self, audio_duration=None, file=sys.stderr):
+        report = self.report(audio_duration)
+        lines = [f'{"stage":<28}{"count":>7}{"wall [s]":>11}{"self [s]":>11}{"cpu [s]":>11}{"rss [MB]":>10}'
+                 f'{"RTF":>8}']
+        for name, s in self.nested_order(report['stages']):
+            rtf = f'{s["rtf"]:.3f}' if audio_duration else '-'
+            name = '  ' * s['depth'] + name
+            lines.append(f'{name:<28}{s["count"]:>7}{s["wall"]:>11.3f}{s["self_wall"]:>11.3f}'
+                         f'{s["child_cpu"]:>11.3f}{s["child_max_rss"] / 2 ** 20:>10.1f}{rtf:>8}')
+        lines.append(f'{"stages":<28}{"":>7}{report["stages_wall"]:>11.3f}{"":>11}{"":>11}{"":>10}{"":>8}')
+        rtf = f'{report["rtf"]:.3f}' if audio_duration else '-'
+        lines.append(f'{"total":<28}{"":>7}{report["total_wall"]:>11.3f}{"":>11}{"":>11}{"":>10}{rtf:>8}')
+        for l in lines:
+            log.info(l)
+            print(l, file=file)
+
+
+    @staticmethod
+    def nested_order(stages):
+        # each stage followed by the ones nested in it
+        children = {}
+        for name, s in stages.items():
+            parent = s['parent'] if s['parent'] in stages and s['parent'] != name else None
+            children.setdefault(parent, []).append(name)
+        order = []
+        pending = list(reversed(children.get(None, [])))
+        while pending:
+            name = pending.pop()
+            if name in order:
+                continue
+            order.append(name)
+            pending.extend(reversed(children.get(name, [])))
+        order.extend(name for name in stages if name not in order)
+        return [(name, stages[name]) for name in order]
+
+
+def profiled(name):
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.profiler.stage(name):
+                return method(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def wait_process(proc, profiler=None, rec=None):
+    """Waits for a Popen process, collecting its resource usage with os.wait4 where it is available."""
+    if hasattr(os, 'wait4') and proc.returncode is None:
+        pid, status, usage = os.wait4(proc.pid, 0)
+        if os.WIFSIGNALED(status):
+            proc.returncode = -os.WTERMSIG(status)
+        else:
+            proc.returncode = os.WEXITSTATUS(status)
+        if profiler:
+            profiler.child(usage, rec)
+    else:
+        proc.wait()
+    return proc.returncode
@@ -0,0 +1,67 @@
+import mmap
+import struct
+
+
+class MappedWave:
+
+    def __init__(self, path):
+        self.file = open(str(path), 'rb')
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        riff, size, wave = struct.unpack_from('<4sI4s', self.mm, 0)
+        assert riff == b'RIFF' and wave == b'WAVE', f'Not a WAV file: {path}'
+
+        fmt = None
+        data = None
+        pos = 12
+        while pos + 8 <= len(self.mm):
+            chunk_id, chunk_size = struct.unpack_from('<4sI', self.mm, pos)
+            pos += 8
+            if chunk_id == b'fmt ':
+                fmt = struct.unpack_from('<HHIIHH', self.mm, pos)
+            elif chunk_id == b'data':
+                # streamed files may leave the data size unset, so never go past the end of the file
+                data = (pos, min(chunk_size, len(self.mm) - pos))
+                break
+            pos += chunk_size + chunk_size % 2
+
+        assert fmt is not None, f'Missing fmt chunk in {path}'
+        assert data is not None, f'Missing data chunk in {path}'
+
+        audio_format, self.nchannels, self.framerate, byte_rate, block_align, bits = fmt
+        assert audio_format in [1, 0xFFFE], f'Only PCM audio is supported: {path}'
+        self.sampwidth = bits // 8
+        self.nframes = data[1] // (self.sampwidth * self.nchannels)
+
+        self.data = memoryview(self.mm)[data[0]:data[0] + self.nframes * self.sampwidth * self.nchannels]
+
+    def getframerate(self):
+        return self.framerate
+
+    def getsampwidth(self):
+        return self.sampwidth
+
+    def getnchannels(self):
+        return self.nchannels
+
+    def getnframes(self):
+        return self.nframes
+
+    def frames(self, start, end):
+        width = self.sampwidth * self.nchannels
+        return self.data[start * width:end * width]
+
+    def close(self):
+        self.data.release()
+        try:
+            self.mm.close()
+        except BufferError:
+            # segments handed out are still alive, the mapping goes away with the last of them
+            pass
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
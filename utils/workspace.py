@@ -0,0 +1,27 @@
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+from utils.log import log
+
+ram_root = Path('/dev/shm')
+
+
+def create_workspace(root, ram=False):
+    """Creates a new, uniquely named folder under root for the intermediate files of one job. With ram,
+    the folder is created on tmpfs instead, if the system has one."""
+    if ram:
+        if ram_root.is_dir() and os.access(str(ram_root), os.W_OK):
+            root = ram_root / 'kaldi-align'
+        else:
+            log.warning(f'{ram_root} is not available, keeping the intermediate files in {root}.')
+    root = Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+    work = Path(tempfile.mkdtemp(prefix='job-', dir=str(root)))
+    log.info(f'Workspace: {work}')
+    return work
+
+
+def remove_workspace(work):
+    shutil.rmtree(str(work), ignore_errors=True)